@@ -0,0 +1,120 @@
+import email.utils
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# status codes that signal that vault is overloaded, 0 is a request that got no response
+OVERLOAD_STATUS_CODES = (0, 429, 503, 504)
+# status codes of requests that may be retried once vault recovers
+RETRY_STATUS_CODES = (429, 503)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the seconds to wait according to a Retry-After header, given as seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class AdaptiveController:
+    """Limits the requests in flight to vault and the size of bulk requests, adapting both to what vault
+    sustains.
+
+    Both limits grow additively while requests succeed within target_latency, and shrink multiplicatively
+    (by backoff, at most once per round trip) on slow requests, errors that signal overload, and 429s. While
+    vault asks to retry after some time, no requests are sent."""
+
+    def __init__(self, initial_concurrency: int = 4, min_concurrency: int = 1, max_concurrency: int = 64,
+                 target_latency: float = 1.0, initial_batch_items: int = 500, min_batch_items: int = 10,
+                 max_batch_items: int = 5000, max_batch_bytes: int = 4 * 1024 * 1024, backoff: float = 0.5,
+                 max_retries: int = 3, retry_backoff: float = 0.1, max_retry_after: float = 30.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.min_batch_items = min_batch_items
+        self.max_batch_items = max_batch_items
+        self.max_batch_bytes = max_batch_bytes
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_after = max_retry_after
+        self.concurrency_limit = float(initial_concurrency)
+        self.batch_items = initial_batch_items
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def get_state(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                'concurrency_limit': int(self.concurrency_limit),
+                'in_flight': self.in_flight,
+                'batch_items': self.batch_items,
+                'max_batch_bytes': self.max_batch_bytes,
+                'paused_secs': max(self._paused_until - time.monotonic(), 0.0),
+            }
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight < int(self.concurrency_limit):
+                    break
+                else:
+                    self._condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self) -> bool:
+        """Like acquire(), but return False instead of blocking when a request may not be sent now"""
+        with self._condition:
+            if self._paused_until > time.monotonic() or self.in_flight >= int(self.concurrency_limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float, status_code: int, retry_after: Optional[float] = None):
+        """Record the outcome of a request sent after acquire()"""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status_code in OVERLOAD_STATUS_CODES or latency > self.target_latency:
+                # requests that were in flight together report the same congestion, it is acted on once
+                if now - self._last_decrease > latency:
+                    self._last_decrease = now
+                    self.concurrency_limit = max(float(self.min_concurrency), self.concurrency_limit * self.backoff)
+                    self.batch_items = max(self.min_batch_items, int(self.batch_items * self.backoff))
+            elif status_code == 200:
+                self.concurrency_limit = min(float(self.max_concurrency),
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+                self.batch_items = min(self.max_batch_items, self.batch_items + max(self.batch_items // 10, 1))
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + min(retry_after, self.max_retry_after))
+            self._condition.notify_all()
+
+    def split(self, items: List[Any], size: Callable[[Any], int]) -> Iterator[List[Any]]:
+        """Split items into batches of up to batch_items items and max_batch_bytes bytes, estimated by size.
+        The limit is read for each batch, so it follows adaptation while a large list is sent."""
+        batch: List[Any] = []
+        batch_bytes = 0
+        for item in items:
+            item_bytes = size(item)
+            if batch and (len(batch) >= self.batch_items or batch_bytes + item_bytes > self.max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += item_bytes
+        if batch:
+            yield batch
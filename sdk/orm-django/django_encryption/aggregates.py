@@ -0,0 +1,139 @@
+import bisect
+from typing import Any, List, Optional, Sequence
+
+from django.db.models import F
+from django.db.models.aggregates import Aggregate, Avg, Count, Max, Min, Sum
+from django.db.models.expressions import Star
+
+
+class Histogram:
+    """Count the values of a field per bucket, for decrypted_aggregate().
+
+    bins are sorted bucket edges. The result is a list of len(bins) + 1 counts: the values below bins[0],
+    the values in each [bins[i], bins[i + 1]) and the values of at least bins[-1]."""
+
+    def __init__(self, field_name: str, bins: Sequence[Any]):
+        if list(bins) != sorted(bins):
+            raise ValueError('Histogram bins must be sorted')
+        self.field_name = field_name
+        self.bins = list(bins)
+
+
+class Accumulator:
+    """Folds the values of one field, chunk by chunk, into a running aggregate"""
+
+    def __init__(self, field_name: Optional[str]):
+        # None for aggregates over rows rather than a field, i.e. Count('*')
+        self.field_name = field_name
+
+    def add(self, values: List[Any]):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class _Sum(Accumulator):
+    def __init__(self, field_name):
+        super().__init__(field_name)
+        self.total = None
+
+    def add(self, values):
+        values = [value for value in values if value is not None]
+        if values:
+            total = sum(values[1:], values[0])
+            self.total = total if self.total is None else self.total + total
+
+    def result(self):
+        return self.total
+
+
+class _Avg(Accumulator):
+    def __init__(self, field_name):
+        super().__init__(field_name)
+        self.total = 0
+        self.count = 0
+
+    def add(self, values):
+        values = [value for value in values if value is not None]
+        self.total += sum(values)
+        self.count += len(values)
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+class _Extremum(Accumulator):
+    def __init__(self, field_name, function):
+        super().__init__(field_name)
+        self.function = function
+        self.value = None
+
+    def add(self, values):
+        values = [value for value in values if value is not None]
+        if values:
+            value = self.function(values)
+            self.value = value if self.value is None else self.function(self.value, value)
+
+    def result(self):
+        return self.value
+
+
+class _Count(Accumulator):
+    def __init__(self, field_name):
+        super().__init__(field_name)
+        self.count = 0
+
+    def add(self, values):
+        if self.field_name is None:
+            self.count += len(values)
+        else:
+            self.count += len(values) - values.count(None)
+
+    def result(self):
+        return self.count
+
+
+class _Histogram(Accumulator):
+    def __init__(self, field_name, bins):
+        super().__init__(field_name)
+        self.bins = bins
+        self.counts = [0] * (len(bins) + 1)
+
+    def add(self, values):
+        for value in values:
+            if value is not None:
+                self.counts[bisect.bisect_right(self.bins, value)] += 1
+
+    def result(self):
+        return list(self.counts)
+
+
+def make_accumulator(aggregate) -> Accumulator:
+    """Return a new accumulator for a Sum, Avg, Min, Max or Count of a field name, or for a Histogram"""
+    if isinstance(aggregate, Histogram):
+        return _Histogram(aggregate.field_name, aggregate.bins)
+    if not isinstance(aggregate, Aggregate):
+        raise TypeError(f'{aggregate!r} is not an aggregate')
+    if aggregate.filter is not None or getattr(aggregate, 'distinct', False):
+        raise ValueError(f'{aggregate!r}: filter and distinct are not supported on decrypted values')
+    source = aggregate.get_source_expressions()[0]
+    if isinstance(source, Star):
+        field_name = None
+    elif isinstance(source, F):
+        field_name = source.name  # type: ignore[attr-defined]
+    else:
+        raise ValueError(f'{aggregate!r}: only aggregates of a field name are supported on decrypted values')
+    if isinstance(aggregate, Count):
+        return _Count(field_name)
+    if field_name is None:
+        raise ValueError(f'{aggregate!r} requires a field name')
+    if isinstance(aggregate, Sum):
+        return _Sum(field_name)
+    if isinstance(aggregate, Avg):
+        return _Avg(field_name)
+    if isinstance(aggregate, Min):
+        return _Extremum(field_name, min)
+    if isinstance(aggregate, Max):
+        return _Extremum(field_name, max)
+    raise ValueError(f'{aggregate!r} is not supported on decrypted values')
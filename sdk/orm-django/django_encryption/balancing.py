@@ -0,0 +1,95 @@
+import collections
+import itertools
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Sequence
+
+
+class Endpoint:
+    """One vault node, with the state the pool balances on"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self):
+        return f'Endpoint({self.url!r}, outstanding={self.outstanding})'
+
+
+class EndpointPool:
+    """Balances requests across vault nodes by least outstanding requests.
+
+    Nodes are ejected passively: a node that fails eject_after_failures requests in a row (no response or a
+    5xx) gets no requests for eject_secs, unless every node is ejected. The latencies of recent reads are
+    kept to compute the delay after which a read is hedged to a second node, in a separate window per kind
+    of read (e.g. single and bulk decrypts), since their latencies differ by orders of magnitude."""
+
+    def __init__(self, urls: Sequence[str], eject_after_failures: int = 3, eject_secs: float = 30.0,
+                 hedge_percentile: Optional[float] = None, hedge_min_samples: int = 20, latency_window: int = 1000):
+        if not urls:
+            raise ValueError('At least one vault endpoint is required')
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.eject_after_failures = eject_after_failures
+        self.eject_secs = eject_secs
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+        # rotates the order in which ties are broken, so idle nodes share the load
+        self._rotation = itertools.count()
+
+    def choose(self, exclude: Optional[Endpoint] = None) -> Optional[Endpoint]:
+        """Pick the healthy endpoint with the least outstanding requests and count a request on it. Returns
+        None when only the excluded endpoint is available."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint is not exclude]
+            healthy = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+            candidates = healthy or candidates
+            if not candidates:
+                return None
+            offset = next(self._rotation) % len(candidates)
+            rotated = candidates[offset:] + candidates[:offset]
+            endpoint = min(rotated, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def finish(self, endpoint: Endpoint, latency: float, ok: bool, kind: Optional[str] = None):
+        """Record the outcome of a request sent to an endpoint returned by choose(). The latency of a
+        successful read is added to the window of its kind."""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if ok:
+                endpoint.consecutive_failures = 0
+                if kind is not None:
+                    window = self._latencies.get(kind)
+                    if window is None:
+                        window = self._latencies[kind] = collections.deque(maxlen=self.latency_window)
+                    window.append(latency)
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.eject_after_failures:
+                endpoint.ejected_until = time.monotonic() + self.eject_secs
+                endpoint.consecutive_failures = 0
+
+    def hedge_delay(self, kind: str) -> Optional[float]:
+        """Seconds after which a read of the given kind should be hedged, None if hedging is disabled or not
+        warmed up yet for that kind"""
+        if self.hedge_percentile is None or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            window = self._latencies.get(kind, ())
+            if len(window) < self.hedge_min_samples:
+                return None
+            latencies: List[float] = sorted(window)
+        index = min(int(len(latencies) * self.hedge_percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def get_state(self) -> List[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [{'url': endpoint.url, 'outstanding': endpoint.outstanding,
+                     'ejected': endpoint.ejected_until > now} for endpoint in self.endpoints]
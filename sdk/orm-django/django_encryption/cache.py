@@ -0,0 +1,90 @@
+import functools
+import hashlib
+import hmac
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from django_encryption.vault_wrapper import Reason, Vault
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # pragma: no cover
+    Fernet = None  # type: ignore
+
+_logger = logging.getLogger(__name__)
+
+_KEY_PREFIX = 'django_encryption:decrypt'
+
+
+class DecryptCache:
+    """A cache of decrypted values shared between processes, backed by one of django's CACHES.
+
+    Decrypted values are encrypted with a local key before they are stored, and entries are keyed by
+    an HMAC of the vault, collection, property (including the transformation), reason and ciphertext,
+    so a value decrypted for one reason or transformation is never returned for another."""
+
+    def __init__(self, cache_alias: str, key: str, timeout: Optional[int]):
+        if Fernet is None:
+            raise ImproperlyConfigured('VAULT_DECRYPT_CACHE requires the cryptography package')
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self._fernet = Fernet(key)
+        self._hmac_key = hashlib.sha256(key.encode()).digest()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, vault: Vault, collection: Optional[str], field_name: str, reason: Reason, ciphertext: str) -> str:
+        scope = '\0'.join([vault.name, collection or '', field_name, reason.value, ciphertext])
+        digest = hmac.new(self._hmac_key, scope.encode(), hashlib.sha256).hexdigest()
+        return f'{_KEY_PREFIX}:{digest}'
+
+    def get_many(self, vault: Vault, collection: Optional[str], field_name: str, reason: Reason,
+                 ciphertexts: Iterable[str]) -> Dict[str, Any]:
+        """Return a mapping of ciphertext to decrypted value, for the ciphertexts found in the cache"""
+        key_to_ciphertext = {self.make_key(vault, collection, field_name, reason, ciphertext): ciphertext
+                             for ciphertext in ciphertexts}
+        if not key_to_ciphertext:
+            return {}
+        result = {}
+        for key, token in self.cache.get_many(list(key_to_ciphertext)).items():
+            try:
+                result[key_to_ciphertext[key]] = json.loads(self._fernet.decrypt(token))
+            except InvalidToken:
+                # written with a different key, treat as a miss
+                _logger.debug("ignoring decrypt cache entry %s that failed to decrypt", key)
+        return result
+
+    def set_many(self, vault: Vault, collection: Optional[str], field_name: str, reason: Reason,
+                 values: Dict[str, Any]):
+        """Store a mapping of ciphertext to decrypted value"""
+        if not values:
+            return
+        self.cache.set_many({
+            self.make_key(vault, collection, field_name, reason, ciphertext): self._fernet.encrypt(
+                json.dumps(value).encode())
+            for ciphertext, value in values.items()
+        }, timeout=self.timeout)
+
+
+@functools.lru_cache(maxsize=None)
+def _make_decrypt_cache(cache_alias: str, key: str, timeout: Optional[int]) -> DecryptCache:
+    return DecryptCache(cache_alias, key, timeout)
+
+
+def get_decrypt_cache() -> Optional[DecryptCache]:
+    """Return the cache configured by settings.VAULT_DECRYPT_CACHE, or None if it is not enabled, e.g.
+    VAULT_DECRYPT_CACHE = {'CACHE': 'default', 'KEY': Fernet.generate_key().decode(), 'TIMEOUT': 60}"""
+    config = getattr(settings, 'VAULT_DECRYPT_CACHE', None)
+    if not config:
+        return None
+    key = config.get('KEY')
+    if not key:
+        raise ImproperlyConfigured('VAULT_DECRYPT_CACHE must define KEY')
+    return _make_decrypt_cache(config.get('CACHE', 'default'), key, config.get('TIMEOUT', 60))
@@ -0,0 +1,99 @@
+import csv
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.db import models
+
+DEFAULT_EXPORT_CHUNK_SIZE = 10000
+
+
+def _get_field_names(queryset, field_names: Optional[Sequence[str]]) -> List[str]:
+    """The given field names, by default the attnames of all the concrete fields of the model"""
+    if field_names is not None:
+        return list(field_names)
+    return [field.attname for field in queryset.model._meta.concrete_fields]
+
+
+def _get_arrow_type(pyarrow, field):
+    """The Arrow type of the values of a field, so that every batch has the same schema even when a column
+    is all nulls. None lets pyarrow infer it."""
+    if isinstance(field, models.BooleanField):
+        return pyarrow.bool_()
+    if isinstance(field, (models.IntegerField, models.AutoField)):
+        return pyarrow.int64()
+    if isinstance(field, models.FloatField):
+        return pyarrow.float64()
+    if isinstance(field, models.DateTimeField):
+        return pyarrow.timestamp('us', tz='UTC' if settings.USE_TZ else None)
+    if isinstance(field, models.DateField):
+        return pyarrow.date32()
+    if isinstance(field, (models.CharField, models.TextField)):
+        return pyarrow.string()
+    return None
+
+
+def _iter_columns(queryset, names: List[str], chunk_size: int, max_workers: int):
+    for _, columns in queryset.iter_decrypted_chunks(names, chunk_size=chunk_size, max_workers=max_workers):
+        yield columns
+
+
+def export_csv(queryset, path_or_file, field_names: Optional[Sequence[str]] = None, *,
+               chunk_size: int = DEFAULT_EXPORT_CHUNK_SIZE, max_workers: int = 4, header: bool = True):
+    """Write the decrypted rows of the queryset to a CSV file, given as a path or a text file object.
+
+    Rows are written chunk by chunk as they are decrypted, without creating model instances."""
+    if isinstance(path_or_file, str):
+        with open(path_or_file, 'w', newline='') as file:
+            return export_csv(queryset, file, field_names, chunk_size=chunk_size, max_workers=max_workers,
+                              header=header)
+    names = _get_field_names(queryset, field_names)
+    writer = csv.writer(path_or_file)
+    if header:
+        writer.writerow(names)
+    rows = 0
+    for columns in _iter_columns(queryset, names, chunk_size, max_workers):
+        chunk = list(zip(*(columns[name] for name in names)))
+        writer.writerows(chunk)
+        rows += len(chunk)
+    return rows
+
+
+def iter_record_batches(queryset, field_names: Optional[Sequence[str]] = None, *,
+                        chunk_size: int = DEFAULT_EXPORT_CHUNK_SIZE, max_workers: int = 4):
+    """Yield the decrypted rows of the queryset as pyarrow RecordBatches of up to chunk_size rows.
+
+    Requires pyarrow."""
+    try:
+        import pyarrow  # type: ignore
+    except ImportError:
+        raise ImportError('Exporting to Arrow requires the pyarrow package')
+    names = _get_field_names(queryset, field_names)
+    types = [_get_arrow_type(pyarrow, queryset.model._meta.get_field(name)) for name in names]
+    for columns in _iter_columns(queryset, names, chunk_size, max_workers):
+        yield pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(columns[name], type=arrow_type) for name, arrow_type in zip(names, types)], names=names)
+
+
+def to_arrow(queryset, field_names: Optional[Sequence[str]] = None, *,
+             chunk_size: int = DEFAULT_EXPORT_CHUNK_SIZE, max_workers: int = 4):
+    """Return the decrypted rows of the queryset as a pyarrow Table. Requires pyarrow."""
+    batches = list(iter_record_batches(queryset, field_names, chunk_size=chunk_size, max_workers=max_workers))
+    import pyarrow  # type: ignore
+    if not batches:
+        return pyarrow.table({name: [] for name in _get_field_names(queryset, field_names)})
+    return pyarrow.Table.from_batches(batches)
+
+
+def to_dataframe(queryset, field_names: Optional[Sequence[str]] = None, *,
+                 chunk_size: int = DEFAULT_EXPORT_CHUNK_SIZE, max_workers: int = 4):
+    """Return the decrypted rows of the queryset as a pandas DataFrame. Requires pandas."""
+    try:
+        import pandas  # type: ignore
+    except ImportError:
+        raise ImportError('Exporting to a DataFrame requires the pandas package')
+    names = _get_field_names(queryset, field_names)
+    data: Dict[str, list] = {name: [] for name in names}
+    for columns in _iter_columns(queryset, names, chunk_size, max_workers):
+        for name in names:
+            data[name].extend(columns[name])
+    return pandas.DataFrame(data, columns=names)
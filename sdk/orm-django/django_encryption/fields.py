@@ -1,38 +1,184 @@
+import base64
+import binascii
+import contextvars
+import datetime
+import decimal
+import functools
+import heapq
 import itertools
+import json
+import pickle
+import struct
+import tempfile
+import threading
+import weakref
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Any, Optional
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
 
 import django.db
 import django.db.models
 from django.conf import settings
 from django.core import validators
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.db.models.options import Options
 from django.db.models.query_utils import DeferredAttribute
-from django.utils import timezone
+from django.utils import dateparse, timezone
 from django.utils.functional import cached_property
-
+from django.utils.module_loading import import_string
+
+from django_encryption import export
+from django_encryption.adaptive import AdaptiveController
+from django_encryption.aggregates import make_accumulator
+from django_encryption.cache import get_decrypt_cache
+from django_encryption.memo import get_decrypt_memo
+from django_encryption.traffic import TrafficRecorder
+from django_encryption.transports import Transport
 from django_encryption.vault_wrapper import (EncryptionType, Reason, Vault,
                                              VaultException)
+from django_encryption.write_behind import get_write_behind_queue
+
+_VALUES = '_vault_values'
+_FIELD_INDEXES = '_vault_field_indexes'
+_PENDING_CIPHERTEXTS = '_pending_ciphertexts'
+_DECRYPT_BATCH = '_vault_decrypt_batch'
+_DEFERRED_BATCH = '_vault_deferred_batch'
+_RAW_CIPHERTEXT = '_vault_raw_ciphertext'
+# marks plaintexts that were compressed before encryption, followed by '<algorithm>:<base64 payload>'
+_COMPRESSED_PREFIX = '\x1fcompressed:'
+_COMPRESSION_ALGORITHMS = ('zlib', 'zstd')
+
+DEFAULT_VAULT_ALIAS = 'default'
+# rows per chunk of the streaming queryset methods (decrypted_aggregate)
+DEFAULT_CHUNK_SIZE = 2000
+# sort entries per encrypted block of the runs spilled by decrypted_order_by
+_SPILL_BLOCK_SIZE = 256
+
+
+def get_vault(alias: str = DEFAULT_VAULT_ALIAS):
+    """Create a new Vault client for the given alias.
+
+    The default alias is configured by VAULT_ADDRESS, VAULT_API_KEY and VAULT_DEFAULT_COLLECTION,
+    any other alias by the matching entry in settings.VAULTS, e.g.
+    VAULTS = {'eu': {'ADDRESS': ..., 'API_KEY': ..., 'DEFAULT_COLLECTION': ...}}
+
+    ADDRESS may be a list of the urls of several vault nodes to balance requests across."""
+    vaults = getattr(settings, 'VAULTS', None) or {}
+    coalesce_linger = getattr(settings, 'VAULT_COALESCE_LINGER_SECS', None)
+    transport_config = getattr(settings, 'VAULT_TRANSPORT', None)
+    compress_min_bytes = getattr(settings, 'VAULT_COMPRESS_MIN_BYTES', None)
+    adaptive_config = getattr(settings, 'VAULT_ADAPTIVE', None)
+    hedge_percentile = getattr(settings, 'VAULT_HEDGE_PERCENTILE', None)
+    traffic_recording = getattr(settings, 'VAULT_TRAFFIC_RECORDING', None)
+    if alias in vaults:
+        config = vaults[alias]
+        vault_address = config.get('ADDRESS')
+        vault_api_key = config.get('API_KEY')
+        default_collection = config.get('DEFAULT_COLLECTION', getattr(settings, "VAULT_DEFAULT_COLLECTION", None))
+        coalesce_linger = config.get('COALESCE_LINGER_SECS', coalesce_linger)
+        transport_config = config.get('TRANSPORT', transport_config)
+        compress_min_bytes = config.get('COMPRESS_MIN_BYTES', compress_min_bytes)
+        adaptive_config = config.get('ADAPTIVE', adaptive_config)
+        hedge_percentile = config.get('HEDGE_PERCENTILE', hedge_percentile)
+        traffic_recording = config.get('TRAFFIC_RECORDING', traffic_recording)
+        if not vault_address:
+            raise ImproperlyConfigured(f'VAULTS[{alias!r}] must define ADDRESS')
+        if not vault_api_key:
+            raise ImproperlyConfigured(f'VAULTS[{alias!r}] must define API_KEY')
+    elif alias == DEFAULT_VAULT_ALIAS:
+        vault_address = getattr(settings, 'VAULT_ADDRESS', None)
+        vault_api_key = getattr(settings, 'VAULT_API_KEY', None)
+        default_collection = getattr(settings, "VAULT_DEFAULT_COLLECTION", None)
+
+        if not vault_address:
+            raise ImproperlyConfigured('VAULT_ADDRESS must be defined in settings')
+        if not vault_api_key:
+            raise ImproperlyConfigured('VAULT_API_KEY must be defined in settings')
+    else:
+        raise ImproperlyConfigured(f'Vault {alias!r} must be defined in settings.VAULTS')
+    if traffic_recording is not None and not isinstance(traffic_recording, str):
+        raise ImproperlyConfigured(f'The traffic recording of vault {alias!r} must be a file path, '
+                                   f'got {traffic_recording!r}')
+
+    return Vault(vault_address, vault_api_key, default_collection, name=alias, coalesce_linger=coalesce_linger,
+                 transport=_make_transport(transport_config), compress_min_bytes=compress_min_bytes,
+                 adaptive=_make_adaptive_controller(adaptive_config), hedge_percentile=hedge_percentile,
+                 recorder=TrafficRecorder(traffic_recording) if traffic_recording else None)
+
+
+def _make_transport(config: Optional[Dict[str, Any]]) -> Optional[Transport]:
+    """Create the transport configured as {'BACKEND': <dotted path>, 'OPTIONS': {...}}, None for the default"""
+    if not config:
+        return None
+    if 'BACKEND' not in config:
+        raise ImproperlyConfigured('VAULT_TRANSPORT must define BACKEND')
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+def _make_adaptive_controller(config: Optional[Dict[str, Any]]) -> Optional[AdaptiveController]:
+    """Create the adaptive controller configured as e.g. {'MAX_CONCURRENCY': 32, 'TARGET_LATENCY': 0.5}, with
+    the (upper case) parameters of AdaptiveController. Returns None, disabling it, when not configured."""
+    if config is None:
+        return None
+    return AdaptiveController(**{key.lower(): value for key, value in config.items()})
 
-_DECRYPTED_PREFIX = 'decrypted_'
-_ENCRYPTED_PREFIX = 'encrypted_'
 
+_VAULT = get_vault()
 
-def get_vault():
-    vault_address = getattr(settings, 'VAULT_ADDRESS', None)
-    vault_api_key = getattr(settings, 'VAULT_API_KEY', None)
-    default_collection = getattr(settings, "VAULT_DEFAULT_COLLECTION", None)
+# Vault clients for non-default aliases, each one keeps its own sessions and stats
+_VAULT_CLIENTS: Dict[str, Vault] = {}
+_VAULT_CLIENTS_LOCK = threading.Lock()
 
-    if not vault_address:
-        raise ImproperlyConfigured('VAULT_ADDRESS must be defined in settings')
-    if not vault_api_key:
-        raise ImproperlyConfigured('VAULT_API_KEY must be defined in settings')
+_vault_alias: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('vault_alias', default=None)
+# prepended to the vault collection of every field, set by django_encryption.testing to isolate test runs
+_collection_prefix = ''
+_raw_ciphertext: contextvars.ContextVar[bool] = contextvars.ContextVar('vault_raw_ciphertext', default=False)
+# set by raw_ciphertext(deserialize=True), while the strings deserialized by to_python() are ciphertexts
+_deserialize_ciphertexts: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    'vault_deserialize_ciphertexts', default=False)
 
-    return Vault(vault_address, vault_api_key, default_collection)
 
+def get_vault_client(alias: str = DEFAULT_VAULT_ALIAS) -> Vault:
+    """Return the shared Vault client for the given alias, creating it on first use"""
+    if alias == DEFAULT_VAULT_ALIAS:
+        return _VAULT
+    client = _VAULT_CLIENTS.get(alias)
+    if client is None:
+        with _VAULT_CLIENTS_LOCK:
+            client = _VAULT_CLIENTS.get(alias)
+            if client is None:
+                client = get_vault(alias)
+                _VAULT_CLIENTS[alias] = client
+    return client
 
-_VAULT = get_vault()
+
+def get_vault_aliases() -> List[str]:
+    """The aliases of every configured Vault target, the default one first"""
+    return [DEFAULT_VAULT_ALIAS] + [alias for alias in getattr(settings, 'VAULTS', None) or {}
+                                    if alias != DEFAULT_VAULT_ALIAS]
+
+
+def warmup_vaults(connections: int = 1):
+    """Warm up the client of every configured Vault target, see Vault.warmup()"""
+    for alias in get_vault_aliases():
+        get_vault_client(alias).warmup(connections)
+
+
+@functools.lru_cache(maxsize=None)
+def _import_vault_router(path: str):
+    return import_string(path)
+
+
+def get_vault_router():
+    """Return the callable configured by settings.VAULT_ROUTER, if any.
+
+    The router is called as router(field, instance=None) and returns a Vault alias, or None for the default.
+    instance is only given when decrypting values loaded from the DB."""
+    router = getattr(settings, 'VAULT_ROUTER', None)
+    if isinstance(router, str):
+        router = _import_vault_router(router)
+    return router
 
 
 class _RaiseError:
@@ -42,6 +188,180 @@ class _RaiseError:
 raise_error = _RaiseError()
 
 
+def _compress(algorithm: str, data: bytes) -> bytes:
+    if algorithm == 'zstd':
+        try:
+            import zstandard  # type: ignore
+        except ImportError:
+            raise ImproperlyConfigured("compress='zstd' requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data)
+
+
+def _decompress(algorithm: str, data: bytes) -> bytes:
+    """Raises ValueError if data is not a valid payload of algorithm"""
+    if algorithm == 'zstd':
+        try:
+            import zstandard  # type: ignore
+        except ImportError:
+            raise ImproperlyConfigured("decompressing zstd values requires the zstandard package")
+        try:
+            return zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+    if algorithm != 'zlib':
+        raise ValueError(f'unknown compression algorithm {algorithm!r}')
+    try:
+        return zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError(str(e))
+
+
+class Ciphertext(str):
+    """A value that was already encrypted, and is written to the DB as is. Assign it to an encrypted field to
+    copy a ciphertext without decrypting it"""
+
+
+def _is_raw_ciphertext(value) -> bool:
+    """Whether value converted by to_python() is a ciphertext to pass through, explicitly or as a string
+    deserialized inside raw_ciphertext(deserialize=True)"""
+    return isinstance(value, Ciphertext) or (isinstance(value, str) and _deserialize_ciphertexts.get())
+
+
+def _is_raw_instance(instance) -> bool:
+    return _raw_ciphertext.get() or bool(instance.__dict__.get(_RAW_CIPHERTEXT))
+
+
+class _NotSet:
+    """Marks a value that was not loaded or decrypted, as opposed to a value that is None"""
+
+    def __repr__(self):
+        return '<not set>'
+
+    def __reduce__(self):
+        return '_NOT_SET'
+
+
+_NOT_SET = _NotSet()
+
+
+class _EncryptedValues:
+    """The ciphertexts and plaintexts of the encrypted fields of one model instance, held in two lists
+    indexed by the position of each field among the encrypted fields of the model (see _locate_value)"""
+
+    __slots__ = ('ciphertexts', 'plaintexts', 'discard_ciphertexts')
+
+    def __init__(self, size: int):
+        self.ciphertexts: List[Any] = [_NOT_SET] * size
+        self.plaintexts: List[Any] = [_NOT_SET] * size
+        # set for read-only querysets, ciphertexts are then dropped once they are decrypted
+        self.discard_ciphertexts = False
+
+    def set_plaintext(self, index: int, plaintext):
+        self.plaintexts[index] = plaintext
+        if self.discard_ciphertexts:
+            self.ciphertexts[index] = _NOT_SET
+
+    def is_loaded(self, index: int) -> bool:
+        return self.ciphertexts[index] is not _NOT_SET or self.plaintexts[index] is not _NOT_SET
+
+    def without_decrypted_plaintexts(self) -> '_EncryptedValues':
+        """Return a copy without the plaintexts of values that have a ciphertext"""
+        values = _EncryptedValues(0)
+        values.ciphertexts = list(self.ciphertexts)
+        values.plaintexts = [_NOT_SET if ciphertext is not _NOT_SET and ciphertext is not None else plaintext
+                             for ciphertext, plaintext in zip(self.ciphertexts, self.plaintexts)]
+        values.discard_ciphertexts = self.discard_ciphertexts
+        return values
+
+
+class _Decrypted:
+    """A value decrypted by prefetch_related, which sets it on the instance through the field's descriptor"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _locate_value(instance, field) -> Tuple[_EncryptedValues, int]:
+    """Return the encrypted values of the instance, and the index of the given field in them"""
+    model = type(instance)
+    indexes = model.__dict__.get(_FIELD_INDEXES)
+    if indexes is None:
+        encrypted_fields = [f for f in model._meta.concrete_fields if isinstance(f, EncryptedMixin)]
+        indexes = {f.attname: index for index, f in enumerate(encrypted_fields)}  # type: ignore[attr-defined]
+        setattr(model, _FIELD_INDEXES, indexes)
+    values = instance.__dict__.get(_VALUES)
+    if values is None:
+        values = instance.__dict__[_VALUES] = _EncryptedValues(len(indexes))
+    return values, indexes[field.attname]
+
+
+@functools.total_ordering
+class _Descending:
+    """Reverses the ordering of a sort key"""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __getstate__(self):
+        return self.key
+
+    def __setstate__(self, key):
+        self.key = key
+
+
+def _sort_key(value, descending: bool):
+    # nulls sort last in ascending order and first in descending order, like in PostgreSQL
+    key = (value is None, value)
+    return _Descending(key) if descending else key
+
+
+def _make_spill_cipher():
+    """A Fernet with a new random key, to encrypt the runs of one external sort"""
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        raise ImproperlyConfigured('decrypted_order_by() of more than chunk_size rows without a limit requires '
+                                   'the cryptography package, to encrypt the sorted runs it writes to disk')
+    return Fernet(Fernet.generate_key())
+
+
+def _spill(entries, fernet) -> Any:
+    """Write sorted entries to a temporary file, to be read back by _read_spilled. The entries hold decrypted
+    values, so they are written in blocks encrypted with fernet, whose key is never written anywhere."""
+    file = tempfile.TemporaryFile()
+    entries = iter(entries)
+    while True:
+        block = list(itertools.islice(entries, _SPILL_BLOCK_SIZE))
+        if not block:
+            break
+        token = fernet.encrypt(pickle.dumps(block))
+        file.write(struct.pack('>I', len(token)))
+        file.write(token)
+    file.seek(0)
+    return file
+
+
+def _read_spilled(file, fernet):
+    with file:
+        while True:
+            header = file.read(4)
+            if not header:
+                return
+            token = file.read(struct.unpack('>I', header)[0])
+            yield from pickle.loads(fernet.decrypt(token))
+
+
 class WithVaultOptions(Options):
     vault_collection: Optional[str] = None
 
@@ -49,15 +369,27 @@ class WithVaultOptions(Options):
 # to get_prefetch_queryset
 
 
-def make_iterable_wrapper(transform_fields=None):
+def make_iterable_wrapper(transform_fields=None, discard_ciphertexts=False, property_selections=None,
+                          raw_ciphertext=False):
     class ModelIterableWrapper(django.db.models.query.ModelIterable):
 
         def __iter__(self):
             for obj in super().__iter__():
                 if self.transform_fields:
                     obj._transform_fields = self.transform_fields
+                if self.property_selections:
+                    obj._property_selections = self.property_selections
+                if self.raw_ciphertext:
+                    obj.__dict__[_RAW_CIPHERTEXT] = True
+                if self.discard_ciphertexts:
+                    values = obj.__dict__.get(_VALUES)
+                    if values is not None:
+                        values.discard_ciphertexts = True
                 yield obj
     ModelIterableWrapper.transform_fields = transform_fields
+    ModelIterableWrapper.discard_ciphertexts = discard_ciphertexts
+    ModelIterableWrapper.property_selections = property_selections
+    ModelIterableWrapper.raw_ciphertext = raw_ciphertext
     return ModelIterableWrapper
 
 
@@ -69,6 +401,22 @@ class EncryptionBatchQuerySet(django.db.models.query.QuerySet):
     def __init__(self, model=None, query=None, using=None, hints=None):
         super().__init__(model, query, using, hints)
         self._transform_fields = {}
+        self._discard_ciphertexts = False
+        self._property_selections = {}
+        self._raw_ciphertext = False
+        self._related_decrypted = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._transform_fields = dict(self._transform_fields)
+        clone._discard_ciphertexts = self._discard_ciphertexts
+        clone._property_selections = dict(self._property_selections)
+        clone._raw_ciphertext = self._raw_ciphertext
+        return clone
+
+    def _set_iterable_class(self):
+        self._iterable_class = make_iterable_wrapper(
+            self._transform_fields, self._discard_ciphertexts, self._property_selections, self._raw_ciphertext)
 
     def transform(self, transformation_name, *fields):
         clone = self._clone()
@@ -79,13 +427,404 @@ class EncryptionBatchQuerySet(django.db.models.query.QuerySet):
                 field_name = field.field.name
             else:  # EncryptedMixin
                 field_name = field.name
+            model_field = self.model._meta.get_field(field_name)
+            if getattr(model_field, 'compress', None) is not None:
+                raise ValueError(f'{field_name} is compressed and cannot be transformed by vault')
             clone._transform_fields[field_name] = transformation_name
-        clone._iterable_class = make_iterable_wrapper(clone._transform_fields)
+        clone._set_iterable_class()
+        return clone
+
+    def discard_ciphertexts(self):
+        """Drop the ciphertexts of the loaded instances once their values are decrypted, to save memory on
+        large read-only querysets. Instances loaded this way keep plaintexts only, so they cannot be pickled."""
+        clone = self._clone()
+        clone._discard_ciphertexts = True
+        clone._set_iterable_class()
+        return clone
+
+    def select_properties(self, field, *properties):
+        """Decrypt only the given properties of an EncryptedCompositeField. The other properties of the loaded
+        instances read as None, and the field cannot be saved."""
+        field_name = field if isinstance(field, str) else field.name
+        model_field = self.model._meta.get_field(field_name)
+        if not isinstance(model_field, EncryptedCompositeField):
+            raise ValueError(f'{field_name} is not an EncryptedCompositeField')
+        unknown = set(properties) - set(model_field.properties)
+        if unknown:
+            raise ValueError(f'{field_name} has no properties {sorted(unknown)}')
+        clone = self._clone()
+        clone._property_selections[field_name] = tuple(properties)
+        clone._set_iterable_class()
+        return clone
+
+    def raw_ciphertext(self):
+        """Load instances whose encrypted fields hold their ciphertexts (as Ciphertext) instead of decrypted
+        values, without calling vault. Saving such instances, e.g. to another table or database, writes the
+        ciphertexts as they are."""
+        clone = self._clone()
+        clone._raw_ciphertext = True
+        clone._set_iterable_class()
         return clone
 
     def mask(self, *fields):
         return self.transform(EncryptionBatchQuerySet.MASK_TRANSFORMATION_NAME, *fields)
 
+    def iter_decrypted_chunks(self, field_names, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=1):
+        """Yield the rows of the queryset in chunks of up to chunk_size rows, ordered by primary key, as
+        (pks, columns) where columns maps each of the given field names to the list of its values.
+
+        Only the given fields are loaded, and the values of encrypted fields are decrypted with a single bulk
+        call per field and chunk. With max_workers > 1, the encrypted columns of a chunk are decrypted
+        concurrently. Sliced querysets are not supported, since the chunks are selected by primary key."""
+        if self.query.is_sliced:
+            raise ValueError('iter_decrypted_chunks() cannot be used on a sliced queryset')
+        fields = [self.model._meta.get_field(name) for name in field_names]
+        # the expiry companion fields are loaded too, so expired values are resolved locally as for instances
+        expiry_names = list(dict.fromkeys(field.expires_at_field for field in fields
+                                          if isinstance(field, EncryptedMixin) and field.expires_at_field))
+        queryset = self.prefetch_related(None).order_by('pk')
+        executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+
+        def decrypt(field, raw_values, expiry_columns):
+            return field.decrypt_column(raw_values, transformation=self._transform_fields.get(field.name),
+                                        expires_at=expiry_columns.get(field.expires_at_field))
+
+        try:
+            last_pk = None
+            while True:
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                rows = list(chunk.values_list('pk', *field_names, *expiry_names)[:chunk_size])
+                if not rows:
+                    return
+                pks, *raw_columns = (list(column) for column in zip(*rows))
+                expiry_columns = dict(zip(expiry_names, raw_columns[len(field_names):]))
+                columns: Dict[str, Any] = {}
+                for name, field, raw_values in zip(field_names, fields, raw_columns):
+                    if not isinstance(field, EncryptedMixin):
+                        columns[name] = raw_values
+                    elif executor is not None:
+                        # the reason and vault alias of the calling context apply to the workers too, the
+                        # transport opens a session of its own in each worker thread
+                        columns[name] = executor.submit(
+                            contextvars.copy_context().run, decrypt, field, raw_values, expiry_columns)
+                    else:
+                        columns[name] = decrypt(field, raw_values, expiry_columns)
+                yield pks, {name: column.result() if isinstance(column, Future) else column
+                            for name, column in columns.items()}
+                last_pk = pks[-1]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def decrypted_aggregate(self, *, group_by=(), chunk_size=DEFAULT_CHUNK_SIZE, **aggregates):
+        """Like aggregate(), but computed on decrypted values, e.g. decrypted_aggregate(total=Sum('enc_int')).
+
+        Supports Sum, Avg, Min, Max and Count of a field name, and django_encryption.aggregates.Histogram.
+        The rows are streamed with iter_decrypted_chunks(), and each chunk is folded into running aggregates,
+        so memory use does not grow with the size of the queryset. With group_by (a list of field names),
+        returns a dict mapping each tuple of group values to the aggregates of its rows."""
+        # this also fails early on unsupported aggregates
+        aggregate_field_names = [make_accumulator(aggregate).field_name for aggregate in aggregates.values()]
+        field_names = [name for name in dict.fromkeys(itertools.chain(group_by, aggregate_field_names))
+                       if name is not None]
+        groups: Dict[tuple, dict] = {}
+        for pks, columns in self.iter_decrypted_chunks(field_names, chunk_size):
+            if group_by:
+                keys = list(zip(*(columns[name] for name in group_by)))
+                rows_by_key: Dict[tuple, list] = {}
+                for row, key in enumerate(keys):
+                    rows_by_key.setdefault(key, []).append(row)
+                chunk_groups = [(key, rows) for key, rows in rows_by_key.items()]
+            else:
+                chunk_groups = [((), None)]
+            for key, rows in chunk_groups:
+                accumulators = groups.get(key)
+                if accumulators is None:
+                    accumulators = groups[key] = {
+                        name: make_accumulator(aggregate) for name, aggregate in aggregates.items()}
+                for accumulator in accumulators.values():
+                    values = pks if accumulator.field_name is None else columns[accumulator.field_name]
+                    accumulator.add(values if rows is None else [values[row] for row in rows])
+        if not group_by:
+            accumulators = groups.get(()) or {
+                name: make_accumulator(aggregate) for name, aggregate in aggregates.items()}
+            return {name: accumulator.result() for name, accumulator in accumulators.items()}
+        return {key: {name: accumulator.result() for name, accumulator in accumulators.items()}
+                for key, accumulators in groups.items()}
+
+    def export_csv(self, path_or_file, field_names=None, **kwargs):
+        """See django_encryption.export.export_csv, returns the number of rows written"""
+        return export.export_csv(self, path_or_file, field_names, **kwargs)
+
+    def iter_record_batches(self, field_names=None, **kwargs):
+        """See django_encryption.export.iter_record_batches"""
+        return export.iter_record_batches(self, field_names, **kwargs)
+
+    def to_arrow(self, field_names=None, **kwargs):
+        """See django_encryption.export.to_arrow"""
+        return export.to_arrow(self, field_names, **kwargs)
+
+    def to_dataframe(self, field_names=None, **kwargs):
+        """See django_encryption.export.to_dataframe"""
+        return export.to_dataframe(self, field_names, **kwargs)
+
+    def decrypted_order_by(self, *field_names, limit=None, offset=0, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Order the queryset by decrypted values, e.g. decrypted_order_by('-enc_date_field', limit=20).
+
+        Field names may be prefixed by '-' for descending order, and ties are broken by primary key. The
+        sort keys are streamed with iter_decrypted_chunks() and only the instances of the requested rows are
+        loaded. With a limit, returns the list of instances of rows [offset, offset + limit), selected with a
+        bounded heap. Without one, returns an iterator over all the rows in order. Up to chunk_size rows are
+        sorted in memory, more by an external merge sort whose runs of chunk_size keys are spilled to
+        temporary files, encrypted with a key that is only kept in memory (this requires cryptography)."""
+        if not field_names:
+            raise ValueError('decrypted_order_by requires at least one field name')
+        order = [(name[1:], True) if name.startswith('-') else (name, False) for name in field_names]
+        names = list(dict.fromkeys(name for name, _ in order))
+
+        def chunk_entries(pks, columns):
+            keys = zip(*([_sort_key(value, descending) for value in columns[name]] for name, descending in order))
+            return [(key, pk) for key, pk in zip(keys, pks)]
+
+        chunks = self.iter_decrypted_chunks(names, chunk_size)
+        if limit is not None:
+            best: list = []
+            for pks, columns in chunks:
+                best = heapq.nsmallest(offset + limit, itertools.chain(best, chunk_entries(pks, columns)))
+            return self._in_order([pk for _, pk in best[offset:]])
+        first, second = next(chunks, None), next(chunks, None)
+        if second is None:
+            entries: Any = sorted(chunk_entries(*first)) if first is not None else []
+        else:
+            fernet = _make_spill_cipher()
+            runs = [_spill(sorted(chunk_entries(pks, columns)), fernet)
+                    for pks, columns in itertools.chain([first, second], chunks)]
+            entries = heapq.merge(*(_read_spilled(run, fernet) for run in runs))
+        return self._iter_in_order((pk for _, pk in entries), offset, chunk_size)
+
+    def _in_order(self, pks):
+        """Load the instances with the given primary keys, in the same order"""
+        instances = self.order_by().in_bulk(pks)
+        return [instances[pk] for pk in pks if pk in instances]
+
+    def _iter_in_order(self, pks, offset, chunk_size):
+        pks = itertools.islice(pks, offset, None)
+        while True:
+            chunk = list(itertools.islice(pks, chunk_size))
+            if not chunk:
+                return
+            yield from self._in_order(chunk)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        set_expires_at(objs)
+        encrypt_instances(objs, using=self.db)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def _get_deferred_encrypted_fields(self):
+        """The encrypted fields of the model that are left out of the query by only() or defer()"""
+        field_names, defer = self.query.deferred_loading
+        deferred = []
+        for field in self.model._meta.concrete_fields:
+            if not isinstance(field, EncryptedMixin):
+                continue
+            selected = field.name in field_names or field.attname in field_names
+            if selected == defer:
+                deferred.append(field)
+        return deferred
+
+    def _prefetch_related_objects(self):
+        # deferred fields are not decrypted eagerly, they are loaded when first accessed. No field is
+        # decrypted for raw_ciphertext()
+        if self._raw_ciphertext:
+            skipped = {field.name for field in self.model._meta.concrete_fields if isinstance(field, EncryptedMixin)}
+        else:
+            skipped = {field.name for field in self._get_deferred_encrypted_fields()}
+        if skipped:
+            self._prefetch_related_lookups = tuple(
+                lookup for lookup in self._prefetch_related_lookups if lookup not in skipped)
+        super()._prefetch_related_objects()
+
+    def _fetch_all(self):
+        super()._fetch_all()
+        if not self._related_decrypted and not self._raw_ciphertext:
+            self._related_decrypted = True
+            # the eager fields of the queryset's own model are decrypted by prefetch_related, this decrypts
+            # the ones of instances loaded by select_related and prefetch_related
+            decrypt_instances(_collect_related_instances(self._result_cache))
+            if self._get_deferred_encrypted_fields():
+                instances = [obj for obj in self._result_cache if isinstance(obj, self.model)]
+                batch = _DeferredBatch(instances)
+                for instance in instances:
+                    instance.__dict__[_DEFERRED_BATCH] = batch
+
+
+def _collect_related_instances(instances):
+    """Return the given instances along with all the model instances cached on them by select_related
+    and prefetch_related, recursively"""
+    result = []
+    seen = set()
+    stack = [instance for instance in instances if isinstance(instance, django.db.models.Model)]
+    while stack:
+        instance = stack.pop()
+        if id(instance) in seen:
+            continue
+        seen.add(id(instance))
+        result.append(instance)
+        for related in instance._state.fields_cache.values():
+            if isinstance(related, django.db.models.Model):
+                stack.append(related)
+        for related_qs in getattr(instance, '_prefetched_objects_cache', {}).values():
+            stack.extend(related for related in related_qs._result_cache or ()
+                         if isinstance(related, django.db.models.Model))
+    return result
+
+
+def decrypt_instances(instances, fields=None):
+    """Decrypt the eager encrypted fields (or the given fields) of the given model instances that were not
+    decrypted yet.
+
+    Instances may be of different models, values are grouped so that a single bulk decrypt is sent per
+    field and transformation (and vault target). Nothing is decrypted for raw ciphertext instances."""
+    groups: Dict[tuple, list] = {}
+    for instance in instances:
+        if _is_raw_instance(instance):
+            continue
+        transform_fields = getattr(instance, '_transform_fields', None) or {}
+        for field in instance._meta.concrete_fields:
+            if not isinstance(field, EncryptedMixin):
+                continue
+            if not (field.eager if fields is None else field in fields):
+                continue
+            values, index = _locate_value(instance, field)
+            if values.plaintexts[index] is not _NOT_SET or values.ciphertexts[index] is _NOT_SET:
+                continue
+            groups.setdefault((field, transform_fields.get(field.name)), []).append((instance, values, index))
+    for (field, transformation), group in groups.items():
+        decrypted_values = field.get_decrypted_values(
+            [values.ciphertexts[index] for _, values, index in group],
+            transformation=transformation, instances=[instance for instance, _, _ in group])
+        for (_, values, index), decrypted_value in zip(group, decrypted_values):
+            values.set_plaintext(index, decrypted_value)
+
+
+def _has_expired(expires_at) -> bool:
+    return expires_at is not None and expires_at <= timezone.now()
+
+
+def set_expires_at(instances, fields=None):
+    """Set the expiry companion field (expires_at_field) of encrypted fields with expiration_secs, ahead of
+    writing the given instances to the DB. The time is taken before encryption, so it is never later than
+    the expiry in vault."""
+    now = timezone.now()
+    for instance in instances:
+        for field in instance._meta.concrete_fields:
+            if not isinstance(field, EncryptedMixin) or field.expires_at_field is None:
+                continue
+            if fields is not None and field.name not in fields:
+                continue
+            value = field.value_from_object(instance)
+            if isinstance(value, Ciphertext):
+                # a copied ciphertext keeps the expiry it was encrypted with
+                continue
+            expires_at = None
+            if field.expiration_secs and value is not None:
+                expires_at = now + datetime.timedelta(seconds=field.expiration_secs)
+            setattr(instance, field.expires_at_field, expires_at)
+
+
+def encrypt_instances(instances, using=None, fields=None):
+    """Encrypt the values of the write-behind fields of the given instances ahead of writing them to the DB.
+
+    All values are submitted to the write-behind queue before waiting for any of them, so they are
+    coalesced into bulk encrypt requests together with values saved concurrently by other threads. Returns
+    once all of them are encrypted, nothing is deferred past the save."""
+    pending = []
+    for instance in instances:
+        for field in instance._meta.concrete_fields:
+            if not isinstance(field, EncryptedMixin) or not field.write_behind:
+                continue
+            if fields is not None and field.name not in fields:
+                continue
+            value = field.value_from_object(instance)
+            if value is None or isinstance(value, Ciphertext):
+                continue
+            connection = django.db.connections[using or django.db.router.db_for_write(
+                type(instance), instance=instance)]
+            plaintext = field.get_db_prep_plaintext(value, connection)
+            if plaintext is None:
+                continue
+            vault = field.resolve_vault(instance)
+            write_queue = get_write_behind_queue()
+            future = write_queue.submit(
+                vault,
+                plaintext,
+                field.vault_property,
+                reason=vault.get_reason(),
+                collection=field.get_vault_collection(vault),
+                encryption_type=field.encryption_type,
+                expiration_secs=field.expiration_secs)
+            pending.append((instance, field, value, future))
+    for instance, field, value, future in pending:
+        instance.__dict__.setdefault(_PENDING_CIPHERTEXTS, {})[field.name] = (value, write_queue.result(future))
+
+
+class _DecryptBatch:
+    """Groups the instances unpickled from the same pickle, so that the first encrypted value accessed on
+    any of them is decrypted for all of them with one bulk call"""
+
+    def __init__(self):
+        self._instances: list = []
+
+    def add(self, instance):
+        self._instances.append(weakref.ref(instance))
+
+    def decrypt(self, field):
+        instances = [instance for instance in (ref() for ref in self._instances) if instance is not None]
+        # the eager fields are decrypted along with the accessed one, as they would be by the queryset
+        decrypt_instances(instances)
+        if not field.eager:
+            decrypt_instances(instances, fields=[field])
+
+
+class _DeferredBatch:
+    """Groups the instances loaded by the same queryset, so that the first access to an encrypted field
+    deferred by only() or defer() on any of them loads it for all of them with one query, and decrypts it
+    with one bulk call"""
+
+    def __init__(self, instances):
+        self._instances = [weakref.ref(instance) for instance in instances]
+
+    def load(self, field):
+        instances = []
+        for instance in (ref() for ref in self._instances):
+            if instance is None:
+                continue
+            values, index = _locate_value(instance, field)
+            if values.ciphertexts[index] is _NOT_SET and values.plaintexts[index] is _NOT_SET:
+                instances.append(instance)
+        for offset in range(0, len(instances), DEFAULT_CHUNK_SIZE):
+            chunk = instances[offset:offset + DEFAULT_CHUNK_SIZE]
+            manager = type(chunk[0])._base_manager.db_manager(chunk[0]._state.db)
+            # values are converted by from_db_value, like when loading instances
+            db_values = dict(manager.filter(pk__in=[instance.pk for instance in chunk]).values_list(
+                'pk', field.attname))
+            for instance in chunk:
+                if instance.pk in db_values:
+                    setattr(instance, field.attname, db_values[instance.pk])
+        decrypt_instances(instances, fields=[field])
+
+
+class _DecryptBatchMarker:
+    """Stored in the pickled state of model instances. All the states in a pickle reference the same marker,
+    so pickle unpickles it once, as a single _DecryptBatch shared by all the instances"""
+
+    def __reduce__(self):
+        return _DecryptBatch, ()
+
+
+_DECRYPT_BATCH_MARKER = _DecryptBatchMarker()
+
 
 class EncryptedBatchManager(django.db.models.Manager):
     def mask(self, *fields):
@@ -94,6 +833,33 @@ class EncryptedBatchManager(django.db.models.Manager):
     def transform(self, transformation_name, *fields):
         return self.get_queryset().transform(transformation_name, *fields)
 
+    def discard_ciphertexts(self):
+        return self.get_queryset().discard_ciphertexts()
+
+    def select_properties(self, field, *properties):
+        return self.get_queryset().select_properties(field, *properties)
+
+    def raw_ciphertext(self):
+        return self.get_queryset().raw_ciphertext()
+
+    def decrypted_aggregate(self, **kwargs):
+        return self.get_queryset().decrypted_aggregate(**kwargs)
+
+    def decrypted_order_by(self, *field_names, **kwargs):
+        return self.get_queryset().decrypted_order_by(*field_names, **kwargs)
+
+    def export_csv(self, path_or_file, field_names=None, **kwargs):
+        return self.get_queryset().export_csv(path_or_file, field_names, **kwargs)
+
+    def iter_record_batches(self, field_names=None, **kwargs):
+        return self.get_queryset().iter_record_batches(field_names, **kwargs)
+
+    def to_arrow(self, field_names=None, **kwargs):
+        return self.get_queryset().to_arrow(field_names, **kwargs)
+
+    def to_dataframe(self, field_names=None, **kwargs):
+        return self.get_queryset().to_dataframe(field_names, **kwargs)
+
     def get_queryset(self):
         qs = EncryptionBatchQuerySet(self.model, using=self._db)
         for field in self.model._meta.get_fields():
@@ -111,6 +877,53 @@ class EncryptingModel(django.db.models.Model):
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            # the expiry of an updated field is updated along with it
+            kwargs['update_fields'] = update_fields | {
+                field.expires_at_field for field in self._meta.concrete_fields
+                if isinstance(field, EncryptedMixin) and field.expires_at_field and field.name in update_fields}
+        set_expires_at([self], fields=update_fields)
+        encrypt_instances([self], using=kwargs.get('using'), fields=update_fields)
+        super().save(*args, **kwargs)
+
+    def __getstate__(self):
+        # only ciphertexts are pickled, so that cached instances hold no plaintext. Values that have no
+        # ciphertext yet (set since the instance was loaded) are kept as is
+        state = super().__getstate__()
+        state.pop(_PENDING_CIPHERTEXTS, None)
+        state.pop(_DECRYPT_BATCH, None)
+        state.pop(_DEFERRED_BATCH, None)
+        values = state.get(_VALUES)
+        if values is not None and values.discard_ciphertexts:
+            raise TypeError(f'{type(self).__name__} instances loaded with discard_ciphertexts() cannot be pickled, '
+                            f'as they would be pickled with their plaintexts')
+        if values is not None:
+            state[_VALUES] = values.without_decrypted_plaintexts()
+            if any(ciphertext is not _NOT_SET and ciphertext is not None for ciphertext in values.ciphertexts):
+                state[_DECRYPT_BATCH] = _DECRYPT_BATCH_MARKER
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        batch = self.__dict__.get(_DECRYPT_BATCH)
+        if batch is not None:
+            batch.add(self)
+
+    def get_deferred_fields(self):
+        # encrypted values are kept in _EncryptedValues rather than in __dict__ under their attname, without
+        # this they would all be considered deferred, and be left out of saves
+        deferred = super().get_deferred_fields()
+        encrypted_fields = [field for field in self._meta.concrete_fields
+                            if isinstance(field, EncryptedMixin) and field.attname in deferred]
+        for field in encrypted_fields:
+            values, index = _locate_value(self, field)
+            if values.is_loaded(index):
+                deferred.discard(field.attname)
+        return deferred
+
 
 # EncryptedMixinDescriptor is a descriptor wrapping access to fields inheriting from EncryptedMixin
 # it allows us to:
@@ -124,69 +937,110 @@ class EncryptedMixinDescriptor(DeferredAttribute):
     def __get__(self, instance, owner):
         if instance is None:
             return DeferredAttribute.__get__(self, instance, owner)
-        if hasattr(instance, _DECRYPTED_PREFIX + self.field.name):
-            decrypted_value = getattr(
-                instance, _DECRYPTED_PREFIX + self.field.name)
-            return decrypted_value
-        if hasattr(instance, _ENCRYPTED_PREFIX + self.field.name):
-            encrypted_value = getattr(
-                instance, _ENCRYPTED_PREFIX + self.field.name)
-            if encrypted_value is None:
-                setattr(instance, _DECRYPTED_PREFIX + self.field.name, None)
-                return None
-
-            transformation = None
-            if hasattr(instance, '_transform_fields'):
-                transformation = instance._transform_fields.get(
-                    self.field.name)
-            decrypted_value = self.field.get_decrypted_value(
-                encrypted_value, transformation=transformation)
-            setattr(
-                instance,
-                _DECRYPTED_PREFIX + self.field.name,
-                decrypted_value)
-            return decrypted_value
-        return DeferredAttribute.__get__(self, instance, owner)
+        values, index = _locate_value(instance, self.field)
+        raw = _is_raw_instance(instance)
+        plaintext = values.plaintexts[index]
+        if plaintext is not _NOT_SET and not (raw and isinstance(values.ciphertexts[index], str)):
+            return plaintext
+        ciphertext = values.ciphertexts[index]
+        if ciphertext is _NOT_SET:
+            # a deferred field is loaded on first access, along with the instances loaded by the same queryset
+            deferred_batch = instance.__dict__.get(_DEFERRED_BATCH)
+            if deferred_batch is not None:
+                deferred_batch.load(self.field)
+                values, index = _locate_value(instance, self.field)
+            if values.ciphertexts[index] is _NOT_SET and values.plaintexts[index] is _NOT_SET:
+                # or on its own, like DeferredAttribute does
+                token = _raw_ciphertext.set(raw)
+                try:
+                    instance.refresh_from_db(fields=[self.field.attname])
+                finally:
+                    _raw_ciphertext.reset(token)
+                values, index = _locate_value(instance, self.field)
+            if values.plaintexts[index] is not _NOT_SET:
+                return values.plaintexts[index]
+            ciphertext = values.ciphertexts[index]
+        if raw and isinstance(ciphertext, str):
+            return Ciphertext(ciphertext)
+        if ciphertext is None:
+            values.plaintexts[index] = None
+            return None
+
+        batch = instance.__dict__.get(_DECRYPT_BATCH)
+        if batch is not None:
+            batch.decrypt(self.field)
+            if values.plaintexts[index] is not _NOT_SET:
+                return values.plaintexts[index]
+
+        transformation = None
+        if hasattr(instance, '_transform_fields'):
+            transformation = instance._transform_fields.get(
+                self.field.name)
+        plaintext = self.field.get_decrypted_value(
+            ciphertext, transformation=transformation, instance=instance)
+        values.set_plaintext(index, plaintext)
+        return plaintext
 
     def __set__(self, instance, value):
         if instance is None:
             raise AttributeError("Can only be set on instances")
+        values, index = _locate_value(instance, self.field)
+        if isinstance(value, _Decrypted):
+            # a value decrypted by prefetch_related
+            if value.value is not _NOT_SET:
+                values.set_plaintext(index, value.value)
+            return
         if value is None:
-            setattr(instance, _DECRYPTED_PREFIX + self.field.name, None)
-            setattr(instance, _ENCRYPTED_PREFIX + self.field.name, None)
+            values.plaintexts[index] = None
+            values.ciphertexts[index] = None
+            return
+        if isinstance(value, Ciphertext):
+            # an encrypted value to pass through, e.g. from loaddata_ciphertexts
+            values.plaintexts[index] = Ciphertext(value)
+            values.ciphertexts[index] = str(value)
             return
         if isinstance(value, tuple):
             # we got an encrypted value
-            value = value[1]
-            setattr(instance, _ENCRYPTED_PREFIX + self.field.name, value)
+            values.ciphertexts[index] = value[1]
             return
-        # we got a decrypted value
-        setattr(instance, _DECRYPTED_PREFIX + self.field.name, value)
+        # we got a decrypted value, the ciphertext loaded before (if any) no longer matches it
+        values.plaintexts[index] = value
+        values.ciphertexts[index] = _NOT_SET
 
     # get_prefetch_queryset is called by django when prefetching related objects
     # this function allows django's queries to believe that the encrypted fields
     # are like foreign keys and so can be prefetched
     def get_prefetch_queryset(self, instances, queryset=None):
-        encrypted_attr_name = _ENCRYPTED_PREFIX + self.field.name
-        encrypted_values = [getattr(instance, encrypted_attr_name)
-                            for instance in instances]
+        located = [_locate_value(instance, self.field) for instance in instances]
+        # deferred values are not decrypted, they are loaded when accessed, and raw ciphertexts are not decrypted
+        loaded = [(instance, values.ciphertexts[index]) for instance, (values, index) in zip(instances, located)
+                  if values.ciphertexts[index] is not _NOT_SET and not _is_raw_instance(instance)]
         transformation = None
         # we could actually have a separate transformation for each instance, but we are assuming
         # that it's the same transformation for all of them
         if hasattr(instances[0], '_transform_fields') and self.field.name in instances[0]._transform_fields:
             transformation = instances[0]._transform_fields.get(
                 self.field.name)
-        rel_qs = self.field.get_decrypted_values(
-            encrypted_values, transformation=transformation)
+        decrypted_values = iter(self.field.get_decrypted_values(
+            [ciphertext for _, ciphertext in loaded], transformation=transformation,
+            instances=[instance for instance, _ in loaded]))
+        loaded_ids = {id(instance) for instance, _ in loaded}
+        rel_qs = [_Decrypted(next(decrypted_values) if id(instance) in loaded_ids else _NOT_SET)
+                  for instance in instances]
+
+        # django matches the returned values to the instances by key. The decrypted values are in the
+        # same order as the instances, so each value is keyed by the identity of its instance.
+        instance_keys = iter([id(instance) for instance in instances])
 
         def rel_obj_attr(obj):
-            return _DECRYPTED_PREFIX + self.field.name
+            return next(instance_keys)
 
         def instance_attr(obj):
-            return _DECRYPTED_PREFIX + self.field.name
+            return id(obj)
 
         single = True
-        cache_name = _DECRYPTED_PREFIX + self.field.name
+        # django sets each value through this descriptor
+        cache_name = self.field.attname
         is_descriptor = True
         return (
             rel_qs,
@@ -197,9 +1051,8 @@ class EncryptedMixinDescriptor(DeferredAttribute):
             is_descriptor)
 
     def is_cached(self, obj):
-        result = hasattr(obj, _DECRYPTED_PREFIX + self.field.name) and getattr(obj,
-                                                                               _DECRYPTED_PREFIX + self.field.name) is not None
-        return result
+        values, index = _locate_value(obj, self.field)
+        return values.plaintexts[index] is not _NOT_SET
 
 
 class EncryptedMixin(object):
@@ -215,9 +1068,29 @@ class EncryptedMixin(object):
             data_type_name: Optional[str] = None,
             on_error: Any = None,
             eager: bool = True,
+            vault_alias: Optional[str] = None,
+            write_behind: bool = False,
+            binary: bool = False,
+            compress: Optional[str] = None,
+            compress_min_length: int = 1024,
+            expires_at_field: Optional[str] = None,
             **kwargs):
         self._vault_property = vault_property
         self._vault_collection = vault_collection
+        self.vault_alias = vault_alias
+        # write_behind encrypts the values of saves through the shared WriteBehindQueue, coalesced with the
+        # values saved by other threads. The write itself stays synchronous: save() blocks until its values
+        # are encrypted, since the row is written with their ciphertexts
+        self.write_behind = write_behind
+        self.binary = binary
+        if compress is not None and compress not in _COMPRESSION_ALGORITHMS:
+            raise ImproperlyConfigured(f'compress must be one of {_COMPRESSION_ALGORITHMS}')
+        if compress is not None and data_type_name not in (None, 'STRING'):
+            # vault would validate and transform (e.g. mask) the compressed payload rather than the value
+            raise ImproperlyConfigured('compress is only supported on STRING properties')
+        self.compress = compress
+        self.compress_min_length = compress_min_length
+        self.expires_at_field = expires_at_field
         self.encryption_type = encryption_type
         self.expiration_secs = expiration_secs
         self._data_type_name = data_type_name
@@ -242,37 +1115,104 @@ class EncryptedMixin(object):
             return self.name  # type: ignore
         return self._vault_property
 
+    def get_vault_properties(self) -> List[Tuple[str, str]]:
+        """The (name, data type) of each vault property the values of this field are encrypted as"""
+        return [(self.vault_property, self.data_type_name)]
+
+    def get_vault_field_name(self, transformation=None, instance=None) -> str:
+        """The name of the property decrypted for instance, including the transformation"""
+        field_name = self.vault_property
+        if transformation and self.compress is not None:
+            raise ValueError(f'{self.vault_property} is compressed and cannot be transformed by vault')
+        if transformation:
+            field_name = f'{field_name}.{transformation}'
+        return field_name
+
     @property
     def vault_collection(self):
+        return self.get_vault_collection()
+
+    def get_vault_collection(self, vault: Optional[Vault] = None):
         vault_collection = self._vault_collection
         if vault_collection is None:
-            meta = self.model._meta
+            meta = self.model._meta  # type: ignore
             vault_collection = getattr(meta, 'vault_collection', None)
         if vault_collection is None:
-            vault_collection = _VAULT.default_collection
+            if vault is None:
+                vault = self.resolve_vault()
+            vault_collection = vault.default_collection
+        if _collection_prefix:
+            vault_collection = _collection_prefix + vault_collection
         return vault_collection
 
+    def get_vault_alias(self, instance=None) -> str:
+        """Select the Vault target for this field: an explicit using_vault() context wins,
+        then the field's vault_alias, then settings.VAULT_ROUTER"""
+        alias = _vault_alias.get()
+        if alias is None:
+            alias = self.vault_alias
+        if alias is None:
+            router = get_vault_router()
+            if router is not None:
+                alias = router(self, instance=instance)
+        return alias or DEFAULT_VAULT_ALIAS
+
+    def resolve_vault(self, instance=None) -> Vault:
+        return get_vault_client(self.get_vault_alias(instance))
+
     # This is a hook for the field, so that when a value is ready from the DB, we know it was read from the DB.
     # This allows us to differentiate between model.field = x done by the developer and the same when done internally by
     # django when reading values from the DB. The first is not encrypted, while the second is.
     def from_db_value(self, value, *args, **kwargs):
         if value is None:
             return None
+        if self.binary and isinstance(value, (bytes, memoryview)):
+            value = base64.b64encode(value).decode('ascii') if value else ''
         if not value:
             return self.to_python(value)
         return ('encrypted', value)
 
-    def get_decrypted_value(self, encrypted_value, transformation=None):
+    def ciphertext_to_db(self, ciphertext: str, connection):
+        """Convert a ciphertext returned by vault to the value stored in the DB, raw bytes for binary fields"""
+        if not self.binary:
+            return ciphertext
+        try:
+            raw = base64.b64decode(ciphertext, validate=True)
+        except binascii.Error:
+            raw = None
+        if raw is None or base64.b64encode(raw).decode('ascii') != ciphertext:
+            raise ValueError(f'Ciphertext of {self.name} is not canonical base64 and cannot be stored as binary')  # type: ignore[attr-defined]
+        return connection.Database.Binary(raw)
+
+    def is_expired(self, instance) -> bool:
+        """Whether the value of this field in instance expired in vault, according to expires_at_field"""
+        if instance is None or self.expires_at_field is None:
+            return False
+        return _has_expired(getattr(instance, self.expires_at_field, None))
+
+    def get_expired_value(self):
+        """The value of an expired field, resolved locally according to on_error"""
+        if self.on_error == raise_error:
+            raise VaultException(f'Value of {self.vault_property} expired', status_code=410,
+                                 collection=self.vault_collection, field_name=self.vault_property)
+        return self.to_python(self.on_error)
+
+    def get_decrypted_value(self, encrypted_value, transformation=None, instance=None):
         if encrypted_value is None:
             return None
         if not encrypted_value:
             return self.to_python(encrypted_value)
-        vault_collection = self.vault_collection
-        field_name = self.vault_property
-        if transformation:
-            field_name = f'{field_name}.{transformation}'
+        if self.is_expired(instance):
+            return self.get_expired_value()
+        vault = self.resolve_vault(instance)
+        vault_collection = self.get_vault_collection(vault)
+        field_name = self.get_vault_field_name(transformation, instance)
+        memo = get_decrypt_memo()
+        memo_key = (vault.name, vault_collection, field_name, vault.get_reason().value, encrypted_value)
+        if memo is not None and memo_key in memo:
+            return self.to_python(self.decompress_plaintext(memo[memo_key]))
         try:
-            decrypted_value = _VAULT.decrypt(
+            decrypted_value = vault.decrypt(
                 ciphertext=encrypted_value,
                 field_name=field_name,
                 collection=vault_collection,
@@ -283,61 +1223,186 @@ class EncryptedMixin(object):
                 raise
             else:
                 return self.to_python(self.on_error)
-        return self.to_python(decrypted_value)
+        if memo is not None:
+            memo[memo_key] = decrypted_value
+        return self.to_python(self.decompress_plaintext(decrypted_value))
 
-    def get_decrypted_values(self, encrypted_values, transformation=None):
+    def get_decrypted_values(self, encrypted_values, transformation=None, instances=None):
+        """Decrypt a batch of values, sending a single bulk request for each Vault target.
+
+        When instances are given (in the same order as encrypted_values) they are passed to the
+        vault router, so that values loaded together can still be routed to different targets."""
         result = [None] * len(encrypted_values)
-        values_to_send = []
-        sent_values_idx_to_orig_idx = {}
-        vault_collection = self.vault_collection
-        field_name = self.vault_property
-        if transformation:
-            field_name = f'{field_name}.{transformation}'
+        # indices of the values to send, partitioned by the alias of the Vault they are routed to
+        alias_to_indices: Dict[str, list] = {}
+        field_name = self.get_vault_field_name(transformation, instances[0] if instances else None)
         for idx, encrypted_value in enumerate(encrypted_values):
             if encrypted_value is None:
                 continue
             if not encrypted_value:
                 result[idx] = self.to_python(encrypted_value)
                 continue
-            values_to_send.append(encrypted_value)
-            sent_values_idx_to_orig_idx[len(values_to_send) - 1] = idx
+            instance = instances[idx] if instances is not None else None
+            if self.is_expired(instance):
+                # no need to ask vault, and an expired value would fail the whole batch
+                result[idx] = self.get_expired_value()
+                continue
+            alias_to_indices.setdefault(self.get_vault_alias(instance), []).append(idx)
+        for alias, indices in alias_to_indices.items():
+            vault = get_vault_client(alias)
+            ciphertext_to_value = self._bulk_decrypt_isolating_failures(
+                vault, list(dict.fromkeys(encrypted_values[idx] for idx in indices)), field_name)
+            for orig_idx in indices:
+                result[orig_idx] = self.to_python(
+                    self.decompress_plaintext(ciphertext_to_value[encrypted_values[orig_idx]]))
+        return result
+
+    def decrypt_column(self, db_values, transformation=None, expires_at=None):
+        """Decrypt a list of values of this field as loaded from the DB by values() or values_list().
+
+        expires_at, when given, is the list of the values of expires_at_field of the same rows, and expired
+        values are resolved locally like those of loaded instances (see is_expired())."""
+        if expires_at is None:
+            expires_at = [None] * len(db_values)
+        expired = [isinstance(value, tuple) and bool(value[1]) and _has_expired(expiry)
+                   for value, expiry in zip(db_values, expires_at)]
+        ciphertexts = [value[1] if isinstance(value, tuple) and not is_expired else None
+                       for value, is_expired in zip(db_values, expired)]
+        decrypted_values = self.get_decrypted_values(ciphertexts, transformation=transformation)
+        return [self.get_expired_value() if is_expired else decrypted if isinstance(value, tuple) else value
+                for value, decrypted, is_expired in zip(db_values, decrypted_values, expired)]
+
+    def _bulk_decrypt_isolating_failures(self, vault: Vault, ciphertexts, field_name: str) -> Dict[str, Any]:
+        """Like _bulk_decrypt, but when a batch is rejected because of some of its items, bisect it to find
+        them, so on_error only applies to the items that actually failed. This takes O(log n) extra requests
+        per failed item."""
         try:
-            decrypted_values = _VAULT.bulk_decrypt(
-                ciphertexts=values_to_send,
-                field_name=field_name,
-                reason=None,
-                collection=vault_collection,
-            )
-        except VaultException:
+            return self._bulk_decrypt(vault, ciphertexts, field_name)
+        except VaultException as e:
             if self.on_error == raise_error:
                 raise
-            else:
-                decrypted_values = [self.on_error] * len(values_to_send)
-        for sent_idx, decrypted_value in enumerate(decrypted_values):
-            orig_idx = sent_values_idx_to_orig_idx[sent_idx]
-            result[orig_idx] = self.to_python(decrypted_value)
+            if len(ciphertexts) == 1 or not e.is_item_error:
+                return {ciphertext: self.on_error for ciphertext in ciphertexts}
+        middle = len(ciphertexts) // 2
+        result = self._bulk_decrypt_isolating_failures(vault, ciphertexts[:middle], field_name)
+        result.update(self._bulk_decrypt_isolating_failures(vault, ciphertexts[middle:], field_name))
         return result
 
-    def get_db_prep_value(self, value, connection, prepared=False):
-        value = super(EncryptedMixin, self).get_db_prep_value(
-            value, connection, prepared)
+    def _bulk_decrypt(self, vault: Vault, ciphertexts, field_name: str) -> Dict[str, Any]:
+        """Return a mapping of each (distinct) ciphertext to its decrypted value, looking values up in the
+        decrypt memo of the current request and the shared decrypt cache first, and sending a single bulk
+        request for the missing ones"""
+        collection = self.get_vault_collection(vault)
+        reason = vault.get_reason()
+        memo = get_decrypt_memo()
+        ciphertext_to_value: Dict[str, Any] = {}
+        if memo is not None:
+            for ciphertext in ciphertexts:
+                key = (vault.name, collection, field_name, reason.value, ciphertext)
+                if key in memo:
+                    ciphertext_to_value[ciphertext] = memo[key]
+        missing = list(dict.fromkeys(c for c in ciphertexts if c not in ciphertext_to_value))
+        cache = get_decrypt_cache()
+        cached: Dict[str, Any] = {}
+        if cache is not None and missing:
+            cached = cache.get_many(vault, collection, field_name, reason, missing)
+            ciphertext_to_value.update(cached)
+            missing = [c for c in missing if c not in cached]
+        decrypted: Dict[str, Any] = {}
+        if missing:
+            decrypted = dict(zip(missing, self.vault_bulk_decrypt(vault, missing, field_name, collection)))
+            if cache is not None:
+                cache.set_many(vault, collection, field_name, reason, decrypted)
+            ciphertext_to_value.update(decrypted)
+        if memo is not None:
+            for ciphertext, value in itertools.chain(cached.items(), decrypted.items()):
+                memo[(vault.name, collection, field_name, reason.value, ciphertext)] = value
+        return ciphertext_to_value
+
+    def vault_bulk_decrypt(self, vault: Vault, ciphertexts: List[str], field_name: str,
+                           collection: Optional[str]) -> List[Any]:
+        return vault.bulk_decrypt(
+            ciphertexts=ciphertexts,
+            field_name=field_name,
+            reason=None,
+            collection=collection,
+        )
 
+    def to_python(self, value):
+        if _is_raw_ciphertext(value):
+            return Ciphertext(value)
+        return super(EncryptedMixin, self).to_python(value)  # type: ignore[misc]
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)  # type: ignore[attr-defined]
+        if isinstance(value, Ciphertext):
+            return str(value)
+        return super(EncryptedMixin, self).value_to_string(obj)  # type: ignore[misc]
+
+    def get_db_prep_plaintext(self, value, connection, prepared=False) -> Optional[str]:
+        """Return the plaintext that is encrypted for value, as prepared for the DB by the wrapped field"""
+        value = super(EncryptedMixin, self).get_db_prep_value(  # type: ignore[misc]
+            value, connection, prepared)
         if value is None:
+            return None
+        # decode the encrypted value to a unicode string, else this breaks in pgsql
+        return self.compress_plaintext(str(value))
+
+    def compress_plaintext(self, plaintext: str) -> str:
+        """Compress plaintexts of at least compress_min_length characters, when compression is enabled"""
+        if self.compress is None or len(plaintext) < self.compress_min_length:
+            return plaintext
+        payload = base64.b64encode(_compress(self.compress, plaintext.encode())).decode('ascii')
+        compressed = f'{_COMPRESSED_PREFIX}{self.compress}:{payload}'
+        if len(compressed) >= len(plaintext):
+            return plaintext
+        return compressed
+
+    def decompress_plaintext(self, value):
+        """Decompress a decrypted value if it was compressed, regardless of the current compress setting, so
+        that rows written before compression was enabled (or disabled) keep working"""
+        if not isinstance(value, str) or not value.startswith(_COMPRESSED_PREFIX):
             return value
+        algorithm, _, payload = value[len(_COMPRESSED_PREFIX):].partition(':')
+        try:
+            # binascii.Error and UnicodeDecodeError are ValueErrors too
+            return _decompress(algorithm, base64.b64decode(payload, validate=True)).decode()
+        except ValueError as e:
+            raise VaultException(f'Failed to decompress a decrypted value: {e}', status_code=0,
+                                 collection=self.vault_collection, field_name=self.vault_property)
+
+    def pre_save(self, model_instance, add):
+        value = super(EncryptedMixin, self).pre_save(model_instance, add)  # type: ignore[misc]
+        pending = model_instance.__dict__.get(_PENDING_CIPHERTEXTS)
+        if pending and self.name in pending:
+            plaintext_value, ciphertext = pending.pop(self.name)
+            if plaintext_value == value:
+                return Ciphertext(ciphertext)
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, Ciphertext):
+            return self.ciphertext_to_db(str(value), connection)
 
-        vault_collection = self.vault_collection
+        plaintext = self.get_db_prep_plaintext(value, connection, prepared)
+        if plaintext is None:
+            return plaintext
 
-        # decode the encrypted value to a unicode string, else this breaks in pgsql
-        result = _VAULT.encrypt(
-            plaintext=str(value),
+        vault = self.resolve_vault()
+        vault_collection = self.get_vault_collection(vault)
+
+        result = vault.encrypt(
+            plaintext=plaintext,
             field_name=self.vault_property,
             collection=vault_collection,
             reason=None,
             encryption_type=self.encryption_type,
             expiration_secs=self.expiration_secs)
-        return result
+        return self.ciphertext_to_db(result, connection)
 
     def get_internal_type(self):
+        if self.binary:
+            return "BinaryField"
         return "TextField"
 
     def deconstruct(self):
@@ -345,6 +1410,9 @@ class EncryptedMixin(object):
 
         if 'max_length' in kwargs:
             del kwargs['max_length']
+        # the column type depends on it, so it must be part of migrations
+        if self.binary:
+            kwargs['binary'] = True
 
         return name, path, args, kwargs
 
@@ -366,7 +1434,7 @@ class EncryptedDateTimeField(EncryptedMixin, django.db.models.DateTimeField):
     def to_python(self, value):
         value = super(EncryptedDateTimeField, self).to_python(value)
 
-        if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        if isinstance(value, datetime.datetime) and settings.USE_TZ and timezone.is_naive(value):
             default_timezone = timezone.get_default_timezone()
             value = timezone.make_aware(value, default_timezone)
 
@@ -436,6 +1504,186 @@ class EncryptedSSNField(EncryptedMixin, django.db.models.TextField):
     pass
 
 
+# how the string values of EncryptedCompositeField properties are parsed, by data type. Other values are
+# returned as vault returns them
+_PROPERTY_PARSERS = {
+    'DATE': dateparse.parse_date,
+    'DATE_OF_BIRTH': dateparse.parse_date,
+    'DATE_TIME': dateparse.parse_datetime,
+    'TIMESTAMP': dateparse.parse_datetime,
+}
+
+
+def _serialize_property(value):
+    """The JSON value of an EncryptedCompositeField property sent to vault"""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        # exact, unlike a float
+        return str(value)
+    return value
+
+
+class _CompositeProperty(property):
+    """The model attribute of a property of an EncryptedCompositeField"""
+
+
+class PartialProperties(dict):
+    """The value of an EncryptedCompositeField loaded with select_properties(), which holds some of its
+    properties only and so cannot be saved"""
+
+
+class EncryptedCompositeField(EncryptedMixin, django.db.models.TextField):  # type: ignore
+    """Several vault properties encrypted together as a single vault object, into one ciphertext and column.
+
+    The value is a dict of property name to value, and each property is also exposed as an attribute of the
+    model. properties are the names of the vault properties, or a mapping of their names to data types.
+    Dates, datetimes and Decimals are sent as strings, and the dates and datetimes of properties with a date
+    data type (see _PROPERTY_PARSERS) are parsed back. Properties that are None are left out of the
+    object."""
+
+    empty_strings_allowed = False
+
+    def __init__(self, *args, properties: Union[Sequence[str], Mapping[str, str]] = (), **kwargs):
+        if not properties:
+            raise ImproperlyConfigured('EncryptedCompositeField requires properties')
+        if kwargs.get('write_behind') or kwargs.get('compress'):
+            raise ImproperlyConfigured('write_behind and compress are not supported on EncryptedCompositeField')
+        self._properties = properties
+        self.properties: List[str] = list(properties)
+        super().__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        for property_name in self.properties:
+            # the attributes of a composite field of an abstract parent are inherited, and replaced
+            existing = getattr(cls, property_name, _NOT_SET)
+            if property_name == name or (existing is not _NOT_SET and not isinstance(existing, _CompositeProperty)):
+                raise ImproperlyConfigured(
+                    f'Property {property_name} of {cls.__name__}.{name} clashes with an attribute of the model')
+        super().contribute_to_class(cls, name, *args, **kwargs)
+        for property_name in self.properties:
+            setattr(cls, property_name, self._make_property(property_name))
+
+    def _make_property(self, property_name: str) -> property:
+        attname = self.attname
+
+        def get_value(instance):
+            value = getattr(instance, attname)
+            return value.get(property_name) if value else None
+
+        def set_value(instance, value):
+            current = getattr(instance, attname)
+            # PartialProperties are copied as such, so they still cannot be saved
+            updated = type(current)(current) if current else {}
+            updated[property_name] = value
+            setattr(instance, attname, updated)
+
+        # a property, so that models also accept it as a keyword argument
+        return _CompositeProperty(get_value, set_value, doc=f'The {property_name} property of {self.name}')
+
+    def get_vault_properties(self) -> List[Tuple[str, str]]:
+        if isinstance(self._properties, Mapping):
+            return list(self._properties.items())
+        return [(property_name, self.data_type_name) for property_name in self.properties]
+
+    def get_selected_properties(self, instance=None) -> List[str]:
+        selections = getattr(instance, '_property_selections', None) or {}
+        return list(selections.get(self.name, self.properties))
+
+    def get_vault_field_name(self, transformation=None, instance=None) -> str:
+        # the selected properties, in the same format vault uses for the props of a decrypt request. It also
+        # scopes the decrypt memo and cache
+        props = self.get_selected_properties(instance)
+        if transformation:
+            props = [f'{prop}.{transformation}' for prop in props]
+        return ','.join(props)
+
+    def vault_bulk_decrypt(self, vault: Vault, ciphertexts: List[str], field_name: str,
+                           collection: Optional[str]) -> List[Any]:
+        props = field_name.split(',')
+        objects = vault.bulk_decrypt_objects(ciphertexts, props, reason=None, collection=collection)
+        # transformed properties are returned as <name>.<transformation>
+        return [{prop.partition('.')[0]: fields.get(prop) for prop in props} for fields in objects]
+
+    def get_decrypted_value(self, encrypted_value, transformation=None, instance=None):
+        return self.get_decrypted_values([encrypted_value], transformation=transformation, instances=[instance])[0]
+
+    def get_decrypted_values(self, encrypted_values, transformation=None, instances=None):
+        decrypted_values = super().get_decrypted_values(encrypted_values, transformation, instances)
+        if self.get_selected_properties(instances[0] if instances else None) == self.properties:
+            return decrypted_values
+        return [PartialProperties(value) if isinstance(value, dict) else value for value in decrypted_values]
+
+    def to_python(self, value):
+        if _is_raw_ciphertext(value):
+            return Ciphertext(value)
+        if isinstance(value, str):
+            try:
+                value = json.loads(value) if value else None
+            except ValueError:
+                raise ValidationError(f'{self.name} must be a JSON object')
+        if value is None:
+            return value
+        if not isinstance(value, dict):
+            raise ValidationError(f'{self.name} must be a dict of its properties')
+        data_types = dict(self.get_vault_properties())
+        parsed = {name: self._parse_property(name, data_types.get(name), property_value)
+                  for name, property_value in value.items()}
+        # PartialProperties stay partial
+        return type(value)(parsed)
+
+    def _parse_property(self, name: str, data_type: Optional[str], value):
+        parser = _PROPERTY_PARSERS.get(data_type) if data_type and isinstance(value, str) else None
+        if parser is None:
+            return value
+        try:
+            parsed = parser(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValidationError(f'{self.name}.{name} is not a valid {data_type}: {value!r}')
+        return parsed
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        if isinstance(value, Ciphertext):
+            return str(value)
+        return json.dumps(value, default=_serialize_property)
+
+    def get_db_prep_properties(self, value) -> Optional[Dict[str, Any]]:
+        """Return the properties that are encrypted for value, None when all of them are None"""
+        value = self.to_python(value)
+        if not value:
+            return None
+        if isinstance(value, PartialProperties):
+            raise ValueError(f'{self.name} was loaded with select_properties() and cannot be saved')
+        unknown = set(value) - set(self.properties)
+        if unknown:
+            raise ValueError(f'{self.name} has no properties {sorted(unknown)}')
+        return {name: _serialize_property(property_value) for name, property_value in value.items()
+                if property_value is not None} or None
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, Ciphertext):
+            return self.ciphertext_to_db(str(value), connection)
+        fields = self.get_db_prep_properties(value)
+        if fields is None:
+            return None
+        vault = self.resolve_vault()
+        result = vault.encrypt_object(
+            fields,
+            collection=self.get_vault_collection(vault),
+            reason=None,
+            encryption_type=self.encryption_type,
+            expiration_secs=self.expiration_secs)
+        return self.ciphertext_to_db(result, connection)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['properties'] = self._properties
+        return name, path, args, kwargs
+
+
 @contextmanager
 def with_reason(reason: Reason):
     _VAULT.add_reason(reason)
@@ -443,3 +1691,30 @@ def with_reason(reason: Reason):
         yield
     finally:
         _VAULT.remove_reason(reason)
+
+
+@contextmanager
+def raw_ciphertext(deserialize: bool = False):
+    """Read the ciphertexts of encrypted fields in this context instead of their decrypted values, without
+    calling vault: fields read as Ciphertext. Only Ciphertext values written to them are stored as they are,
+    other values are encrypted.
+
+    With deserialize, strings converted by the fields' to_python(), as deserializers do, are taken as
+    ciphertexts too. Used by dumpdata_ciphertexts and loaddata_ciphertexts"""
+    token = _raw_ciphertext.set(True)
+    deserialize_token = _deserialize_ciphertexts.set(deserialize)
+    try:
+        yield
+    finally:
+        _deserialize_ciphertexts.reset(deserialize_token)
+        _raw_ciphertext.reset(token)
+
+
+@contextmanager
+def using_vault(alias: str):
+    """Route all encrypted field operations in this context to the Vault configured for alias"""
+    token = _vault_alias.set(alias)
+    try:
+        yield
+    finally:
+        _vault_alias.reset(token)
@@ -0,0 +1,11 @@
+from django.core.management.commands import dumpdata
+
+from django_encryption.fields import raw_ciphertext
+
+
+class Command(dumpdata.Command):
+    help = 'Like dumpdata, with the ciphertexts of encrypted fields instead of their decrypted values, without calling Vault'
+
+    def handle(self, *args, **options):
+        with raw_ciphertext():
+            return super().handle(*args, **options)
@@ -41,9 +41,8 @@ class Command(BaseCommand):
                 if not isinstance(field, EncryptedMixin):
                     continue
                 collection = field.vault_collection
-                property_name = field.vault_property
-                property_type = field.data_type_name
-                collection_to_fields[collection].append(dict(name=property_name, type=property_type))
+                for property_name, property_type in field.get_vault_properties():
+                    collection_to_fields[collection].append(dict(name=property_name, type=property_type))
         template = TEMPLATE
         project_name = self._get_django_project_name()
         template = template.replace('__PROJECT_NAME__', project_name)
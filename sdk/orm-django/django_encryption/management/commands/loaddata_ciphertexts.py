@@ -0,0 +1,11 @@
+from django.core.management.commands import loaddata
+
+from django_encryption.fields import raw_ciphertext
+
+
+class Command(loaddata.Command):
+    help = 'Like loaddata, with the ciphertexts of encrypted fields instead of their decrypted values, without calling Vault'
+
+    def handle(self, *args, **options):
+        with raw_ciphertext(deserialize=True):
+            return super().handle(*args, **options)
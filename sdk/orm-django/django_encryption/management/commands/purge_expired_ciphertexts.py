@@ -0,0 +1,58 @@
+from typing import List, Optional
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db.models import Model
+from django.utils import timezone
+
+from django_encryption.fields import EncryptedMixin
+
+
+class Command(BaseCommand):
+    help = 'Sets encrypted values that expired in Vault (according to their expires_at_field) to NULL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model_names', nargs='*', type=str)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--database', default='default')
+
+    def _get_all_models(self):
+        return apps.get_models()
+
+    def _model_name_to_model(self, model_name: str) -> Model:
+        app_label, model_name = model_name.split('.')
+        return apps.get_model(app_label, model_name)  # type: ignore
+
+    def _purge_field(self, model, field: EncryptedMixin, database: str, batch_size: int) -> int:
+        # expires_at_field should be indexed, so that each chunk is an index range scan
+        queryset = model._base_manager.using(database).filter(**{
+            f'{field.expires_at_field}__lte': timezone.now(),
+            f'{field.name}__isnull': False,  # type: ignore[attr-defined]
+        })
+        purged = 0
+        while True:
+            pks = list(queryset.order_by(field.expires_at_field).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return purged
+            purged += model._base_manager.using(database).filter(pk__in=pks).update(**{
+                field.name: None,  # type: ignore[attr-defined]
+                field.expires_at_field: None,
+            })
+
+    def _purge(self, model_names: Optional[List[str]], database: str, batch_size: int):
+        if model_names:
+            models = [self._model_name_to_model(name) for name in model_names]
+        else:
+            models = self._get_all_models()
+        for model in models:
+            for field in model._meta.get_fields():
+                if not isinstance(field, EncryptedMixin) or field.expires_at_field is None:
+                    continue
+                if not field.null:  # type: ignore[attr-defined]
+                    self.stderr.write(f'Skipping {model._meta.label}.{field.name}, it is not nullable')
+                    continue
+                purged = self._purge_field(model, field, database, batch_size)
+                self.stdout.write(f'{model._meta.label}.{field.name}: purged {purged} expired values')
+
+    def handle(self, *args, **options):
+        self._purge(options.get('model_names'), options['database'], options['batch_size'])
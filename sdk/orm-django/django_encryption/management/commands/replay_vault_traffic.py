@@ -0,0 +1,69 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand
+
+from django_encryption.fields import DEFAULT_VAULT_ALIAS, get_vault
+from django_encryption.traffic import (ReplayReport, StandInTransport,
+                                       load_traffic, replay)
+from django_encryption.vault_wrapper import Vault
+
+
+def _make_vault(options: Dict[str, Any]) -> Vault:
+    vault = get_vault(options['vault'])
+    # the replay itself is not recorded
+    vault.recorder = None
+    if options['stand_in']:
+        vault.transport = StandInTransport(latency=options['stand_in_latency'])
+    return vault
+
+
+def _replay_process(options: Dict[str, Any], entries: List[Dict[str, Any]]) -> ReplayReport:
+    return replay(_make_vault(options), entries, threads=options['threads'], speed=options['speed'],
+                  copies=options['copies'])
+
+
+class Command(BaseCommand):
+    help = 'Replays Vault traffic recorded with VAULT_TRAFFIC_RECORDING, and reports throughput and latencies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', type=str, help='Recorded traffic files, merged by time')
+        parser.add_argument('--vault', default=DEFAULT_VAULT_ALIAS, help='The alias of the Vault to replay against')
+        parser.add_argument('--threads', type=int, default=4, help='Threads sending requests, per process')
+        parser.add_argument('--processes', type=int, default=1, help='Processes each replaying all the traffic')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Speed up of the recorded timing, 0 sends requests as fast as possible')
+        parser.add_argument('--copies', type=int, default=1, help='Times each recorded request is sent')
+        parser.add_argument('--stand-in', action='store_true',
+                            help='Answer requests with a local stand-in instead of sending them to Vault')
+        parser.add_argument('--stand-in-latency', type=float, default=0.0)
+
+    def _replay(self, options: Dict[str, Any], entries: List[Dict[str, Any]]) -> ReplayReport:
+        if options['processes'] <= 1:
+            return _replay_process(options, entries)
+        report = ReplayReport()
+        with ProcessPoolExecutor(max_workers=options['processes'],
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_replay_process, options, entries) for _ in range(options['processes'])]
+            for future in futures:
+                report.merge(future.result())
+        # each process replays the recording, skipped entries are counted once
+        report.skipped //= options['processes']
+        return report
+
+    def handle(self, *args, **options):
+        entries = load_traffic(options['paths'])
+        # the options are sent to the replay processes
+        replay_options = {name: options[name] for name in (
+            'vault', 'threads', 'processes', 'speed', 'copies', 'stand_in', 'stand_in_latency')}
+        summary = self._replay(replay_options, entries).summary()
+        self.stdout.write(
+            f"Replayed {summary['requests']} requests ({summary['items']} items) in {summary['duration']:.1f}s: "
+            f"{summary['requests_per_sec']:.1f} requests/s, {summary['items_per_sec']:.1f} items/s, "
+            f"{summary['errors']} errors, {summary['skipped']} skipped")
+        for op, latency in summary['latency'].items():
+            self.stdout.write(
+                f"{op}: p50 {latency['p50'] * 1000:.1f}ms, p90 {latency['p90'] * 1000:.1f}ms, "
+                f"p99 {latency['p99'] * 1000:.1f}ms, max {latency['max'] * 1000:.1f}ms "
+                f"({latency['requests']} requests)")
@@ -0,0 +1,44 @@
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+# maps (vault, collection, field name, reason, ciphertext) to the decrypted value
+MemoKey = Tuple[str, Optional[str], str, str, str]
+
+_decrypt_memo: contextvars.ContextVar[Optional[Dict[MemoKey, Any]]] = contextvars.ContextVar(
+    'vault_decrypt_memo', default=None)
+
+
+def get_decrypt_memo() -> Optional[Dict[MemoKey, Any]]:
+    """Return the memo of the current decrypt_memo() context, or None outside of one"""
+    return _decrypt_memo.get()
+
+
+@contextmanager
+def decrypt_memo():
+    """Remember values decrypted in this context, so that identical ciphertexts loaded again (by another
+    queryset, a form or a serializer) are not sent to vault again.
+
+    The memo is discarded when the context exits, so decrypted values never outlive it. Nested contexts
+    share the memo of the outermost one."""
+    if _decrypt_memo.get() is not None:
+        yield
+        return
+    memo: Dict[MemoKey, Any] = {}
+    token = _decrypt_memo.set(memo)
+    try:
+        yield
+    finally:
+        _decrypt_memo.reset(token)
+        memo.clear()
+
+
+class DecryptMemoMiddleware:
+    """Scope a decrypt_memo() to each request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with decrypt_memo():
+            return self.get_response(request)
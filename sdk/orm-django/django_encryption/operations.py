@@ -0,0 +1,35 @@
+from django.db import migrations
+
+from django_encryption.fields import Ciphertext
+
+
+def copy_ciphertext(model_name: str, from_field: str, to_field: str, batch_size: int = 1000) -> migrations.RunPython:
+    """Return a migration operation that copies the ciphertexts of one encrypted field to another, without
+    decrypting them, e.g. from an existing text column to a new field with binary=True.
+
+    model_name is given as 'app_label.ModelName'. Reversing the operation copies the values back."""
+
+    def copy(apps, schema_editor, source, target):
+        model = apps.get_model(model_name)
+        queryset = model._base_manager.using(schema_editor.connection.alias).order_by('pk')
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(chunk.values_list('pk', source)[:batch_size])
+            if not rows:
+                break
+            objs = []
+            for pk, value in rows:
+                obj = model(pk=pk)
+                # values read from the DB are ('encrypted', ciphertext)
+                if isinstance(value, tuple):
+                    value = value[1]
+                setattr(obj, target, Ciphertext(value) if value is not None else None)
+                objs.append(obj)
+            model._base_manager.using(schema_editor.connection.alias).bulk_update(objs, [target])
+            last_pk = rows[-1][0]
+
+    return migrations.RunPython(
+        lambda apps, schema_editor: copy(apps, schema_editor, from_field, to_field),
+        reverse_code=lambda apps, schema_editor: copy(apps, schema_editor, to_field, from_field),
+    )
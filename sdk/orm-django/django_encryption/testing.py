@@ -0,0 +1,267 @@
+import secrets
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import runner as django_runner
+
+from django_encryption import fields
+from django_encryption.fields import (DEFAULT_VAULT_ALIAS, EncryptedMixin,
+                                      get_vault_aliases, get_vault_client)
+from django_encryption.traffic import StandInTransport, TrafficRecorder
+
+# the type of the collections created for tests, as in the scripts of generate_vault_migration
+COLLECTION_TYPE = 'PERSONS'
+
+# the (vault alias, collection, property) this process provisioned, which are not looked up again
+_provisioned: Set[Tuple[str, str, str]] = set()
+# the collection prefix and in memory mode of the test run, read by the parallel test workers
+_worker_session: Dict[str, Any] = {'collection_prefix': '', 'in_memory': False}
+
+
+def set_collection_prefix(prefix: str):
+    """Prepend prefix to the vault collection of every encrypted field, '' to stop"""
+    fields._collection_prefix = prefix
+
+
+def get_vault_schema(models: Optional[Iterable[Any]] = None) -> Dict[Tuple[str, str], Dict[str, str]]:
+    """The vault properties the encrypted fields of models (by default all installed models) are stored in, as
+    {(vault alias, collection): {property name: data type}}"""
+    schema: Dict[Tuple[str, str], Dict[str, str]] = {}
+    for model in models if models is not None else apps.get_models():
+        for field in model._meta.get_fields():
+            if not isinstance(field, EncryptedMixin):
+                continue
+            alias = field.get_vault_alias()
+            collection = field.get_vault_collection(get_vault_client(alias))
+            schema.setdefault((alias, collection), {}).update(field.get_vault_properties())
+    return schema
+
+
+def _property(name: str, data_type: str) -> Dict[str, Any]:
+    return dict(name=name, description='', is_encrypted=True, is_index=False, is_nullable=True, is_unique=False,
+                data_type_name=data_type)
+
+
+def provision_collections(models: Optional[Iterable[Any]] = None) -> List[Tuple[str, str]]:
+    """Create the vault collections and properties the encrypted fields of models need, that do not exist yet.
+
+    Each vault is asked for its collections once, and only the difference is created: a missing collection
+    with all of its properties in one request, and the missing properties of an existing collection. What
+    this process provisioned before is not looked up again, and vaults answered by a stand-in are skipped.
+    Returns the (vault alias, collection) that were created."""
+    missing: Dict[str, Dict[str, Dict[str, str]]] = {}
+    for (alias, collection), properties in get_vault_schema(models).items():
+        properties = {name: data_type for name, data_type in properties.items()
+                      if (alias, collection, name.lower()) not in _provisioned}
+        if properties:
+            missing.setdefault(alias, {})[collection] = properties
+    created = []
+    for alias, collections in missing.items():
+        vault = get_vault_client(alias)
+        if isinstance(vault.transport, StandInTransport):
+            continue
+        # vault names are case insensitive
+        existing = {collection['name'].lower(): {prop['name'].lower() for prop in collection.get('properties') or ()}
+                    for collection in vault.list_collections()}
+        for collection, properties in collections.items():
+            existing_properties = existing.get(collection.lower())
+            if existing_properties is None:
+                vault.add_collection(collection, COLLECTION_TYPE,
+                                     [_property(name, data_type) for name, data_type in properties.items()])
+                created.append((alias, collection))
+            else:
+                for name, data_type in properties.items():
+                    if name.lower() not in existing_properties:
+                        vault.add_property(
+                            property_name=name,
+                            collection=collection,
+                            description='',
+                            is_encrypted=True,
+                            is_index=False,
+                            is_nullable=True,
+                            is_unique=False,
+                            data_type_name=data_type,
+                        )
+            _provisioned.update((alias, collection, name.lower()) for name in properties)
+    return created
+
+
+def remove_collections(prefix: str, aliases: Iterable[str] = (DEFAULT_VAULT_ALIAS,)) -> List[Tuple[str, str]]:
+    """Remove the collections whose names start with prefix from the given vaults. Returns the
+    (vault alias, collection) that were removed."""
+    if not prefix:
+        # never remove collections that were not created for a test run
+        raise ValueError('A collection prefix is required')
+    removed = []
+    for alias in aliases:
+        vault = get_vault_client(alias)
+        if isinstance(vault.transport, StandInTransport):
+            continue
+        for collection in vault.list_collections():
+            name = collection['name']
+            if name.lower().startswith(prefix.lower()):
+                vault.remove_collection(name)
+                removed.append((alias, name))
+        for key in [key for key in _provisioned if key[0] == alias and key[1].lower().startswith(prefix.lower())]:
+            _provisioned.discard(key)
+    return removed
+
+
+def _remove_created_collections(created: Iterable[Tuple[str, str]]):
+    """Remove the (vault alias, collection) returned by provision_collections()"""
+    for alias, collection in created:
+        get_vault_client(alias).remove_collection(collection)
+        for key in [key for key in _provisioned if key[:2] == (alias, collection)]:
+            _provisioned.discard(key)
+
+
+class InMemoryVaults:
+    """Answers the requests of the vault client of every configured alias with a StandInTransport instead of
+    sending them to vault, and records their traffic in memory. Clients created with get_vault() are not
+    affected.
+
+    Use it as a context manager, or call start() and stop()."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._swapped: List[Tuple[Any, Any, Any]] = []
+
+    def start(self) -> 'InMemoryVaults':
+        for alias in get_vault_aliases():
+            vault = get_vault_client(alias)
+            if isinstance(vault.transport, StandInTransport):
+                continue
+            self._swapped.append((vault, vault.transport, vault.recorder))
+            vault.transport = StandInTransport(latency=self.latency)
+            vault.recorder = TrafficRecorder()
+        return self
+
+    def stop(self):
+        for vault, transport, recorder in reversed(self._swapped):
+            vault.transport = transport
+            vault.recorder = recorder
+        self._swapped = []
+
+    def get_traffic(self, alias: str = DEFAULT_VAULT_ALIAS) -> List[Dict[str, Any]]:
+        """The requests recorded for the given alias, as described by TrafficRecorder"""
+        recorder = get_vault_client(alias).recorder
+        return list(recorder.entries) if recorder is not None else []
+
+    def __enter__(self) -> 'InMemoryVaults':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class VaultTestMixin:
+    """Provisions the vault collections of vault_models (by default all installed models) before the first
+    test of the class, see provision_collections(). Collections are provisioned once per process, so test
+    case classes sharing models do not repeat it. The collections the class created are removed after its
+    last test, e.g. when it is not run by VaultTestRunner, whose collections already exist."""
+
+    vault_models: Optional[Sequence[Any]] = None
+    _created_collections: List[Tuple[str, str]] = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls._created_collections = provision_collections(cls.vault_models)
+        try:
+            super().setUpClass()  # type: ignore
+        except Exception:
+            _remove_created_collections(cls._created_collections)
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            super().tearDownClass()  # type: ignore
+        finally:
+            _remove_created_collections(cls._created_collections)
+
+
+def _process_setup(session: Dict[str, Any]):
+    # workers started by spawn do not inherit the session of the main process
+    _worker_session.update(session)
+
+
+def _init_worker(*args, **kwargs):
+    django_runner._init_worker(*args, **kwargs)
+    # the collections of each worker were provisioned by the main process, see VaultTestRunner.setup_databases()
+    set_collection_prefix(f"{_worker_session['collection_prefix']}{django_runner._worker_id}_")
+    if _worker_session['in_memory']:
+        InMemoryVaults().start()
+
+
+class VaultParallelTestSuite(django_runner.ParallelTestSuite):
+    init_worker = _init_worker
+    process_setup = _process_setup
+
+    @property
+    def process_setup_args(self):  # type: ignore
+        return (dict(_worker_session),)
+
+
+class VaultTestRunner(django_runner.DiscoverRunner):
+    """A test runner that provisions the vault collections of all installed models once per test run, under a
+    collection prefix unique to the run, and removes them when the run ends.
+
+    With --parallel each worker process gets collections of its own, which requires Django 4.1 or later. With --keepdb the collections are
+    created under the fixed prefix test_ and kept, so later runs only create what changed. With
+    --vault-in-memory, or settings.VAULT_TEST_IN_MEMORY, no vault is needed: requests are answered and
+    recorded by InMemoryVaults."""
+
+    parallel_test_suite = VaultParallelTestSuite
+
+    def __init__(self, vault_in_memory: Optional[bool] = None, **kwargs):
+        super().__init__(**kwargs)
+        if self.parallel > 1 and django.VERSION < (4, 1):
+            # the workers are set up with ParallelTestSuite.process_setup, added in Django 4.1
+            raise ImproperlyConfigured('VaultTestRunner runs tests in parallel with Django 4.1 or later, '
+                                       'use --parallel=1')
+        if vault_in_memory is None:
+            vault_in_memory = getattr(settings, 'VAULT_TEST_IN_MEMORY', False)
+        self.in_memory_vaults = InMemoryVaults() if vault_in_memory else None
+        self.collection_prefix = 'test_' if self.keepdb else f'test_{secrets.token_hex(4)}_'
+
+    @classmethod
+    def add_arguments(cls, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--vault-in-memory', action='store_true', default=None,
+                            help='Answer vault requests in memory instead of sending them to vault.')
+
+    def get_collection_prefixes(self) -> List[str]:
+        """The collection prefix of each test process"""
+        if self.parallel > 1:
+            return [f'{self.collection_prefix}{worker}_' for worker in range(1, self.parallel + 1)]
+        return [self.collection_prefix]
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        if self.in_memory_vaults is not None:
+            self.in_memory_vaults.start()
+        _worker_session.update(collection_prefix=self.collection_prefix, in_memory=self.in_memory_vaults is not None)
+        set_collection_prefix(self.collection_prefix)
+
+    def teardown_test_environment(self, **kwargs):
+        set_collection_prefix('')
+        if self.in_memory_vaults is not None:
+            self.in_memory_vaults.stop()
+        super().teardown_test_environment(**kwargs)
+
+    def setup_databases(self, **kwargs):
+        old_config = super().setup_databases(**kwargs)
+        if self.in_memory_vaults is None:
+            for prefix in self.get_collection_prefixes():
+                set_collection_prefix(prefix)
+                provision_collections()
+            set_collection_prefix(self.collection_prefix)
+        return old_config
+
+    def teardown_databases(self, old_config, **kwargs):
+        if self.in_memory_vaults is None and not self.keepdb:
+            remove_collections(self.collection_prefix, {alias for alias, _ in get_vault_schema()})
+        super().teardown_databases(old_config, **kwargs)
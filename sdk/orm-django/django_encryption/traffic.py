@@ -0,0 +1,386 @@
+import base64
+import collections
+import datetime
+import gzip
+import json
+import os
+import queue
+import random
+import re
+import string
+import threading
+import time
+from typing import (Any, Callable, DefaultDict, Deque, Dict, Iterable, List,
+                    Optional, Sequence, Tuple)
+from urllib.parse import urlsplit
+
+from django_encryption.transports import Transport
+from django_encryption.vault_wrapper import Vault, VaultException
+
+_OBJECTS_PATH = re.compile(r'/data/collections/([^/]+)/(encrypt|decrypt)/objects$')
+# the JSON of an encrypt item other than its values, used to size replayed values like the recorded ones
+_ITEM_OVERHEAD_BYTES = 40
+# the most distinct ciphertexts created per collection and properties to replay decrypt requests with
+_MAX_REPLAY_CIPHERTEXTS = 1000
+# the most entries a TrafficRecorder without a path keeps in memory
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def describe_request(path: str, body: Any) -> Dict[str, Any]:
+    """The shape of a request to vault: its operation, collection, properties and number of items. Values
+    and ciphertexts are left out"""
+    match = _OBJECTS_PATH.search(path)
+    if match is None:
+        return {'op': path}
+    collection, op = match.groups()
+    items = body if isinstance(body, list) else []
+    props = set()
+    types = set()
+    for item in items:
+        if op == 'encrypt':
+            props.update(item.get('object', {}).get('fields', {}))
+            types.add(item.get('type'))
+        else:
+            props.update(item.get('props') or ())
+    shape: Dict[str, Any] = {'op': op, 'collection': collection, 'props': sorted(props), 'items': len(items)}
+    if op == 'encrypt' and len(types) == 1:
+        shape['type'] = types.pop()
+    return shape
+
+
+class TrafficRecorder:
+    """Records the shape of the requests a Vault client sends: the operation, collection, properties, number
+    of items, payload sizes, latency and the number of requests in flight. Values, ciphertexts and query
+    parameters are never recorded.
+
+    Entries are appended as JSON lines to path, which may contain {pid} so that each worker process writes
+    its own file. Without a path they are kept in entries, which is meant for tests: only the last
+    max_entries entries are kept."""
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.entries: Deque[Dict[str, Any]] = collections.deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._file: Optional[Any] = None
+        self._pid: Optional[int] = None
+
+    def start(self, vault: Vault, method: str, url: str, body: Any,
+              request_bytes: Optional[int] = None) -> Dict[str, Any]:
+        """Return the entry of a request that is about to be sent. request_bytes is the size of the JSON
+        body, when the caller already serialized it"""
+        if url.startswith(vault.vault_url):
+            path = url[len(vault.vault_url):]
+        else:
+            path = urlsplit(url).path
+        entry = {'time': time.time(), 'vault': vault.name, 'pid': os.getpid(), 'method': method}
+        entry.update(describe_request(path, body))
+        if request_bytes is None:
+            request_bytes = len(json.dumps(body).encode()) if body is not None else 0
+        entry['request_bytes'] = request_bytes
+        with self._lock:
+            self._in_flight += 1
+            entry['in_flight'] = self._in_flight
+        return entry
+
+    def finish(self, entry: Dict[str, Any], latency: float, response: Any):
+        """Record the entry returned by start(), with the response, None if no response was received"""
+        entry['latency'] = latency
+        entry['status'] = response.status_code if response is not None else 0
+        content = getattr(response, 'content', None)
+        entry['response_bytes'] = len(content) if isinstance(content, bytes) else 0
+        with self._lock:
+            self._in_flight -= 1
+            if self.path is None:
+                self.entries.append(entry)
+                return
+            if self._pid != os.getpid():
+                # a file inherited through fork is left to the parent process
+                self._file = open(self.path.format(pid=os.getpid()), 'a', buffering=1)
+                self._pid = os.getpid()
+            assert self._file is not None
+            self._file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pid = None
+
+
+def load_traffic(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    """Read the entries recorded to the given files, ordered by time"""
+    entries: List[Dict[str, Any]] = []
+    for path in paths:
+        with open(path) as file:
+            entries.extend(json.loads(line) for line in file if line.strip())
+    entries.sort(key=lambda entry: entry['time'])
+    return entries
+
+
+class _StandInResponse:
+    def __init__(self, status_code: int, body: Any):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode()
+        self.headers: Dict[str, str] = {}
+
+    @property
+    def text(self) -> str:
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __repr__(self):
+        return f'<Response [{self.status_code}]>'
+
+
+class StandInTransport(Transport):
+    """A local stand-in for vault, answering encrypt, decrypt and health requests without sending them.
+
+    Ciphertexts are the base64 encoded JSON of the encrypted object, and transformations are ignored. Each
+    request takes latency seconds, plus item_latency seconds per item."""
+
+    def __init__(self, latency: float = 0.0, item_latency: float = 0.0):
+        self.latency = latency
+        self.item_latency = item_latency
+
+    def request(self, method: str, url: str, *, headers: Dict[str, str], **kwargs):
+        path = urlsplit(url).path
+        if path.endswith('/data/info/health'):
+            return _StandInResponse(200, {'status': 'pass'})
+        match = _OBJECTS_PATH.search(path)
+        if match is None or method != 'POST':
+            return _StandInResponse(404, {'message': f'{method} {path} is not supported by the stand-in'})
+        data = kwargs.get('data', b'')
+        if headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        items = json.loads(data)
+        time.sleep(self.latency + self.item_latency * len(items))
+        if match.group(2) == 'encrypt':
+            return _StandInResponse(200, [
+                {'ciphertext': base64.b64encode(json.dumps(item['object']['fields']).encode()).decode()}
+                for item in items])
+        result = []
+        for item in items:
+            try:
+                fields = json.loads(base64.b64decode(item['encrypted_object']['ciphertext']))
+            except ValueError:
+                return _StandInResponse(400, {'message': 'invalid ciphertext'})
+            result.append({'fields': {prop: fields.get(prop.partition('.')[0]) for prop in item['props']
+                                      if prop.partition('.')[0] in fields}})
+        return _StandInResponse(200, result)
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * percentile / 100), len(sorted_values) - 1)]
+
+
+class ReplayReport:
+    """The outcome of replay(), reports of several processes are combined with merge()"""
+
+    def __init__(self):
+        self.latencies: DefaultDict[str, List[float]] = collections.defaultdict(list)
+        self.items = 0
+        self.errors = 0
+        self.skipped = 0
+        self.duration = 0.0
+
+    def merge(self, other: 'ReplayReport'):
+        for op, latencies in other.latencies.items():
+            self.latencies[op].extend(latencies)
+        self.items += other.items
+        self.errors += other.errors
+        self.skipped += other.skipped
+        self.duration = max(self.duration, other.duration)
+
+    def summary(self) -> Dict[str, Any]:
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        latency = {}
+        for op, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            latency[op] = {'requests': len(ordered), 'p50': _percentile(ordered, 50), 'p90': _percentile(ordered, 90),
+                           'p99': _percentile(ordered, 99), 'max': ordered[-1]}
+        return {
+            'requests': requests,
+            'items': self.items,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'duration': self.duration,
+            'requests_per_sec': requests / self.duration if self.duration else 0.0,
+            'items_per_sec': self.items / self.duration if self.duration else 0.0,
+            'latency': latency,
+        }
+
+
+def _random_value(length: int) -> str:
+    return os.urandom(length // 2 + 1).hex()[:max(length, 1)]
+
+
+def _random_digits(count: int) -> str:
+    return ''.join(random.choice(string.digits) for _ in range(count))
+
+
+def _random_ssn(length: int) -> str:
+    # area numbers 000, 666 and 900-999, group 00 and serial 0000 are never issued
+    area = random.choice([number for number in range(1, 900) if number != 666])
+    return f'{area:03d}-{random.randint(1, 99):02d}-{random.randint(1, 9999):04d}'
+
+
+def _random_card_number(length: int) -> str:
+    digits = [4] + [int(digit) for digit in _random_digits(14)]
+    # the Luhn check digit
+    total = sum(sum(divmod(digit * 2, 10)) if i % 2 == 0 else digit for i, digit in enumerate(reversed(digits)))
+    return ''.join(map(str, digits)) + str(-total % 10)
+
+
+def _random_date(length: int) -> str:
+    return (datetime.date(1950, 1, 1) + datetime.timedelta(days=random.randrange(365 * 50))).isoformat()
+
+
+def _random_datetime(length: int) -> str:
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    value = start + datetime.timedelta(seconds=random.randrange(365 * 24 * 3600))
+    return value.isoformat().replace('+00:00', 'Z')
+
+
+# random values that vault accepts for properties of the given data types, of about the given length where
+# it is free. Other data types get random hex strings
+_VALUE_GENERATORS: Dict[str, Callable[[int], Any]] = {
+    'SSN': _random_ssn,
+    'CC_NUMBER': _random_card_number,
+    'EMAIL': lambda length: f'{_random_value(max(length - 12, 1))}@example.com',
+    'PHONE_NUMBER': lambda length: f'+1202555{_random_digits(4)}',
+    'NAME': lambda length: ''.join(random.choice(string.ascii_lowercase) for _ in range(max(length, 2))).title(),
+    'DATE': _random_date,
+    'DATE_OF_BIRTH': _random_date,
+    'DATE_TIME': _random_datetime,
+    'TIMESTAMP': _random_datetime,
+    'INTEGER': lambda length: random.randrange(10 ** min(max(length, 1), 9)),
+    'BOOLEAN': lambda length: random.random() < 0.5,
+}
+
+
+def _value_length(entry: Dict[str, Any]) -> int:
+    per_item = entry.get('request_bytes', 0) // max(entry['items'], 1)
+    return max(per_item - _ITEM_OVERHEAD_BYTES, 1) // max(len(entry['props']), 1)
+
+
+class _Replayer:
+    def __init__(self, vault: Vault, report: ReplayReport):
+        self.vault = vault
+        self.report = report
+        self.reason = vault.get_reason().value
+        self._lock = threading.Lock()
+        self._ciphertexts: Dict[Tuple[str, Tuple[str, ...]], List[str]] = {}
+        # {collection: {property: data type}}, lowercase since vault names are case insensitive
+        self._data_types: Dict[str, Dict[str, str]] = {}
+
+    def _url(self, entry: Dict[str, Any]) -> str:
+        return f"{self.vault.vault_url}/api/pvlt/1.0/data/collections/{entry['collection']}/{entry['op']}/objects"
+
+    def _encrypt_body(self, entry: Dict[str, Any], props: List[str], count: int) -> List[Dict[str, Any]]:
+        length = _value_length(entry)
+        data_types = self._data_types.get(entry['collection'].lower(), {})
+        generators = {prop: _VALUE_GENERATORS.get(data_types.get(prop.lower(), ''), _random_value) for prop in props}
+        body = [{'object': {'fields': {prop: generate(length) for prop, generate in generators.items()}}}
+                for _ in range(count)]
+        if entry.get('type'):
+            for item in body:
+                item['type'] = entry['type']
+        return body
+
+    def load_data_types(self):
+        """Look up the data types of the properties of vault, so replayed values are valid for them"""
+        try:
+            collections = self.vault.list_collections()
+        except VaultException:
+            # e.g. the api key may not read the schema, values are then random strings
+            return
+        for collection in collections:
+            self._data_types[collection['name'].lower()] = {
+                prop['name'].lower(): prop.get('data_type_name', '') for prop in collection.get('properties') or ()}
+
+    def prepare(self, entries: List[Dict[str, Any]]):
+        """Encrypt random objects to decrypt, for each collection and properties of the decrypt entries"""
+        sizes: Dict[Tuple[str, Tuple[str, ...]], Tuple[int, Dict[str, Any]]] = {}
+        for entry in entries:
+            if entry['op'] == 'decrypt':
+                key = (entry['collection'], tuple(sorted({prop.partition('.')[0] for prop in entry['props']})))
+                count = min(max(entry['items'], sizes.get(key, (0, entry))[0]), _MAX_REPLAY_CIPHERTEXTS)
+                sizes[key] = (count, entry)
+        for (collection, props), (count, entry) in sizes.items():
+            response = self.vault.make_request(
+                'POST', self._url({'collection': collection, 'op': 'encrypt'}), params={'reason': self.reason},
+                json=self._encrypt_body(entry, list(props), count))
+            if response.status_code != 200:
+                raise VaultException(f'Failed to prepare ciphertexts to replay: {response}, {response.text}',
+                                     status_code=response.status_code, collection=collection)
+            self._ciphertexts[(collection, props)] = [item['ciphertext'] for item in response.json()]
+
+    def send(self, entry: Dict[str, Any]):
+        if entry['op'] == 'encrypt':
+            body = self._encrypt_body(entry, entry['props'], entry['items'])
+        else:
+            key = (entry['collection'], tuple(sorted({prop.partition('.')[0] for prop in entry['props']})))
+            ciphertexts = self._ciphertexts[key]
+            body = [{'encrypted_object': {'ciphertext': ciphertexts[i % len(ciphertexts)]}, 'props': entry['props']}
+                    for i in range(entry['items'])]
+        start = time.monotonic()
+        try:
+            response = self.vault.make_request('POST', self._url(entry), params={'reason': self.reason}, json=body)
+            ok = response.status_code == 200
+        except VaultException:
+            ok = False
+        latency = time.monotonic() - start
+        with self._lock:
+            self.report.latencies[entry['op']].append(latency)
+            self.report.items += entry['items']
+            if not ok:
+                self.report.errors += 1
+
+
+def replay(vault: Vault, entries: Sequence[Dict[str, Any]], *, threads: int = 4, speed: float = 1.0,
+           copies: int = 1) -> ReplayReport:
+    """Send requests of the recorded shapes to vault, with random values valid for the data types of their
+    properties, and report their latencies.
+
+    Requests are sent at the recorded times divided by speed (with speed 0, as fast as threads allow), and
+    each of them copies times. Only encrypt and decrypt requests are replayed, the objects to decrypt are
+    encrypted ahead of the replay."""
+    report = ReplayReport()
+    replayer = _Replayer(vault, report)
+    schedule = [entry for entry in entries if entry.get('op') in ('encrypt', 'decrypt') and entry.get('items')]
+    report.skipped = len(entries) - len(schedule)
+    if not schedule:
+        return report
+    replayer.load_data_types()
+    replayer.prepare(schedule)
+    work: queue.Queue = queue.Queue()
+
+    def worker():
+        while True:
+            entry = work.get()
+            if entry is None:
+                return
+            replayer.send(entry)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    first_time = schedule[0]['time']
+    start = time.monotonic()
+    for entry in schedule:
+        if speed:
+            delay = (entry['time'] - first_time) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        for _ in range(copies):
+            work.put(entry)
+    for _ in workers:
+        work.put(None)
+    for thread in workers:
+        thread.join()
+    report.duration = time.monotonic() - start
+    return report
@@ -0,0 +1,176 @@
+import abc
+import contextvars
+import os
+import socket
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+import requests.adapters
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+
+class TransportError(Exception):
+    """Raised by transports when a request could not be sent or no response was received"""
+
+
+class Transport(abc.ABC):
+    """Sends HTTP requests to vault on behalf of a Vault client.
+
+    Responses must provide status_code, text and json(), like the responses of requests and httpx.
+    Transports must not reuse connections opened by another process, since a forked worker inherits the
+    sockets of its parent."""
+
+    @abc.abstractmethod
+    def request(self, method: str, url: str, *, headers: Dict[str, str], **kwargs) -> Any:
+        """Send a request and return its response, raising TransportError if no response was received"""
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """HTTP/1.1 with a requests.Session per context and thread, since sessions are not safe to share between
+    threads: a context copied to a worker thread (contextvars.copy_context()) gets a session of its own.
+
+    The sessions of a process share one adapter, whose connection pool is thread safe, so a connection
+    opened by one thread (e.g. by Vault.warmup()) is reused by the others. pool_maxsize connections are
+    kept open per host."""
+
+    def __init__(self, pool_maxsize: int = requests.adapters.DEFAULT_POOLSIZE):
+        self.pool_maxsize = pool_maxsize
+        # the session is kept with the pid and thread that created it, the adapter with the pid
+        self._session: contextvars.ContextVar[Optional[Tuple[int, int, requests.Session]]] = contextvars.ContextVar(
+            'vault_session', default=None)
+        self._adapter: Optional[Tuple[int, requests.adapters.HTTPAdapter]] = None
+        self._lock = threading.Lock()
+
+    def _make_adapter(self) -> requests.adapters.HTTPAdapter:
+        return requests.adapters.HTTPAdapter(pool_maxsize=self.pool_maxsize)
+
+    def _get_adapter(self) -> requests.adapters.HTTPAdapter:
+        pid = os.getpid()
+        state = self._adapter
+        if state is None or state[0] != pid:
+            with self._lock:
+                state = self._adapter
+                if state is None or state[0] != pid:
+                    state = (pid, self._make_adapter())
+                    self._adapter = state
+        return state[1]
+
+    def _get_session(self) -> requests.Session:
+        pid, thread = os.getpid(), threading.get_ident()
+        state = self._session.get()
+        # a session inherited through fork is dropped rather than closed, closing it would shut down
+        # connections that the parent process is still using. One of another thread is left to that thread
+        if state is None or state[:2] != (pid, thread):
+            session = requests.Session()
+            adapter = self._get_adapter()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            state = (pid, thread, session)
+            self._session.set(state)
+        return state[2]
+
+    def request(self, method: str, url: str, *, headers: Dict[str, str], **kwargs):
+        try:
+            return self._get_session().request(method, url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise TransportError(str(e)) from e
+
+    def close(self):
+        """Close the connections of this process, the sessions of other contexts open new ones when used"""
+        state = self._session.get()
+        if state is not None:
+            if state[:2] == (os.getpid(), threading.get_ident()):
+                state[2].close()
+            self._session.set(None)
+        adapter = self._adapter
+        if adapter is not None and adapter[0] == os.getpid():
+            adapter[1].close()
+
+
+def _make_unix_connection_pool_class(socket_path: str):
+    class UnixSocketConnection(HTTPConnection):
+        def _new_conn(self):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if isinstance(self.timeout, (int, float)):
+                sock.settimeout(self.timeout)
+            try:
+                sock.connect(socket_path)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+
+    class UnixSocketConnectionPool(HTTPConnectionPool):
+        ConnectionCls = UnixSocketConnection
+
+    return UnixSocketConnectionPool
+
+
+class _UnixSocketAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, socket_path: str, **kwargs):
+        self._pool_class = _make_unix_connection_pool_class(socket_path)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # the host of the url is ignored, every connection goes to the socket
+        self.poolmanager.pool_classes_by_scheme = {'http': self._pool_class, 'https': self._pool_class}
+
+
+class UnixSocketTransport(RequestsTransport):
+    """HTTP/1.1 over a Unix domain socket, for a vault running as a sidecar. The vault url should use the
+    http scheme, its host is ignored."""
+
+    def __init__(self, socket_path: str, pool_maxsize: int = requests.adapters.DEFAULT_POOLSIZE):
+        super().__init__(pool_maxsize=pool_maxsize)
+        self.socket_path = socket_path
+
+    def _make_adapter(self) -> requests.adapters.HTTPAdapter:
+        return _UnixSocketAdapter(self.socket_path, pool_maxsize=self.pool_maxsize)
+
+
+class HTTP2Transport(Transport):
+    """HTTP/2 with a single httpx client shared by all threads, so concurrent requests are multiplexed over
+    one connection per vault host instead of opening a connection each. Requires httpx[http2]."""
+
+    def __init__(self, timeout: Optional[float] = None, max_connections: Optional[int] = None):
+        try:
+            import httpx  # type: ignore
+        except ImportError:
+            raise ImportError('HTTP2Transport requires the httpx[http2] package')
+        self._httpx = httpx
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._client = self._make_client()
+
+    def _make_client(self):
+        return self._httpx.Client(http2=True, timeout=self.timeout,
+                                  limits=self._httpx.Limits(max_connections=self.max_connections))
+
+    def _get_client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # the client inherited through fork is dropped rather than closed, like in RequestsTransport
+                    self._client = self._make_client()
+                    self._pid = os.getpid()
+        return self._client
+
+    def request(self, method: str, url: str, *, headers: Dict[str, str], **kwargs):
+        if 'data' in kwargs:
+            kwargs['content'] = kwargs.pop('data')
+        try:
+            return self._get_client().request(method, url, headers=headers, **kwargs)
+        except self._httpx.HTTPError as e:
+            raise TransportError(str(e)) from e
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._client.close()
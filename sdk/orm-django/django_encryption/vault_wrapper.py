@@ -1,12 +1,33 @@
+import collections
+import collections.abc
 import contextvars
 import enum
+import gzip
+import json
 import logging
-from typing import Any, Dict, List, Optional
-
-import requests
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (TYPE_CHECKING, Any, Callable, Dict, List, Optional,
+                    Sequence, Tuple, Union)
+
+from django_encryption.adaptive import (RETRY_STATUS_CODES,
+                                        AdaptiveController, parse_retry_after)
+from django_encryption.balancing import Endpoint, EndpointPool
+from django_encryption.transports import (RequestsTransport, Transport,
+                                          TransportError)
+
+if TYPE_CHECKING:
+    from django_encryption.traffic import TrafficRecorder
 
 _logger = logging.getLogger(__name__)
 
+# the JSON of a bulk item, other than its value
+_ITEM_OVERHEAD_BYTES = 64
+# hedges in flight (or waiting for their delay) per Vault client, reads beyond it are not hedged
+DEFAULT_MAX_HEDGES = 8
+
 
 class Reason(enum.Enum):
     AppFunctionality = "AppFunctionality"
@@ -40,33 +61,126 @@ class VaultException(Exception):
         self.field_name = field_name
         self.reason = reason
 
+    @property
+    def is_item_error(self) -> bool:
+        """Whether vault rejected the request because of the items in it (e.g. an invalid or expired ciphertext),
+        as opposed to failing it as a whole (outage, authorization, rate limiting)"""
+        return 400 <= self.status_code < 500 and self.status_code not in (401, 403, 429)
+
     def __str__(self):
         return f'VaultException({self.message}, status_code={self.status_code}, collection={self.collection}, field_name={self.field_name}, reason={self.reason})'
 
 
+class _Coalescer:
+    """Merges concurrent single item calls with the same key into one batch call.
+
+    The first caller for a key waits for the linger window and then runs the batch on behalf of every
+    caller that joined it, unless the batch fills up first, in which case the caller that filled it
+    runs it. Each caller gets its own item's result. When vault rejects a batch because of some of its items,
+    the batch is bisected so that only the callers of those items get the error."""
+
+    def __init__(self, linger: float, max_batch_size: int):
+        self.linger = linger
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple, List[Tuple[Any, Future]]] = {}
+
+    def submit(self, key: Tuple, item: Any, run_batch: Callable[[List[Any]], List[Any]]) -> Any:
+        future: Future = Future()
+        with self._lock:
+            batch = self._pending.get(key)
+            is_leader = batch is None
+            if batch is None:
+                batch = self._pending[key] = []
+            batch.append((item, future))
+            is_full = len(batch) >= self.max_batch_size
+            if is_full:
+                del self._pending[key]
+        if is_full:
+            self._run(batch, run_batch)
+        elif is_leader:
+            time.sleep(self.linger)
+            with self._lock:
+                is_detached = self._pending.get(key) is batch
+                if is_detached:
+                    del self._pending[key]
+            if is_detached:
+                self._run(batch, run_batch)
+        return future.result()
+
+    @classmethod
+    def _run(cls, batch: List[Tuple[Any, Future]], run_batch: Callable[[List[Any]], List[Any]]):
+        try:
+            results = run_batch([item for item, _ in batch])
+        except VaultException as e:
+            if len(batch) == 1 or not e.is_item_error:
+                cls._fail(batch, e)
+                return
+            middle = len(batch) // 2
+            cls._run(batch[:middle], run_batch)
+            cls._run(batch[middle:], run_batch)
+            return
+        except Exception as e:
+            cls._fail(batch, e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    @staticmethod
+    def _fail(batch: List[Tuple[Any, Future]], e: Exception):
+        for _, future in batch:
+            future.set_exception(e)
+
+
+# The access reason belongs to the calling context rather than to a specific Vault target,
+# so it is shared by all Vault clients
+_reason: contextvars.ContextVar[Optional[Reason]] = contextvars.ContextVar('vault_reason', default=None)
+
+
 class Vault:
-    def __init__(self, vault_url: str, auth_token: str, default_collection: str):
+    def __init__(self, vault_url: Union[str, Sequence[str]], auth_token: str, default_collection: str,
+                 name: str = 'default', coalesce_linger: Optional[float] = None, coalesce_max_batch_size: int = 500,
+                 transport: Optional[Transport] = None, compress_min_bytes: Optional[int] = None,
+                 adaptive: Optional[AdaptiveController] = None, hedge_percentile: Optional[float] = None,
+                 recorder: Optional['TrafficRecorder'] = None, max_hedges: int = DEFAULT_MAX_HEDGES):
         self.auth_token = auth_token
-        self.vault_url = vault_url
+        urls = [vault_url] if isinstance(vault_url, str) else list(vault_url)
+        if not urls:
+            raise ValueError('At least one vault url is required')
+        # requests are built against the first url, and sent to the node chosen by the pool when there are several
+        self.vault_url = urls[0].rstrip('/')
+        self.endpoints = EndpointPool(urls, hedge_percentile=hedge_percentile) if len(urls) > 1 else None
+        self.max_hedges = max_hedges
+        # the hedge executor and its free slots, with the pid of the process that created them
+        self._hedging: Optional[Tuple[int, ThreadPoolExecutor, threading.BoundedSemaphore]] = None
+        self._hedging_lock = threading.Lock()
         self.default_collection = default_collection
-        self._session: contextvars.ContextVar[
-            Optional[requests.Session]] = contextvars.ContextVar('vault_session', default=None)
+        self.name = name
+        # when set, concurrent single item encrypt/decrypt calls are held for up to coalesce_linger seconds
+        # and merged into bulk calls
+        self._coalescer = _Coalescer(coalesce_linger, coalesce_max_batch_size) if coalesce_linger else None
+        # per-client request counters, so that each routed Vault target can be monitored separately
+        self._stats: collections.Counter = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self.transport = transport if transport is not None else RequestsTransport()
+        # when set, json bodies of at least compress_min_bytes are sent gzipped. It is reset to None if vault
+        # rejects a compressed body, so that the rest of the requests are sent as is
+        self.compress_min_bytes = compress_min_bytes
+        # when set, limits the requests in flight and splits bulk requests into adaptively sized batches
+        self.adaptive = adaptive
+        # when set, the shape of each request (but none of its values) is recorded
+        self.recorder = recorder
+        self._headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.auth_token}",
+            "Accept-Encoding": "gzip",
+        }
 
         # a mapping between (collection, field_name) to transformation name
         self._transformations: contextvars.ContextVar[Optional[Dict[tuple[str, str], str]]] = contextvars.ContextVar(
             'vault_transformations', default=None)
 
-        self._reason: contextvars.ContextVar[Optional[Reason]] = contextvars.ContextVar('vault_reason', default=None)
-
-    def _init_session(self) -> requests.Session:
-        session = requests.Session()
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.auth_token}"
-        }
-        session.headers.update(headers)
-        self._session.set(session)
-        return session
+        self._reason = _reason
 
     def _init_transformations(self) -> Dict:
         transformations: Dict[tuple[str, str], str] = {}
@@ -79,17 +193,230 @@ class Vault:
             transformations = self._init_transformations()
         return transformations
 
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def get_limits(self) -> Dict[str, Any]:
+        """The current limits of the adaptive controller, empty when it is disabled"""
+        return self.adaptive.get_state() if self.adaptive is not None else {}
+
+    def get_endpoints(self) -> List[Dict[str, Any]]:
+        """The state of each vault node, empty when there is a single one"""
+        return self.endpoints.get_state() if self.endpoints is not None else []
+
+    def _split(self, values: List[str]) -> List[List[str]]:
+        """Split the values of a bulk request into batches sized by the adaptive controller"""
+        if self.adaptive is None:
+            return [values]
+        return list(self.adaptive.split(values, lambda value: len(value) + _ITEM_OVERHEAD_BYTES))
+
     def make_request(self, method: str, url: str, *, collection: Optional[str] = None, field_name: Optional[str] = None, reason: Optional[Reason] = None, **kwargs):
-        session = self._session.get()
-        if session is None:
-            session = self._init_session()
+        body = kwargs.pop('json', None)
+        # serialized once, the recorder takes the size from here
+        data = json.dumps(body).encode() if body is not None else None
+        recorder = self.recorder
+        if recorder is None:
+            return self._make_request(method, url, collection, field_name, reason, data, **kwargs)
+        entry = recorder.start(self, method, url, body, request_bytes=len(data) if data is not None else 0)
+        start = time.monotonic()
+        response = None
+        try:
+            response = self._make_request(method, url, collection, field_name, reason, data, **kwargs)
+            return response
+        finally:
+            recorder.finish(entry, time.monotonic() - start, response)
+
+    def _make_request(self, method: str, url: str, collection: Optional[str], field_name: Optional[str],
+                      reason: Optional[Reason], body: Optional[bytes], **kwargs):
+        if body is None:
+            return self._send(method, url, self._headers, collection, field_name, reason, **kwargs)
+        min_bytes = self.compress_min_bytes
+        if min_bytes is not None and len(body) >= min_bytes:
+            compressed = gzip.compress(body, compresslevel=5)
+            if len(compressed) < len(body):
+                response = self._send(method, url, {**self._headers, "Content-Encoding": "gzip"},
+                                      collection, field_name, reason, data=compressed, **kwargs)
+                if response.status_code != 415:
+                    self._count('request_bytes_saved', len(body) - len(compressed))
+                    return response
+                _logger.warning("vault %s does not accept compressed requests, sending them uncompressed", self.name)
+                self.compress_min_bytes = None
+        return self._send(method, url, self._headers, collection, field_name, reason, data=body, **kwargs)
+
+    def _send(self, method: str, url: str, headers: Dict[str, str], collection: Optional[str],
+              field_name: Optional[str], reason: Optional[Reason], hedge: Optional[str] = None,
+              balance: bool = True, **kwargs):
+        # hedge marks reads that are safe to send to a second node when the first one is slow, and names
+        # the latency window they are measured in ('single' or 'bulk'). balance=False sends the request to
+        # the node of the url as is
+        adaptive = self.adaptive
+        attempt = 0
+        while True:
+            self._count('requests')
+            if 'data' in kwargs:
+                self._count('request_bytes', len(kwargs['data']))
+            if adaptive is not None:
+                adaptive.acquire()
+            start = time.monotonic()
+            try:
+                response = self._request(method, url, headers, balance, hedge, kwargs)
+            except TransportError as e:
+                self._count('errors')
+                if adaptive is not None:
+                    adaptive.release(time.monotonic() - start, 0)
+                raise VaultException(f"Request failed: {e}", status_code=0,
+                                     collection=collection, field_name=field_name, reason=reason)
+            if response.status_code != 200:
+                self._count('errors')
+            self._count_response_bytes(response)
+            # self.log.append(LogLine(method, url, kwargs, response))
+            if adaptive is None:
+                return response
+            retry_after = None
+            if response.status_code in RETRY_STATUS_CODES:
+                response_headers = getattr(response, 'headers', None)
+                if isinstance(response_headers, collections.abc.Mapping):
+                    retry_after = parse_retry_after(response_headers.get('Retry-After'))
+                if retry_after is None:
+                    retry_after = adaptive.retry_backoff * 2 ** attempt
+            adaptive.release(time.monotonic() - start, response.status_code, retry_after)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= adaptive.max_retries:
+                return response
+            attempt += 1
+            self._count('retries')
+
+    def _request(self, method: str, url: str, headers: Dict[str, str], balance: bool, hedge: Optional[str],
+                 kwargs: Dict[str, Any]):
+        """Send a request to the node chosen by the endpoint pool, unless balance is False.
+
+        The request is sent from the calling thread. When it is a read that is still running after the
+        hedge delay of its kind, the same read is sent to a second node from the hedge executor, and its
+        response is used if the first one fails (no response or a 5xx)."""
+        pool = self.endpoints
+        if pool is None or not balance or not url.startswith(self.vault_url + '/'):
+            return self.transport.request(method, url, headers=headers, **kwargs)
+        path = url[len(self.vault_url):]
+        endpoint = pool.choose()
+        assert endpoint is not None
+        delay = pool.hedge_delay(hedge) if hedge is not None else None
+        hedging = self._get_hedging() if delay is not None else None
+        if delay is None or hedging is None or not hedging[1].acquire(blocking=False):
+            return self._request_endpoint(pool, endpoint, method, path, headers, kwargs, hedge)
+        executor, slots = hedging
+        done = threading.Event()
+        second = executor.submit(self._hedge, pool, endpoint, done, time.monotonic() + delay, method, path,
+                                 headers, kwargs, hedge)
+        second.add_done_callback(lambda _: slots.release())
+        try:
+            response = self._request_endpoint(pool, endpoint, method, path, headers, kwargs, hedge)
+        except TransportError:
+            done.set()
+            hedged = second.result() if second.exception() is None else None
+            if hedged is None:
+                raise
+            return hedged
+        done.set()
+        if response.status_code < 500:
+            # a hedge that was sent completes in the background
+            return response
+        hedged = second.result() if second.exception() is None else None
+        return hedged if hedged is not None and hedged.status_code < 500 else response
+
+    def _hedge(self, pool: EndpointPool, endpoint: Endpoint, done: threading.Event, deadline: float,
+               method: str, path: str, headers: Dict[str, str], kwargs: Dict[str, Any], kind: Optional[str]):
+        """Send a read to a node other than endpoint if the request sent to endpoint is not done by
+        deadline. Returns the response, or None if no hedge was sent. Hedges count against the requests in
+        flight of the adaptive controller, and are not sent when it has no room for them."""
+        if done.wait(max(deadline - time.monotonic(), 0)):
+            return None
+        second_endpoint = pool.choose(exclude=endpoint)
+        if second_endpoint is None:
+            return None
+        adaptive = self.adaptive
+        if adaptive is not None and not adaptive.try_acquire():
+            return None
+        self._count('hedged_requests')
+        start = time.monotonic()
+        status_code = 0
         try:
-            response = session.request(method, url, **kwargs)
-        except requests.exceptions.RequestException as e:
-            raise VaultException(f"Request failed: {e}", status_code=response.status_code,
-                                 collection=collection, field_name=field_name, reason=reason)
-        # self.log.append(LogLine(method, url, kwargs, response))
-        return response
+            response = self._request_endpoint(pool, second_endpoint, method, path, headers, kwargs, kind)
+            status_code = response.status_code
+            return response
+        finally:
+            if adaptive is not None:
+                adaptive.release(time.monotonic() - start, status_code)
+
+    def _request_endpoint(self, pool: EndpointPool, endpoint: Endpoint, method: str, path: str,
+                          headers: Dict[str, str], kwargs: Dict[str, Any], kind: Optional[str]):
+        start = time.monotonic()
+        ok = False
+        try:
+            response = self.transport.request(method, endpoint.url + path, headers=headers, **kwargs)
+            ok = response.status_code < 500
+            return response
+        finally:
+            pool.finish(endpoint, time.monotonic() - start, ok, kind)
+
+    def _get_hedging(self) -> Tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+        """The hedge executor of this process and the semaphore bounding the hedges in flight. A forked
+        process creates its own, the threads of the parent's executor do not exist in it"""
+        pid = os.getpid()
+        with self._hedging_lock:
+            if self._hedging is None or self._hedging[0] != pid:
+                executor = ThreadPoolExecutor(max_workers=self.max_hedges,
+                                              thread_name_prefix=f'vault-{self.name}-hedge')
+                self._hedging = (pid, executor, threading.BoundedSemaphore(self.max_hedges))
+            return self._hedging[1], self._hedging[2]
+
+    def _count_response_bytes(self, response):
+        """Count the bytes of every response body as received, like request_bytes counts the bodies as sent.
+        Transports decompress response bodies, so the size on the wire of a gzipped body is its
+        Content-Length, and the saving is the difference from the decompressed body."""
+        content = getattr(response, 'content', None)
+        if not isinstance(content, bytes):
+            return
+        received = len(content)
+        headers = getattr(response, 'headers', None)
+        if isinstance(headers, collections.abc.Mapping) and headers.get('Content-Encoding') == 'gzip':
+            try:
+                received = int(headers['Content-Length'])
+            except (KeyError, ValueError):
+                pass
+        self._count('response_bytes', received)
+        self._count('response_bytes_saved', len(content) - received)
+
+    def warmup(self, connections: int = 1):
+        """Open connections to vault ahead of the first request and check that vault is healthy, e.g. in the
+        post-fork hook of a worker process.
+
+        With connections > 1, that many health checks are sent concurrently, each from a new context, so
+        the connection pool of the transport keeps that many connections open. RequestsTransport shares
+        its pool between the sessions of all threads, so they are warm for every thread of the process. With
+        several vault nodes, each of them is checked. Raises VaultException if vault is unreachable or
+        unhealthy."""
+        urls = [endpoint.url for endpoint in self.endpoints.endpoints] if self.endpoints is not None else [self.vault_url]
+
+        def check(url):
+            response = self.make_request("GET", f"{url}/api/pvlt/1.0/data/info/health", balance=False)
+            if response.status_code != 200:
+                raise VaultException(f"Vault is not healthy: {response}, {response.text}",
+                                     status_code=response.status_code)
+
+        if connections <= 1:
+            for url in urls:
+                check(url)
+            return
+        # a new context has no session yet, no session is used by several threads at once
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(contextvars.Context().run, check, url)
+                       for url in urls for _ in range(connections)]
+        for future in futures:
+            future.result()
 
     def encrypt(
             self,
@@ -103,10 +430,15 @@ class Vault:
 
         _logger.debug("vault encrypt called: %s %s %s %s %s %s", plaintext, field_name,
                       reason, collection, encryption_type, expiration_secs)
-        if reason is None:
-            reason = self._reason.get()
-        if reason is None:
-            reason = Reason.AppFunctionality
+        reason = self.get_reason(reason)
+        if self._coalescer is not None:
+            return self._coalescer.submit(
+                ('encrypt', collection, field_name, reason, encryption_type, expiration_secs),
+                plaintext,
+                lambda plaintexts: self.bulk_encrypt(
+                    plaintexts, field_name, reason=reason, collection=collection,
+                    encryption_type=encryption_type, expiration_secs=expiration_secs))
+        self._count('encrypted_items')
         query_params: Dict[str, Any] = {"reason": reason.value}
         if expiration_secs:
             query_params["expiration_secs"] = expiration_secs
@@ -123,20 +455,60 @@ class Vault:
                                  field_name=field_name, collection=collection, reason=reason)
         return response.json()[0]["ciphertext"]
 
+    def bulk_encrypt(
+            self,
+            plaintexts: List[str],
+            field_name: str,
+            *,
+            reason: Optional[Reason],
+            collection: Optional[str],
+            encryption_type: Optional[EncryptionType] = None,
+            expiration_secs: Optional[int] = None) -> List[str]:
+
+        _logger.debug("vault %s bulk encrypt called: %s %s %s %s %s", self.name, field_name,
+                      reason, collection, encryption_type, expiration_secs)
+        self._count('encrypted_items', len(plaintexts))
+        reason = self.get_reason(reason)
+        return [ciphertext for batch in self._split(plaintexts) for ciphertext in self._bulk_encrypt(
+            batch, field_name, reason, collection, encryption_type, expiration_secs)]
+
+    def _bulk_encrypt(self, plaintexts: List[str], field_name: str, reason: Reason, collection: Optional[str],
+                      encryption_type: Optional[EncryptionType], expiration_secs: Optional[int]) -> List[str]:
+        query_params: Dict[str, Any] = {"reason": reason.value}
+        if expiration_secs:
+            query_params["expiration_secs"] = expiration_secs
+        post_body: List[Dict[str, Any]] = [{"object": {"fields": {field_name: plaintext}}} for plaintext in plaintexts]
+        if encryption_type:
+            for item in post_body:
+                item['type'] = encryption_type.value
+        response = self.make_request(
+            "POST",
+            f"{self.vault_url}/api/pvlt/1.0/data/collections/{collection}/encrypt/objects",
+            params=query_params,
+            json=post_body)
+        if response.status_code != 200:
+            raise VaultException(f"Failed to bulk encrypt: {response}, {response.text}", status_code=response.status_code,
+                                 field_name=field_name, collection=collection, reason=reason)
+        return [r["ciphertext"] for r in response.json()]
+
     def decrypt(self, ciphertext: str, field_name: str, reason: Optional[Reason], collection: Optional[str]) -> str:
         transformations = self._get_transformations()
         logging.debug("transformations: %s", transformations)
         if (collection, field_name) in transformations:
             field_name = f'{field_name}.{transformations[(collection, field_name)]}'
         logging.debug("vault decrypt called with %s %s %s %s", ciphertext, field_name, reason, collection)
-        if reason is None:
-            reason = self._reason.get()
-        if reason is None:
-            reason = Reason.AppFunctionality
+        reason = self.get_reason(reason)
+        if self._coalescer is not None:
+            return self._coalescer.submit(
+                ('decrypt', collection, field_name, reason),
+                ciphertext,
+                lambda ciphertexts: self.bulk_decrypt(ciphertexts, field_name, reason, collection))
+        self._count('decrypted_items')
         response = self.make_request(
             "POST",
             f"{self.vault_url}/api/pvlt/1.0/data/collections/{collection}/decrypt/objects",
             params={"reason": reason.value},
+            hedge='single',
             json=[{"encrypted_object": {"ciphertext": ciphertext}, "props": [field_name]}])
         if response.status_code != 200:
             raise VaultException(f"Failed to decrypt: {response}, {response.text}", status_code=response.status_code,
@@ -144,20 +516,67 @@ class Vault:
         return response.json()[0]["fields"][field_name]
 
     def bulk_decrypt(self, ciphertexts: List[str], field_name: str, reason: Optional[Reason], collection: Optional[str]) -> List[str]:
-        logging.debug("vault bulk decrypt called with %s %s %s %s", ciphertexts, field_name, reason, collection)
-        if reason is None:
-            reason = self._reason.get()
-        if reason is None:
-            reason = Reason.AppFunctionality
+        logging.debug("vault %s bulk decrypt called with %s %s %s %s", self.name, ciphertexts, field_name, reason, collection)
+        self._count('decrypted_items', len(ciphertexts))
+        reason = self.get_reason(reason)
+        return [value for batch in self._split(ciphertexts)
+                for value in self._bulk_decrypt(batch, field_name, reason, collection)]
+
+    def _bulk_decrypt(self, ciphertexts: List[str], field_name: str, reason: Reason,
+                      collection: Optional[str]) -> List[str]:
+        return [fields[field_name] for fields in self._bulk_decrypt_objects(ciphertexts, [field_name], reason, collection)]
+
+    def encrypt_object(
+            self,
+            fields: Dict[str, Any],
+            *,
+            reason: Optional[Reason],
+            collection: Optional[str],
+            encryption_type: Optional[EncryptionType] = None,
+            expiration_secs: Optional[int] = None) -> str:
+        """Encrypt several properties together as a single object, returning one ciphertext"""
+        _logger.debug("vault encrypt object called: %s %s %s %s %s", list(fields), reason, collection,
+                      encryption_type, expiration_secs)
+        reason = self.get_reason(reason)
+        self._count('encrypted_items')
+        query_params: Dict[str, Any] = {"reason": reason.value}
+        if expiration_secs:
+            query_params["expiration_secs"] = expiration_secs
+        item: Dict[str, Any] = {"object": {"fields": fields}}
+        if encryption_type:
+            item['type'] = encryption_type.value
+        response = self.make_request(
+            "POST",
+            f"{self.vault_url}/api/pvlt/1.0/data/collections/{collection}/encrypt/objects",
+            params=query_params,
+            json=[item])
+        if response.status_code != 200:
+            raise VaultException(f"Failed to encrypt: {response}, {response.text}", status_code=response.status_code,
+                                 field_name=','.join(fields), collection=collection, reason=reason)
+        return response.json()[0]["ciphertext"]
+
+    def bulk_decrypt_objects(self, ciphertexts: List[str], props: List[str], reason: Optional[Reason],
+                             collection: Optional[str]) -> List[Dict[str, Any]]:
+        """Decrypt the given properties of objects encrypted by encrypt_object. Properties that are not set in
+        an object are missing from its result."""
+        logging.debug("vault %s bulk decrypt objects called with %s %s %s", self.name, props, reason, collection)
+        self._count('decrypted_items', len(ciphertexts))
+        reason = self.get_reason(reason)
+        return [fields for batch in self._split(ciphertexts)
+                for fields in self._bulk_decrypt_objects(batch, props, reason, collection)]
+
+    def _bulk_decrypt_objects(self, ciphertexts: List[str], props: List[str], reason: Reason,
+                              collection: Optional[str]) -> List[Dict[str, Any]]:
         response = self.make_request(
             "POST",
             f"{self.vault_url}/api/pvlt/1.0/data/collections/{collection}/decrypt/objects",
             params={"reason": reason.value},
-            json=[{"encrypted_object": {"ciphertext": ciphertext}, "props": [field_name]} for ciphertext in ciphertexts])
+            hedge='single' if len(ciphertexts) == 1 else 'bulk',
+            json=[{"encrypted_object": {"ciphertext": ciphertext}, "props": props} for ciphertext in ciphertexts])
         if response.status_code != 200:
             raise VaultException(f"Failed to bulk decrypt: {response}, {response.text}", status_code=response.status_code,
-                                 field_name=field_name, collection=collection, reason=reason)
-        return [r["fields"][field_name] for r in response.json()]
+                                 field_name=','.join(props), collection=collection, reason=reason)
+        return [r["fields"] for r in response.json()]
 
     def add_collection(self, collection: str, collection_type: str, properties: List[Dict]):
         url = f"{self.vault_url}/api/pvlt/1.0/ctl/collections/"
@@ -229,8 +648,16 @@ class Vault:
     def remove_mask(self, field_name: str, collection_name: str):
         self.remove_transformation(field_name, collection_name)
 
+    def get_reason(self, reason: Optional[Reason] = None) -> Reason:
+        """Return the reason that would be sent to vault: the given reason, else the one of the current context"""
+        if reason is None:
+            reason = self._reason.get()
+        if reason is None:
+            reason = Reason.AppFunctionality
+        return reason
+
     def add_reason(self, reason: Reason):
         self._reason.set(reason)
 
-    def remove_reason(self):
+    def remove_reason(self, reason: Optional[Reason] = None):
         self._reason.set(None)
@@ -0,0 +1,202 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+from django_encryption.vault_wrapper import (EncryptionType, Reason, Vault,
+                                             VaultException)
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_LINGER_SECS = 0.005
+DEFAULT_PUT_TIMEOUT_SECS = 30
+DEFAULT_RESULT_TIMEOUT_SECS = 60
+
+
+class _EncryptRequest(NamedTuple):
+    vault: Vault
+    collection: Optional[str]
+    field_name: str
+    reason: Reason
+    encryption_type: Optional[EncryptionType]
+    expiration_secs: Optional[int]
+    plaintext: str
+    future: Future
+
+    @property
+    def batch_key(self) -> Tuple:
+        return (id(self.vault), self.collection, self.field_name, self.reason, self.encryption_type,
+                self.expiration_secs)
+
+
+class WriteBehindQueue:
+    """A bounded queue of values to encrypt, drained by a worker thread that coalesces values submitted
+    by all threads into large bulk encrypt requests.
+
+    submit() blocks for up to put_timeout when the queue is full, so that producers are slowed down to
+    the rate vault can sustain rather than buffering without bound, and result() waits for up to
+    result_timeout for a ciphertext. The worker is restarted if it died, and in a forked process."""
+
+    def __init__(self, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE, batch_size: int = DEFAULT_BATCH_SIZE,
+                 linger: float = DEFAULT_LINGER_SECS, put_timeout: float = DEFAULT_PUT_TIMEOUT_SECS,
+                 result_timeout: float = DEFAULT_RESULT_TIMEOUT_SECS):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.linger = linger
+        self.put_timeout = put_timeout
+        self.result_timeout = result_timeout
+        self._closed = False
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._worker: Optional[threading.Thread] = None
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid() and self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # the values queued by the parent process are encrypted there, and the queue inherited through
+                # fork may hold locks taken by threads that do not exist here
+                self._queue = queue.Queue(maxsize=self.max_queue_size)
+                self._pid = os.getpid()
+                self._worker = None
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='vault-write-behind', daemon=True)
+                self._worker.start()
+
+    def submit(self, vault: Vault, plaintext: str, field_name: str, *, reason: Reason, collection: Optional[str],
+               encryption_type: Optional[EncryptionType] = None, expiration_secs: Optional[int] = None) -> Future:
+        """Enqueue a value and return a future of its ciphertext"""
+        if self._closed:
+            raise RuntimeError('write-behind queue is closed')
+        self._ensure_worker()
+        future: Future = Future()
+        request = _EncryptRequest(vault, collection, field_name, reason, encryption_type, expiration_secs,
+                                  plaintext, future)
+        try:
+            self._queue.put(request, timeout=self.put_timeout)
+        except queue.Full:
+            raise VaultException('Write-behind queue is full', status_code=0, collection=collection,
+                                 field_name=field_name, reason=reason)
+        return future
+
+    def result(self, future: Future) -> str:
+        """Wait for the ciphertext of a future returned by submit()"""
+        try:
+            return future.result(timeout=self.result_timeout)
+        except FutureTimeoutError:
+            raise VaultException(f'Write-behind encryption did not complete within {self.result_timeout}s',
+                                 status_code=0)
+
+    def flush(self):
+        """Block until all the values submitted so far are encrypted"""
+        self._queue.join()
+
+    def close(self):
+        """Encrypt all pending values and stop the worker"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._pid != os.getpid() or self._worker is None or not self._worker.is_alive():
+            # nothing is left to drain by a worker of this process
+            return
+        self._queue.put(None)
+        self._worker.join()
+
+    def _next_batch(self) -> Tuple[List[_EncryptRequest], bool]:
+        first = self._queue.get()
+        if first is None:
+            self._queue.task_done()
+            return [], True
+        batch = [first]
+        stop = False
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.task_done()
+                stop = True
+                break
+            batch.append(request)
+        return batch, stop
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            groups: Dict[Tuple, List[_EncryptRequest]] = {}
+            for request in batch:
+                groups.setdefault(request.batch_key, []).append(request)
+            for group in groups.values():
+                try:
+                    self._encrypt_group(group)
+                except Exception as e:
+                    # the worker must survive, and no value may be left waiting
+                    for request in group:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _encrypt_group(self, group: List[_EncryptRequest]):
+        first = group[0]
+        try:
+            ciphertexts = first.vault.bulk_encrypt(
+                plaintexts=[request.plaintext for request in group],
+                field_name=first.field_name,
+                reason=first.reason,
+                collection=first.collection,
+                encryption_type=first.encryption_type,
+                expiration_secs=first.expiration_secs)
+        except Exception as e:
+            _logger.debug("write-behind bulk encrypt of %s values failed: %s", len(group), e)
+            for request in group:
+                request.future.set_exception(e)
+            return
+        if len(ciphertexts) != len(group):
+            # the ciphertexts cannot be matched to the values, none of them is used
+            error = VaultException(
+                f'Bulk encrypt returned {len(ciphertexts)} ciphertexts for {len(group)} values', status_code=0,
+                collection=first.collection, field_name=first.field_name, reason=first.reason)
+            for request in group:
+                request.future.set_exception(error)
+            return
+        for request, ciphertext in zip(group, ciphertexts):
+            request.future.set_result(ciphertext)
+
+
+_write_behind_queue: Optional[WriteBehindQueue] = None
+_write_behind_queue_lock = threading.Lock()
+
+
+def get_write_behind_queue() -> WriteBehindQueue:
+    """Return the process wide queue, configured by settings.VAULT_WRITE_BEHIND, e.g.
+    VAULT_WRITE_BEHIND = {'MAX_QUEUE_SIZE': 10000, 'BATCH_SIZE': 500, 'LINGER_SECS': 0.005, 'PUT_TIMEOUT_SECS': 30,
+    'RESULT_TIMEOUT_SECS': 60}"""
+    global _write_behind_queue
+    if _write_behind_queue is None:
+        with _write_behind_queue_lock:
+            if _write_behind_queue is None:
+                config = getattr(settings, 'VAULT_WRITE_BEHIND', None) or {}
+                _write_behind_queue = WriteBehindQueue(
+                    max_queue_size=config.get('MAX_QUEUE_SIZE', DEFAULT_MAX_QUEUE_SIZE),
+                    batch_size=config.get('BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                    linger=config.get('LINGER_SECS', DEFAULT_LINGER_SECS),
+                    put_timeout=config.get('PUT_TIMEOUT_SECS', DEFAULT_PUT_TIMEOUT_SECS),
+                    result_timeout=config.get('RESULT_TIMEOUT_SECS', DEFAULT_RESULT_TIMEOUT_SECS))
+                atexit.register(_write_behind_queue.close)
+    return _write_behind_queue
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0002_testmodel_enc_ssn_field_alter_testmodel_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestRelatedModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('test_model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='testapp.testmodel')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:16
+
+from django.db import migrations, models
+import django_encryption.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0003_testrelatedmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestContactModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(default='', max_length=20)),
+                ('contact', django_encryption.fields.EncryptedCompositeField(null=True, properties=['name', 'email', 'phone'])),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
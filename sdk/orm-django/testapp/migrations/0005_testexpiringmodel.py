@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:04
+
+from django.db import migrations, models
+import django_encryption.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0004_testcontactmodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestExpiringModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enc_char_field', django_encryption.fields.EncryptedCharField(null=True)),
+                ('expires_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -1,3 +1,5 @@
+from django.db import models
+
 from django_encryption import fields
 
 
@@ -18,3 +20,17 @@ class TestModel(fields.EncryptingModel):
         null=True)
     enc_big_integer_field = fields.EncryptedBigIntegerField(null=True)
     enc_ssn_field = fields.EncryptedSSNField(null=True, data_type_name='SSN')
+
+
+class TestRelatedModel(fields.EncryptingModel):
+    test_model = models.ForeignKey(TestModel, on_delete=models.CASCADE, related_name='+')  # type: ignore[var-annotated]
+
+
+class TestContactModel(fields.EncryptingModel):
+    state = models.CharField(max_length=20, default='')  # type: ignore[var-annotated]
+    contact = fields.EncryptedCompositeField(properties=['name', 'email', 'phone'], null=True)
+
+
+class TestExpiringModel(fields.EncryptingModel):
+    enc_char_field = fields.EncryptedCharField(null=True, expires_at_field='expires_at', expiration_secs=60)
+    expires_at = models.DateTimeField(null=True)  # type: ignore[var-annotated]
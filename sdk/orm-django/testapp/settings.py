@@ -105,6 +105,8 @@ STATIC_URL = '/static/'
 VAULT_ADDRESS = 'http://localhost:8123'
 VAULT_API_KEY = 'pvaultauth'
 VAULT_DEFAULT_COLLECTION = 'test'
+# tests run with collections of their own, which are removed when the run ends
+TEST_RUNNER = 'django_encryption.testing.VaultTestRunner'
 #
 # import logging
 # logging.basicConfig(level=logging.DEBUG)
@@ -1,17 +1,53 @@
+import base64
+import contextlib
+import contextvars
+import csv
 import datetime
+import decimal
+import gzip
+import http.server
+import io
+import json
 import os
+import pickle
+import socketserver
 import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import timezone
 
+import django.db.models
 import mock
-from django.core.exceptions import ImproperlyConfigured
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Max, Min, Sum
 from django.forms import ModelForm
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as django_timezone
 
 import django_encryption.fields
-from django_encryption import fields
-from django_encryption.fields import EncryptedMixin, VaultException, get_vault
+from django_encryption import fields, testing
+from django_encryption.adaptive import AdaptiveController, parse_retry_after
+from django_encryption.aggregates import Histogram
+from django_encryption.balancing import EndpointPool
+from django_encryption.fields import VaultException, get_vault
+from django_encryption.memo import (DecryptMemoMiddleware, decrypt_memo,
+                                    get_decrypt_memo)
+from django_encryption.operations import copy_ciphertext
+from django_encryption.testing import VaultTestMixin
+from django_encryption.traffic import (StandInTransport, TrafficRecorder,
+                                       load_traffic, replay)
+from django_encryption import traffic, transports, vault_wrapper
+from django_encryption.transports import (RequestsTransport, Transport,
+                                          UnixSocketTransport)
+from django_encryption.vault_wrapper import Reason, Vault
+from django_encryption.write_behind import WriteBehindQueue
 
 from . import models
 
@@ -23,6 +59,42 @@ MASK_SSN_VALUE = '***-**-6789'
 SSN_VALUE2 = '856-45-6789'
 MASK_SSN_VALUE2 = '***-**-6789'
 
+FAKE_CIPHERTEXT_PREFIX = 'ct:'
+
+
+@contextlib.contextmanager
+def fake_vault(vault):
+    """Replace the Vault API calls of the given client with a reversible fake, so tests can count calls
+    without a running Vault"""
+    def encrypt(plaintext, field_name, **kwargs):
+        return FAKE_CIPHERTEXT_PREFIX + plaintext
+
+    def decrypt(ciphertext, field_name, reason, collection):
+        return ciphertext[len(FAKE_CIPHERTEXT_PREFIX):]
+
+    def bulk_encrypt(plaintexts, field_name, **kwargs):
+        return [encrypt(plaintext, field_name, **kwargs) for plaintext in plaintexts]
+
+    def bulk_decrypt(ciphertexts, field_name, reason, collection):
+        return [decrypt(ciphertext, field_name, reason, collection) for ciphertext in ciphertexts]
+
+    def encrypt_object(fields, **kwargs):
+        return FAKE_CIPHERTEXT_PREFIX + json.dumps(fields)
+
+    def bulk_decrypt_objects(ciphertexts, props, reason, collection):
+        objects = [json.loads(decrypt(ciphertext, None, reason, collection)) for ciphertext in ciphertexts]
+        return [{prop: fields[prop] for prop in props if prop in fields} for fields in objects]
+
+    with mock.patch.object(vault, 'encrypt', side_effect=encrypt) as encrypt_mock, \
+            mock.patch.object(vault, 'bulk_encrypt', side_effect=bulk_encrypt) as bulk_encrypt_mock, \
+            mock.patch.object(vault, 'decrypt', side_effect=decrypt) as decrypt_mock, \
+            mock.patch.object(vault, 'bulk_decrypt', side_effect=bulk_decrypt) as bulk_decrypt_mock, \
+            mock.patch.object(vault, 'encrypt_object', side_effect=encrypt_object) as encrypt_object_mock, \
+            mock.patch.object(vault, 'bulk_decrypt_objects', side_effect=bulk_decrypt_objects) as bulk_decrypt_objects_mock:
+        yield mock.Mock(encrypt=encrypt_mock, bulk_encrypt=bulk_encrypt_mock, decrypt=decrypt_mock,
+                        bulk_decrypt=bulk_decrypt_mock, encrypt_object=encrypt_object_mock,
+                        bulk_decrypt_objects=bulk_decrypt_objects_mock)
+
 
 class TestSettings(TestCase):
 
@@ -38,37 +110,1361 @@ class TestSettings(TestCase):
             self.assertRaises(ImproperlyConfigured, fields.get_vault)
 
 
-class TestModelTestCase(TestCase):
+class TestVaultRouting(TestCase):
+    VAULTS = {'eu': {'ADDRESS': 'http://eu.localhost:8123', 'API_KEY': 'eu-key', 'DEFAULT_COLLECTION': 'eu_test'}}
 
-    def setUp(self) -> None:
+    def test_get_vault_alias(self):
+        with self.settings(VAULTS=self.VAULTS):
+            vault = fields.get_vault('eu')
+            self.assertEqual(vault.vault_url, 'http://eu.localhost:8123')
+            self.assertEqual(vault.name, 'eu')
+            self.assertRaises(ImproperlyConfigured, fields.get_vault, 'us')
 
-        vault = get_vault()
-        vault.add_collection(TEST_COLLECTION_NAME, 'PERSONS', [])
+    def test_using_vault(self):
+        field = models.TestModel._meta.get_field('enc_char_field')
+        with self.settings(VAULTS=self.VAULTS):
+            self.assertIs(field.resolve_vault(), fields._VAULT)
+            with fields.using_vault('eu'):
+                vault = field.resolve_vault()
+                self.assertEqual(vault.name, 'eu')
+                self.assertIs(vault, fields.get_vault_client('eu'))
+                self.assertEqual(field.vault_collection, f'{fields._collection_prefix}eu_test')
+
+    def test_bulk_decrypt_partitioned_by_router(self):
+        instances = [models.TestModel(id=i) for i in range(4)]
+
+        def router(field, instance=None):
+            return 'eu' if instance is not None and instance.id % 2 else None
+
+        with self.settings(VAULTS=self.VAULTS, VAULT_ROUTER=router):
+            eu_vault = fields.get_vault_client('eu')
+            with fake_vault(fields._VAULT) as default_calls, fake_vault(eu_vault) as eu_calls:
+                field = models.TestModel._meta.get_field('enc_char_field')
+                values = field.get_decrypted_values(
+                    ['ct:a', 'ct:b', 'ct:c', 'ct:d'], instances=instances)
+        self.assertEqual(values, ['a', 'b', 'c', 'd'])
+        self.assertEqual(default_calls.bulk_decrypt.call_count, 1)
+        self.assertEqual(default_calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:a', 'ct:c'])
+        self.assertEqual(eu_calls.bulk_decrypt.call_count, 1)
+        self.assertEqual(eu_calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:b', 'ct:d'])
+
+    def test_eager_decryption_of_multiple_rows(self):
+        with fake_vault(fields._VAULT):
+            models.TestModel.objects.create(enc_char_field='a', enc_text_field='x')
+            models.TestModel.objects.create(enc_char_field='b', enc_text_field='y')
+            objects = list(models.TestModel.objects.order_by('id'))
+        self.assertEqual([o.enc_char_field for o in objects], ['a', 'b'])
+        self.assertEqual([o.enc_text_field for o in objects], ['x', 'y'])
+
+
+class TestDecryptCache(TestCase):
+    CACHES = {'vault': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'vault-tests'}}
+    VAULT_DECRYPT_CACHE = {'CACHE': 'vault', 'KEY': 'Mb3rzUfDGi9iIvrJLQx2hMhhP8ZK-0Zg4d6JqPgrVt8=', 'TIMEOUT': 60}
+
+    def setUp(self):
+        self.field = models.TestModel._meta.get_field('enc_char_field')
+
+    def test_shared_cache(self):
+        with self.settings(CACHES=self.CACHES, VAULT_DECRYPT_CACHE=self.VAULT_DECRYPT_CACHE):
+            with fake_vault(fields._VAULT) as calls:
+                self.assertEqual(self.field.get_decrypted_values(['ct:a', 'ct:b', 'ct:a']), ['a', 'b', 'a'])
+                self.assertEqual(calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:a', 'ct:b'])
+                self.assertEqual(self.field.get_decrypted_values(['ct:b', 'ct:c']), ['b', 'c'])
+                self.assertEqual(calls.bulk_decrypt.call_count, 2)
+                self.assertEqual(calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:c'])
+
+                # entries are scoped by reason and transformation
+                with fields.with_reason(Reason.Analytics):
+                    self.field.get_decrypted_values(['ct:a'])
+                self.field.get_decrypted_values(['ct:a'], transformation='mask')
+                self.assertEqual(calls.bulk_decrypt.call_count, 4)
+
+            # values are encrypted at rest
+            from django.core.cache import caches
+            cache = caches['vault']
+            for key in cache._cache:
+                self.assertNotIn(b'"a"', cache._cache[key])
+
+
+class TestDecryptMemo(TestCase):
+
+    def test_memo_dedupes_across_batches(self):
+        field = models.TestModel._meta.get_field('enc_char_field')
+        with fake_vault(fields._VAULT) as calls:
+            with decrypt_memo():
+                self.assertEqual(field.get_decrypted_values(['ct:a', 'ct:a', 'ct:b']), ['a', 'a', 'b'])
+                self.assertEqual(field.get_decrypted_values(['ct:b', 'ct:a']), ['b', 'a'])
+                self.assertEqual(calls.bulk_decrypt.call_count, 1)
+                self.assertEqual(calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:a', 'ct:b'])
+                memo = get_decrypt_memo()
+            self.assertIsNone(get_decrypt_memo())
+            self.assertEqual(memo, {})
+            field.get_decrypted_values(['ct:a'])
+            self.assertEqual(calls.bulk_decrypt.call_count, 2)
+
+    def test_memo_dedupes_single_decrypts(self):
+        with fake_vault(fields._VAULT) as calls:
+            models.TestModel.objects.create(enc_char_field='a')
+            with decrypt_memo():
+                # loaded without a queryset batch, the deferred field is decrypted on its own when accessed
+                for _ in range(2):
+                    instance = models.TestModel._base_manager.defer('enc_char_field').get()
+                    self.assertEqual(instance.enc_char_field, 'a')
+            self.assertEqual(calls.decrypt.call_count, 1)
+            self.assertEqual(calls.bulk_decrypt.call_count, 0)
+
+    def test_middleware(self):
+        def view(request):
+            return [[o.enc_char_field for o in models.TestModel.objects.all()] for _ in range(2)]
+
+        with fake_vault(fields._VAULT) as calls:
+            models.TestModel.objects.create(enc_char_field='a', enc_text_field='x')
+            self.assertEqual(DecryptMemoMiddleware(view)(None), [['a'], ['a']])
+            # a single bulk_decrypt per field for both loads
+            bulk_decrypt_calls = calls.bulk_decrypt.call_count
+            view(None)
+            self.assertEqual(calls.bulk_decrypt.call_count, 3 * bulk_decrypt_calls)
+
+
+class TestRelatedDecryption(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for value in ['a', 'b', 'c']:
+                models.TestRelatedModel.objects.create(
+                    test_model=models.TestModel.objects.create(enc_char_field=value, enc_text_field=value))
+
+    def assert_related_decrypted(self, queryset):
+        with fake_vault(fields._VAULT) as calls:
+            objects = list(queryset.order_by('id'))
+            bulk_decrypt_calls = calls.bulk_decrypt.call_count
+            self.assertEqual([o.test_model.enc_char_field for o in objects], ['a', 'b', 'c'])
+            self.assertEqual([o.test_model.enc_text_field for o in objects], ['a', 'b', 'c'])
+        # a single bulk decrypt per non empty field, with no per instance decrypts
+        self.assertEqual(bulk_decrypt_calls, 5)
+        self.assertEqual(calls.bulk_decrypt.call_count, 5)
+        self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_select_related(self):
+        self.assert_related_decrypted(models.TestRelatedModel.objects.select_related('test_model'))
+
+    def test_prefetch_related(self):
+        self.assert_related_decrypted(models.TestRelatedModel.objects.prefetch_related('test_model'))
+
+
+class TestPickling(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for value in ['a', 'b', 'c']:
+                models.TestModel.objects.create(enc_char_field=value, enc_text_field=value)
+
+    def test_plaintexts_are_not_pickled(self):
+        with fake_vault(fields._VAULT):
+            objects = list(models.TestModel.objects.order_by('id'))
+        values, index = fields._locate_value(objects[0], models.TestModel._meta.get_field('enc_char_field'))
+        pickled_values = objects[0].__getstate__()[fields._VALUES]
+        self.assertEqual(pickled_values.ciphertexts[index], 'ct:a')
+        self.assertIs(pickled_values.plaintexts[index], fields._NOT_SET)
+        # the instance itself is left decrypted
+        self.assertEqual(values.plaintexts[index], 'a')
+
+    def test_instances_without_ciphertexts_are_not_pickled(self):
+        with fake_vault(fields._VAULT):
+            objects = list(models.TestModel.objects.discard_ciphertexts().order_by('id'))
+            self.assertEqual(objects[0].enc_char_field, 'a')
+        self.assertRaises(TypeError, pickle.dumps, objects[0])
+
+    def test_unpickled_list_is_decrypted_in_bulk(self):
+        with fake_vault(fields._VAULT) as load_calls:
+            objects = pickle.loads(pickle.dumps(list(models.TestModel.objects.order_by('id'))))
+        with fake_vault(fields._VAULT) as calls:
+            self.assertEqual([o.enc_char_field for o in objects], ['a', 'b', 'c'])
+            self.assertEqual([o.enc_text_field for o in objects], ['a', 'b', 'c'])
+        # the same bulk calls as loading the queryset
+        self.assertEqual(calls.bulk_decrypt.call_count, load_calls.bulk_decrypt.call_count)
+        self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_unpickled_queryset_is_decrypted_in_bulk(self):
+        with fake_vault(fields._VAULT):
+            queryset = models.TestModel.objects.order_by('id')
+            list(queryset)
+            queryset = pickle.loads(pickle.dumps(queryset))
+        with fake_vault(fields._VAULT) as calls:
+            self.assertEqual([o.enc_char_field for o in queryset], ['a', 'b', 'c'])
+        self.assertEqual(calls.decrypt.call_count, 0)
+        self.assertGreater(calls.bulk_decrypt.call_count, 0)
+
+    def test_modified_value_is_kept(self):
+        with fake_vault(fields._VAULT):
+            obj = models.TestModel.objects.order_by('id').first()
+        obj.enc_char_field = 'changed'
+        with fake_vault(fields._VAULT) as calls:
+            self.assertEqual(pickle.loads(pickle.dumps(obj)).enc_char_field, 'changed')
+        self.assertEqual(calls.decrypt.call_count + calls.bulk_decrypt.call_count, 0)
+
+
+class TestEncryptedValues(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for value in ['a', 'b']:
+                models.TestModel.objects.create(enc_char_field=value, enc_text_field=value)
+
+    def test_null_values_are_cached(self):
+        with fake_vault(fields._VAULT) as calls:
+            objects = list(models.TestModel.objects.all())
+            self.assertIsNone(objects[0].enc_date_field)
+            call_count = calls.bulk_decrypt.call_count
+            django.db.models.prefetch_related_objects(objects, 'enc_date_field', 'enc_char_field')
+        self.assertEqual(calls.bulk_decrypt.call_count, call_count)
+        self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_discard_ciphertexts(self):
+        field = models.TestModel._meta.get_field('enc_char_field')
+        with fake_vault(fields._VAULT):
+            objects = list(models.TestModel.objects.discard_ciphertexts().order_by('id'))
+        values, index = fields._locate_value(objects[0], field)
+        self.assertIs(values.ciphertexts[index], fields._NOT_SET)
+        self.assertEqual([o.enc_char_field for o in objects], ['a', 'b'])
+
+    def test_loaded_values_are_not_deferred(self):
+        with fake_vault(fields._VAULT):
+            obj = models.TestModel.objects.only('id', 'enc_char_field').order_by('id').first()
+            self.assertEqual(obj.get_deferred_fields(), {
+                field.attname for field in models.TestModel._meta.concrete_fields
+                if field.attname not in ('id', 'enc_char_field')})
+            self.assertEqual(obj.enc_text_field, 'a')
+        self.assertNotIn('enc_text_field', obj.get_deferred_fields())
+
+
+class TestDeferredFields(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for value in ['a', 'b', 'c']:
+                models.TestModel.objects.create(enc_char_field=value, enc_text_field=value.upper())
+
+    def test_deferred_fields_are_not_decrypted_eagerly(self):
+        with fake_vault(fields._VAULT) as calls:
+            objects = list(models.TestModel.objects.only('id', 'enc_char_field').order_by('id'))
+        self.assertEqual(calls.bulk_decrypt.call_count, 1)
+        self.assertEqual(calls.bulk_decrypt.call_args.kwargs['field_name'], 'enc_char_field')
+        self.assertEqual([o.enc_char_field for o in objects], ['a', 'b', 'c'])
+
+    def test_deferred_field_is_loaded_in_bulk(self):
+        with fake_vault(fields._VAULT) as calls:
+            objects = list(models.TestModel.objects.defer('enc_text_field').order_by('id'))
+            call_count = calls.bulk_decrypt.call_count
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual([o.enc_text_field for o in objects], ['A', 'B', 'C'])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(calls.bulk_decrypt.call_count, call_count + 1)
+        self.assertEqual(calls.decrypt.call_count, 0)
+        self.assertEqual(objects[0].get_deferred_fields(), set())
+
+    def test_deferred_field_of_single_instance(self):
+        with fake_vault(fields._VAULT) as calls:
+            obj = models.TestModel.objects.defer('enc_text_field').get(enc_char_field='b')
+            self.assertEqual(obj.enc_text_field, 'B')
+        self.assertEqual(calls.decrypt.call_count, 0)
+        # the batch is not pickled
+        self.assertEqual(pickle.loads(pickle.dumps(obj)).pk, obj.pk)
+
+
+class TestRawCiphertext(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for value in ['a', 'b']:
+                models.TestModel.objects.create(enc_char_field=value, enc_text_field=value.upper(),
+                                                enc_integer_field=len(value), enc_date_field=datetime.date(2020, 1, 2))
+            models.TestContactModel.objects.create(name='Alice', email='alice@example.com')
+
+    def test_copy_without_decryption(self):
+        with fake_vault(fields._VAULT) as calls:
+            objects = list(models.TestModel.objects.raw_ciphertext().order_by('id'))
+            self.assertIsInstance(objects[0].enc_char_field, fields.Ciphertext)
+            self.assertEqual(objects[0].enc_char_field, 'ct:a')
+            for obj in objects:
+                obj.pk = None
+                obj.save()
+            self.assertEqual(calls.method_calls, [])
+            copies = list(models.TestModel.objects.order_by('id')[2:])
+        self.assertEqual([(o.enc_char_field, o.enc_text_field, o.enc_integer_field) for o in copies],
+                         [('a', 'A', 1), ('b', 'B', 1)])
+
+    def test_dumpdata_and_loaddata(self):
+        out = io.StringIO()
+        with fake_vault(fields._VAULT) as calls:
+            call_command('dumpdata_ciphertexts', 'testapp.TestModel', 'testapp.TestContactModel', stdout=out)
+            self.assertEqual(calls.method_calls, [])
+        fixture = json.loads(out.getvalue())
+        self.assertEqual(fixture[0]['fields']['enc_char_field'], 'ct:a')
+        self.assertTrue(fixture[-1]['fields']['contact'].startswith(FAKE_CIPHERTEXT_PREFIX))
+        with fake_vault(fields._VAULT):
+            models.TestModel.objects.all().delete()
+            models.TestContactModel.objects.all().delete()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'fixture.json')
+            with open(path, 'w') as file:
+                file.write(out.getvalue())
+            with fake_vault(fields._VAULT) as calls:
+                call_command('loaddata_ciphertexts', path, stdout=io.StringIO())
+                self.assertEqual(calls.method_calls, [])
+        with fake_vault(fields._VAULT):
+            obj = models.TestModel.objects.order_by('id').first()
+            self.assertEqual((obj.enc_char_field, obj.enc_date_field), ('a', datetime.date(2020, 1, 2)))
+            self.assertEqual(models.TestContactModel.objects.get().email, 'alice@example.com')
+
+    def test_raw_ciphertext_context(self):
+        with fake_vault(fields._VAULT) as calls:
+            obj = models.TestModel.objects.order_by('id').first()
+            with fields.raw_ciphertext():
+                self.assertEqual(obj.enc_char_field, 'ct:a')
+            self.assertEqual(obj.enc_char_field, 'a')
+            obj.enc_text_field = fields.Ciphertext('ct:copied')
+            obj.save()
+            self.assertNotIn('ct:copied', [call.kwargs['plaintext'] for call in calls.encrypt.call_args_list])
+        with fake_vault(fields._VAULT):
+            self.assertEqual(models.TestModel.objects.get(pk=obj.pk).enc_text_field, 'copied')
+
+    def test_plain_strings_are_encrypted_in_raw_context(self):
+        with fake_vault(fields._VAULT) as calls, fields.raw_ciphertext():
+            obj = models.TestModel.objects.order_by('id').first()
+            # as by full_clean()
+            obj.enc_text_field = models.TestModel._meta.get_field('enc_text_field').clean('plain', obj)
+            self.assertNotIsInstance(obj.enc_text_field, fields.Ciphertext)
+            obj.save()
+            self.assertIn('plain', [call.kwargs['plaintext'] for call in calls.encrypt.call_args_list])
+            self.assertEqual(models.TestModel.objects.get(pk=obj.pk).enc_text_field, 'ct:plain')
+            with self.assertRaises(ValidationError):
+                models.TestContactModel._meta.get_field('contact').to_python('ct:not json')
+
+
+class TestDecryptedAggregate(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for group, number in [('a', 1), ('b', 2), ('a', 3), ('b', None), ('a', 5)]:
+                models.TestModel.objects.create(enc_char_field=group, enc_text_field='x', enc_integer_field=number)
+
+    def test_aggregate(self):
+        with fake_vault(fields._VAULT) as calls:
+            result = models.TestModel.objects.decrypted_aggregate(
+                chunk_size=2, total=Sum('enc_integer_field'), avg=Avg('enc_integer_field'),
+                low=Min('enc_integer_field'), high=Max('enc_integer_field'), count=Count('enc_integer_field'),
+                rows=Count('*'), histogram=Histogram('enc_integer_field', [2, 4]))
+        self.assertEqual(result, {'total': 11, 'avg': 2.75, 'low': 1, 'high': 5, 'count': 4, 'rows': 5,
+                                  'histogram': [1, 2, 1]})
+        # one bulk decrypt per chunk, and no per row decrypts
+        self.assertEqual(calls.bulk_decrypt.call_count, 3)
+        self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_group_by(self):
+        with fake_vault(fields._VAULT):
+            result = models.TestModel.objects.filter(enc_integer_field__isnull=False).decrypted_aggregate(
+                group_by=['enc_char_field'], total=Sum('enc_integer_field'), rows=Count('*'))
+        self.assertEqual(result, {('a',): {'total': 9, 'rows': 3}, ('b',): {'total': 2, 'rows': 1}})
+
+    def test_empty(self):
+        result = models.TestModel.objects.none().decrypted_aggregate(total=Sum('enc_integer_field'),
+                                                                     rows=Count('*'))
+        self.assertEqual(result, {'total': None, 'rows': 0})
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            models.TestModel.objects.decrypted_aggregate(total=Sum('enc_integer_field', distinct=True))
+
+
+class TestDecryptedOrderBy(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for name, number in [('c', 3), ('a', 1), ('e', None), ('b', 2), ('d', 3)]:
+                models.TestModel.objects.create(enc_char_field=name, enc_text_field='x', enc_integer_field=number)
+
+    def names(self, instances):
+        return [instance.enc_char_field for instance in instances]
+
+    def test_top_k(self):
+        with fake_vault(fields._VAULT) as calls:
+            page = models.TestModel.objects.decrypted_order_by('enc_integer_field', limit=2, chunk_size=2)
+            self.assertEqual(self.names(page), ['a', 'b'])
+        # nothing but the sort keys and the page is decrypted
+        decrypted = [ciphertext for call in calls.bulk_decrypt.call_args_list for ciphertext in call.kwargs['ciphertexts']]
+        self.assertNotIn('ct:c', decrypted)
+        self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_descending_page(self):
+        with fake_vault(fields._VAULT):
+            page = models.TestModel.objects.decrypted_order_by(
+                '-enc_integer_field', 'enc_char_field', limit=3, offset=1, chunk_size=2)
+            # nulls come first in descending order, ties are ordered by the next field
+            self.assertEqual(self.names(page), ['c', 'd', 'b'])
+
+    def test_full_ordering(self):
+        with fake_vault(fields._VAULT):
+            ordered = models.TestModel.objects.decrypted_order_by('enc_integer_field', '-enc_char_field', chunk_size=2)
+            self.assertEqual(self.names(ordered), ['a', 'b', 'd', 'c', 'e'])
+
+    def test_spilled_runs_are_encrypted(self):
+        with fake_vault(fields._VAULT):
+            models.TestModel.objects.create(enc_char_field='confidential', enc_text_field='x')
+        spilled = []
+        original_spill = fields._spill
+
+        def spill(entries, fernet):
+            file = original_spill(entries, fernet)
+            spilled.append(file.read())
+            file.seek(0)
+            return file
+
+        with fake_vault(fields._VAULT), mock.patch.object(fields, '_spill', side_effect=spill):
+            ordered = models.TestModel.objects.decrypted_order_by('-enc_char_field', chunk_size=2)
+            self.assertEqual(self.names(ordered), ['e', 'd', 'confidential', 'c', 'b', 'a'])
+        self.assertEqual(len(spilled), 3)
+        self.assertFalse(any(b'confidential' in data for data in spilled))
+
+    def test_spilling_requires_cryptography(self):
+        with fake_vault(fields._VAULT), mock.patch.dict(sys.modules, {'cryptography.fernet': None}):
+            # what fits in one chunk is sorted in memory
+            ordered = models.TestModel.objects.decrypted_order_by('enc_char_field')
+            self.assertEqual(self.names(ordered), ['a', 'b', 'c', 'd', 'e'])
+            with self.assertRaises(ImproperlyConfigured):
+                models.TestModel.objects.decrypted_order_by('enc_char_field', chunk_size=2)
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        with fake_vault(fields._VAULT):
+            for name, number in [('a', 1), ('b', None), ('c', 3)]:
+                models.TestModel.objects.create(enc_char_field=name, enc_text_field='x', enc_integer_field=number)
+
+    def test_export_csv(self):
+        output = io.StringIO()
+        with fake_vault(fields._VAULT) as calls:
+            rows = models.TestModel.objects.export_csv(
+                output, ['enc_char_field', 'enc_integer_field'], chunk_size=2, max_workers=2)
+        self.assertEqual(rows, 3)
+        self.assertEqual(list(csv.reader(io.StringIO(output.getvalue()))), [
+            ['enc_char_field', 'enc_integer_field'], ['a', '1'], ['b', ''], ['c', '3']])
+        # one bulk decrypt per encrypted column and chunk
+        self.assertEqual(calls.bulk_decrypt.call_count, 4)
+        self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_export_all_fields(self):
+        output = io.StringIO()
+        with fake_vault(fields._VAULT):
+            models.TestModel.objects.filter(enc_integer_field=None).export_csv(output)
+        header, row = csv.reader(io.StringIO(output.getvalue()))
+        self.assertEqual(header, [field.attname for field in models.TestModel._meta.concrete_fields])
+        self.assertEqual(row[header.index('enc_char_field')], 'b')
+
+    def test_sliced_querysets_are_rejected(self):
+        with self.assertRaises(ValueError):
+            models.TestModel.objects.all()[:2].export_csv(io.StringIO())
+
+    def test_arrow_requires_pyarrow(self):
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            with self.assertRaises(ImportError):
+                models.TestModel.objects.to_arrow()
+
+
+class TestCompositeField(TestCase):
+
+    def test_properties_are_encrypted_together(self):
+        with fake_vault(fields._VAULT) as calls:
+            contact = models.TestContactModel.objects.create(name='Alice', email='alice@example.com')
+            self.assertEqual(calls.encrypt_object.call_count, 1)
+            self.assertEqual(calls.encrypt_object.call_args.args[0], {'name': 'Alice', 'email': 'alice@example.com'})
+            models.TestContactModel.objects.create(contact={'name': 'Bob', 'phone': '555'})
+            loaded = list(models.TestContactModel.objects.order_by('pk'))
+        self.assertEqual(calls.bulk_decrypt_objects.call_count, 1)
+        self.assertEqual(calls.bulk_decrypt_objects.call_args.args[1], ['name', 'email', 'phone'])
+        self.assertEqual(loaded[0].contact, {'name': 'Alice', 'email': 'alice@example.com', 'phone': None})
+        self.assertEqual((loaded[1].name, loaded[1].phone, loaded[1].email), ('Bob', '555', None))
+        raw = models.TestContactModel.objects.values_list('contact', flat=True).get(pk=contact.pk)
+        self.assertTrue(raw[1].startswith(FAKE_CIPHERTEXT_PREFIX))
+
+    def test_set_property(self):
+        with fake_vault(fields._VAULT) as calls:
+            contact = models.TestContactModel.objects.create(name='Alice', email='alice@example.com')
+            contact = models.TestContactModel.objects.get(pk=contact.pk)
+            contact.email = 'alice@example.org'
+            contact.save()
+            self.assertEqual(calls.encrypt_object.call_args.args[0],
+                             {'name': 'Alice', 'email': 'alice@example.org'})
+            self.assertEqual(models.TestContactModel.objects.get(pk=contact.pk).email, 'alice@example.org')
+
+    def test_select_properties(self):
+        with fake_vault(fields._VAULT) as calls:
+            contact = models.TestContactModel.objects.create(name='Alice', email='alice@example.com')
+            loaded = models.TestContactModel.objects.select_properties('contact', 'email').get(pk=contact.pk)
+            self.assertEqual(calls.bulk_decrypt_objects.call_args.args[1], ['email'])
+            self.assertEqual((loaded.email, loaded.name), ('alice@example.com', None))
+            loaded.email = 'alice@example.org'
+            with self.assertRaises(ValueError), transaction.atomic():
+                loaded.save()
+            # other fields can still be saved
+            loaded.state = 'active'
+            loaded.save(update_fields=['state'])
+        with self.assertRaises(ValueError):
+            models.TestContactModel.objects.select_properties('contact', 'address')
+
+    def test_typed_properties(self):
+        field = fields.EncryptedCompositeField(properties={'born': 'DATE_OF_BIRTH', 'seen': 'DATE_TIME',
+                                                           'balance': 'STRING'})
+        field.set_attributes_from_name('details')
+        seen = datetime.datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+        value = {'born': datetime.date(1990, 1, 2), 'seen': seen, 'balance': decimal.Decimal('10.50')}
+        properties = field.get_db_prep_properties(value)
+        self.assertEqual(properties, {'born': '1990-01-02', 'seen': '2024-05-01T12:30:00+00:00', 'balance': '10.50'})
+        self.assertEqual(field.to_python(json.loads(json.dumps(properties))), dict(value, balance='10.50'))
+        with self.assertRaises(ValidationError):
+            field.to_python({'born': '1990-02-30'})
+
+    def test_property_name_clashes(self):
+        for name, properties in [('Clash1', ['state']), ('Clash2', ['save']), ('Clash3', ['contact'])]:
+            with self.assertRaises(ImproperlyConfigured):
+                type(name, (fields.EncryptingModel,), {
+                    '__module__': models.__name__,
+                    'state': django.db.models.CharField(max_length=20),
+                    'contact': fields.EncryptedCompositeField(properties=properties),
+                })
+
+    def test_vault_properties(self):
+        field = models.TestContactModel._meta.get_field('contact')
+        self.assertEqual(field.get_vault_properties(), [('name', 'STRING'), ('email', 'STRING'), ('phone', 'STRING')])
+        self.assertIsNone(models.TestContactModel().contact)
+
+
+class TestWriteBehind(TestCase):
+
+    def setUp(self):
+        field = models.TestModel._meta.get_field('enc_char_field')
+        patcher = mock.patch.object(field, 'write_behind', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bulk_create(self):
+        with fake_vault(fields._VAULT) as calls:
+            models.TestModel.objects.bulk_create(
+                [models.TestModel(enc_char_field=value, enc_text_field='x') for value in ['a', 'b', 'c']])
+            self.assertEqual(calls.bulk_encrypt.call_count, 1)
+            self.assertEqual(calls.bulk_encrypt.call_args.kwargs['plaintexts'], ['a', 'b', 'c'])
+            self.assertNotIn('enc_char_field', [c.kwargs['field_name'] for c in calls.encrypt.call_args_list])
+            self.assertEqual([o.enc_char_field for o in models.TestModel.objects.order_by('id')], ['a', 'b', 'c'])
+
+    def test_save(self):
+        with fake_vault(fields._VAULT) as calls:
+            inst = models.TestModel.objects.create(enc_char_field='a', enc_text_field='x')
+            inst.enc_char_field = 'b'
+            inst.save(update_fields=['enc_char_field'])
+            self.assertEqual(calls.bulk_encrypt.call_count, 2)
+            self.assertEqual(models.TestModel.objects.get().enc_char_field, 'b')
+
+    def test_write_behind_queue(self):
+        write_queue = WriteBehindQueue(batch_size=10, linger=0.05)
+        with fake_vault(fields._VAULT) as calls:
+            futures = [write_queue.submit(fields._VAULT, value, 'enc_char_field', reason=Reason.AppFunctionality,
+                                          collection='test') for value in ['a', 'b', 'c']]
+            write_queue.close()
+        self.assertEqual([future.result() for future in futures], ['ct:a', 'ct:b', 'ct:c'])
+        self.assertEqual(calls.bulk_encrypt.call_count, 1)
+
+    def test_missing_ciphertexts_fail_every_value(self):
+        write_queue = WriteBehindQueue(batch_size=10, linger=0.05)
+        with mock.patch.object(fields._VAULT, 'bulk_encrypt', return_value=['ct:a']):
+            futures = [write_queue.submit(fields._VAULT, value, 'enc_char_field', reason=Reason.AppFunctionality,
+                                          collection='test') for value in ['a', 'b']]
+            write_queue.flush()
+        for future in futures:
+            with self.assertRaises(VaultException):
+                write_queue.result(future)
+        write_queue.close()
+
+    def test_result_timeout(self):
+        write_queue = WriteBehindQueue(result_timeout=0.01)
+        with self.assertRaises(VaultException):
+            write_queue.result(Future())
+        write_queue.close()
+
+    def test_worker_is_restarted(self):
+        write_queue = WriteBehindQueue(linger=0)
+        # as if the worker died, or the queue was inherited by a forked process
+        for kill in (lambda: write_queue._queue.put(None), lambda: setattr(write_queue, '_pid', -1)):
+            kill()
+            write_queue._worker.join(0.1)
+            with fake_vault(fields._VAULT):
+                future = write_queue.submit(fields._VAULT, 'a', 'enc_char_field', reason=Reason.AppFunctionality,
+                                            collection='test')
+                self.assertEqual(write_queue.result(future), 'ct:a')
+        write_queue.close()
+
+
+class TestCoalescing(TestCase):
+
+    def test_concurrent_decrypts_are_coalesced(self):
+        vault = Vault('http://localhost:8123', 'test', 'test', coalesce_linger=0.1)
+        with mock.patch.object(vault, 'bulk_decrypt',
+                               side_effect=lambda ciphertexts, *args: [c.upper() for c in ciphertexts]) as bulk_decrypt:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                values = list(executor.map(
+                    lambda ciphertext: vault.decrypt(ciphertext, 'name', reason=None, collection='test'),
+                    ['a', 'b', 'c', 'd']))
+        self.assertEqual(values, ['A', 'B', 'C', 'D'])
+        self.assertEqual(bulk_decrypt.call_count, 1)
+        self.assertEqual(sorted(bulk_decrypt.call_args.args[0]), ['a', 'b', 'c', 'd'])
+
+    def test_rejected_items_fail_only_their_callers(self):
+        vault = Vault('http://localhost:8123', 'test', 'test', coalesce_linger=0.1)
+
+        def bulk_decrypt(ciphertexts, *args):
+            if 'bad' in ciphertexts:
+                raise VaultException('Failed to bulk decrypt', status_code=400)
+            return [c.upper() for c in ciphertexts]
+
+        def decrypt(ciphertext):
+            try:
+                return vault.decrypt(ciphertext, 'name', reason=None, collection='test')
+            except VaultException as e:
+                return e.status_code
+
+        with mock.patch.object(vault, 'bulk_decrypt', side_effect=bulk_decrypt):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                values = list(executor.map(decrypt, ['a', 'bad', 'c', 'd']))
+        self.assertEqual(values, ['A', 400, 'C', 'D'])
+
+    def test_request_failures_fail_every_caller(self):
+        vault = Vault('http://localhost:8123', 'test', 'test', coalesce_linger=0.1)
+        error = VaultException('Failed to bulk decrypt', status_code=503)
+        with mock.patch.object(vault, 'bulk_decrypt', side_effect=error) as bulk_decrypt:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [executor.submit(vault.decrypt, ciphertext, 'name', reason=None, collection='test')
+                           for ciphertext in 'ab']
+                self.assertEqual([future.exception() for future in futures], [error, error])
+        self.assertEqual(bulk_decrypt.call_count, 1)
+
+    def test_full_batch_runs_immediately(self):
+        vault = Vault('http://localhost:8123', 'test', 'test', coalesce_linger=60, coalesce_max_batch_size=1)
+        with mock.patch.object(vault, 'bulk_encrypt', return_value=['ct:a']) as bulk_encrypt:
+            self.assertEqual(vault.encrypt('a', 'name', reason=None, collection='test'), 'ct:a')
+        self.assertEqual(bulk_encrypt.call_count, 1)
+
+
+class TestBinaryStorage(TestCase):
+    CIPHERTEXT = 'AAECAwQFBgc='
+
+    def setUp(self):
+        self.field = models.TestModel._meta.get_field('enc_text_field')
+        patcher = mock.patch.object(self.field, 'binary', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_binary_round_trip(self):
+        self.assertEqual(self.field.get_internal_type(), 'BinaryField')
+        self.assertEqual(self.field.deconstruct()[3]['binary'], True)
+        with fake_vault(fields._VAULT) as calls:
+            # binary storage requires base64 ciphertexts
+            calls.encrypt.side_effect = lambda plaintext, field_name, **kwargs: base64.b64encode(
+                plaintext.encode()).decode()
+            calls.bulk_decrypt.side_effect = lambda ciphertexts, **kwargs: [
+                base64.b64decode(ciphertext).decode() for ciphertext in ciphertexts]
+            models.TestModel.objects.create(enc_char_field='a', enc_text_field='xyz')
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT enc_char_field, enc_text_field FROM testapp_testmodel')
+                self.assertEqual(cursor.fetchone(), ('YQ==', b'xyz'))
+            self.assertEqual(models.TestModel.objects.get().enc_text_field, 'xyz')
+
+    def test_non_base64_ciphertext(self):
+        self.assertRaises(ValueError, self.field.ciphertext_to_db, 'ct:x', connection)
+
+    def test_copy_ciphertext(self):
+        with fake_vault(fields._VAULT) as calls:
+            with mock.patch.object(self.field, 'binary', False):
+                for _ in range(3):
+                    models.TestModel.objects.create(enc_char_field='a', enc_text_field='a')
+            models.TestModel.objects.update(enc_char_field=fields.Ciphertext(self.CIPHERTEXT))
+            encrypt_calls = calls.encrypt.call_count
+            operation = copy_ciphertext('testapp.TestModel', 'enc_char_field', 'enc_text_field', batch_size=2)
+            operation.code(apps, mock.Mock(connection=connection))
+            self.assertEqual(calls.encrypt.call_count, encrypt_calls)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT enc_text_field FROM testapp_testmodel')
+            self.assertEqual([bytes(row[0]) for row in cursor.fetchall()], [bytes(range(8))] * 3)
+
+
+class TestCompression(TestCase):
+    LONG_TEXT = 'This is a long note. ' * 100
+
+    def setUp(self):
+        self.field = models.TestModel._meta.get_field('enc_text_field')
+        patcher = mock.patch.object(self.field, 'compress', 'zlib')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_compressed_round_trip(self):
+        with fake_vault(fields._VAULT) as calls:
+            models.TestModel.objects.create(enc_char_field='short', enc_text_field=self.LONG_TEXT)
+            plaintexts = {c.kwargs['field_name']: c.kwargs['plaintext'] for c in calls.encrypt.call_args_list}
+            self.assertTrue(plaintexts['enc_text_field'].startswith('\x1fcompressed:zlib:'))
+            self.assertLess(len(plaintexts['enc_text_field']), len(self.LONG_TEXT) / 10)
+            inst = models.TestModel.objects.get()
+            self.assertEqual(inst.enc_text_field, self.LONG_TEXT)
+            ciphertext = 'ct:' + plaintexts['enc_text_field']
+            self.assertEqual(self.field.get_decrypted_value(ciphertext), self.LONG_TEXT)
+
+    def test_short_and_legacy_values(self):
+        self.assertEqual(self.field.compress_plaintext('short'), 'short')
+        self.assertEqual(self.field.decompress_plaintext(self.LONG_TEXT), self.LONG_TEXT)
+        with mock.patch.object(self.field, 'compress', None):
+            self.assertEqual(self.field.compress_plaintext(self.LONG_TEXT), self.LONG_TEXT)
+
+    def test_corrupt_payload(self):
+        for value in ['\x1fcompressed:zlib:not base64!', '\x1fcompressed:zlib:' + base64.b64encode(b'x').decode(),
+                      '\x1fcompressed:lzma:' + base64.b64encode(b'x').decode()]:
+            with self.assertRaises(VaultException):
+                self.field.decompress_plaintext(value)
+
+    def test_transformations_are_rejected(self):
+        with self.assertRaises(ValueError):
+            models.TestModel.objects.mask('enc_text_field')
+        with self.assertRaises(ImproperlyConfigured):
+            fields.EncryptedCharField(compress='zlib', data_type_name='SSN')
+
+
+class TestExpiry(TestCase):
+
+    def setUp(self):
+        self.field = models.TestExpiringModel._meta.get_field('enc_char_field')
+
+    def test_expired_values_are_not_sent(self):
+        now = django_timezone.now()
+        instances = [models.TestExpiringModel() for _ in range(3)]
+        for instance, expires_at in zip(instances, [now - datetime.timedelta(seconds=1), now + datetime.timedelta(hours=1), None]):
+            instance.expires_at = expires_at
+        with fake_vault(fields._VAULT) as calls:
+            values = self.field.get_decrypted_values(['ct:a', 'ct:b', 'ct:c'], instances=instances)
+            self.assertEqual(values, [None, 'b', 'c'])
+            self.assertEqual(calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:b', 'ct:c'])
+            with mock.patch.object(self.field, 'on_error', fields.raise_error):
+                self.assertRaises(VaultException, self.field.get_decrypted_value, 'ct:a', instance=instances[0])
+            self.assertEqual(calls.decrypt.call_count, 0)
+
+    def test_expired_values_are_not_exported_or_aggregated(self):
+        with fake_vault(fields._VAULT):
+            expired, _ = [models.TestExpiringModel.objects.create(enc_char_field=name) for name in 'ab']
+        models.TestExpiringModel.objects.filter(pk=expired.pk).update(
+            expires_at=django_timezone.now() - datetime.timedelta(seconds=1))
+        output = io.StringIO()
+        with fake_vault(fields._VAULT) as calls:
+            models.TestExpiringModel.objects.export_csv(output, ['enc_char_field'], max_workers=2)
+            groups = models.TestExpiringModel.objects.decrypted_aggregate(group_by=['enc_char_field'], rows=Count('*'))
+            self.assertEqual(calls.bulk_decrypt.call_args.kwargs['ciphertexts'], ['ct:b'])
+        self.assertEqual(list(csv.reader(io.StringIO(output.getvalue()))), [['enc_char_field'], [''], ['b']])
+        self.assertEqual(groups, {(None,): {'rows': 1}, ('b',): {'rows': 1}})
+
+    def test_save_sets_expires_at(self):
+        with fake_vault(fields._VAULT):
+            inst = models.TestExpiringModel.objects.create(enc_char_field='a')
+        self.assertAlmostEqual(inst.expires_at, django_timezone.now() + datetime.timedelta(seconds=60),
+                               delta=datetime.timedelta(seconds=5))
+
+
+class TestPartialFailures(TestCase):
+
+    def setUp(self):
+        self.field = models.TestModel._meta.get_field('enc_char_field')
+
+    def bulk_decrypt(self, ciphertexts, field_name, reason, collection):
+        if 'bad' in ciphertexts:
+            raise VaultException('Failed to bulk decrypt', status_code=400)
+        return [ciphertext.upper() for ciphertext in ciphertexts]
+
+    def test_failed_items_are_isolated(self):
+        ciphertexts = ['a', 'b', 'c', 'bad', 'e', 'f', 'g', 'h']
+        with mock.patch.object(fields._VAULT, 'bulk_decrypt', side_effect=self.bulk_decrypt) as bulk_decrypt, \
+                mock.patch.object(self.field, 'on_error', 'error'):
+            values = self.field.get_decrypted_values(ciphertexts)
+        self.assertEqual(values, ['A', 'B', 'C', 'error', 'E', 'F', 'G', 'H'])
+        self.assertEqual(bulk_decrypt.call_count, 7)
+
+    def test_batch_errors_are_not_bisected(self):
+        error = VaultException('Unavailable', status_code=503)
+        with mock.patch.object(fields._VAULT, 'bulk_decrypt', side_effect=error) as bulk_decrypt, \
+                mock.patch.object(self.field, 'on_error', 'error'):
+            self.assertEqual(self.field.get_decrypted_values(['a', 'b', 'c']), ['error'] * 3)
+        self.assertEqual(bulk_decrypt.call_count, 1)
+
+    def test_raise_error(self):
+        with mock.patch.object(fields._VAULT, 'bulk_decrypt', side_effect=self.bulk_decrypt) as bulk_decrypt, \
+                mock.patch.object(self.field, 'on_error', fields.raise_error):
+            self.assertRaises(VaultException, self.field.get_decrypted_values, ['a', 'bad'])
+        self.assertEqual(bulk_decrypt.call_count, 1)
+
+
+class _EchoDecryptHandler(http.server.BaseHTTPRequestHandler):
+    """Answers decrypt requests with the ciphertexts as the decrypted values"""
+
+    def do_POST(self):
+        items = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        body = json.dumps([{'fields': {item['props'][0]: item['encrypted_object']['ciphertext']}}
+                           for item in items]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestTransports(TestCase):
+
+    def test_transport_setting(self):
+        with self.settings(VAULT_TRANSPORT={'BACKEND': 'django_encryption.transports.UnixSocketTransport',
+                                            'OPTIONS': {'socket_path': '/run/pvault.sock'}}):
+            vault = get_vault()
+        self.assertIsInstance(vault.transport, UnixSocketTransport)
+        self.assertEqual(vault.transport.socket_path, '/run/pvault.sock')
+
+    def test_transports_must_implement_request(self):
+        class NoRequestTransport(Transport):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoRequestTransport()
+
+    def test_custom_transport(self):
+        transport = mock.Mock(spec=Transport)
+        transport.request.return_value = mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'a'}}])
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport)
+        self.assertEqual(vault.bulk_decrypt(['ct:a'], 'name', reason=None, collection='test'), ['a'])
+        self.assertEqual(transport.request.call_args.kwargs['headers']['Authorization'], 'Bearer key')
+
+    def test_unix_socket_transport(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), 'pvault.sock')
+        server = socketserver.ThreadingUnixStreamServer(socket_path, _EchoDecryptHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(os.remove, socket_path)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        vault = Vault('http://localhost', 'key', 'test', transport=UnixSocketTransport(socket_path))
+        self.assertEqual(vault.bulk_decrypt(['a', 'b'], 'name', reason=None, collection='test'), ['a', 'b'])
+
+
+class TestCompressedRequests(TestCase):
+
+    def make_vault(self, *responses):
+        transport = mock.Mock(spec=Transport)
+        transport.request.side_effect = list(responses)
+        return Vault('http://localhost:8123', 'key', 'test', transport=transport, compress_min_bytes=100), transport
+
+    def test_large_body_is_gzipped(self):
+        ciphertexts = [f'ct:{i}' for i in range(100)]
+        vault, transport = self.make_vault(mock.Mock(status_code=200, json=lambda: [
+            {'fields': {'name': ciphertext}} for ciphertext in ciphertexts]))
+        vault.bulk_decrypt(ciphertexts, 'name', reason=None, collection='test')
+        kwargs = transport.request.call_args.kwargs
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        body = gzip.decompress(kwargs['data'])
+        self.assertEqual(json.loads(body)[0], {'encrypted_object': {'ciphertext': 'ct:0'}, 'props': ['name']})
+        self.assertEqual(vault.get_stats()['request_bytes_saved'], len(body) - len(kwargs['data']))
+
+    def test_small_body_is_not_gzipped(self):
+        vault, transport = self.make_vault(mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'a'}}]))
+        vault.bulk_decrypt(['ct:a'], 'name', reason=None, collection='test')
+        kwargs = transport.request.call_args.kwargs
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+        self.assertEqual(json.loads(kwargs['data']), [{'encrypted_object': {'ciphertext': 'ct:a'}, 'props': ['name']}])
+
+    def test_unsupported_compression_falls_back(self):
+        ciphertexts = [f'ct:{i}' for i in range(100)]
+        vault, transport = self.make_vault(
+            mock.Mock(status_code=415),
+            mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'a'}}] * 100))
+        vault.bulk_decrypt(ciphertexts, 'name', reason=None, collection='test')
+        self.assertEqual(transport.request.call_count, 2)
+        self.assertNotIn('Content-Encoding', transport.request.call_args.kwargs['headers'])
+        self.assertIsNone(vault.compress_min_bytes)
+
+    def test_compressed_response_is_counted(self):
+        vault, transport = self.make_vault(mock.Mock(
+            status_code=200, headers={'Content-Encoding': 'gzip', 'Content-Length': '40'}, content=b'x' * 100,
+            json=lambda: [{'fields': {'name': 'a'}}]))
+        vault.bulk_decrypt(['ct:a'], 'name', reason=None, collection='test')
+        self.assertEqual(vault.get_stats()['response_bytes'], 40)
+        self.assertEqual(vault.get_stats()['response_bytes_saved'], 60)
+
+    def test_uncompressed_response_is_counted(self):
+        vault, transport = self.make_vault(mock.Mock(
+            status_code=200, headers={'Content-Length': '100'}, content=b'x' * 100,
+            json=lambda: [{'fields': {'name': 'a'}}]))
+        vault.bulk_decrypt(['ct:a'], 'name', reason=None, collection='test')
+        self.assertEqual(vault.get_stats()['response_bytes'], 100)
+        self.assertEqual(vault.get_stats()['response_bytes_saved'], 0)
+
+
+class TestWarmup(TestCase):
+
+    def test_warmup_opens_connections(self):
+        transport = mock.Mock(spec=Transport)
+        transport.request.return_value = mock.Mock(status_code=200)
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport)
+        vault.warmup(connections=3)
+        self.assertEqual(transport.request.call_count, 3)
+        self.assertEqual(transport.request.call_args.args,
+                         ('GET', 'http://localhost:8123/api/pvlt/1.0/data/info/health'))
+
+    def test_warmup_shares_connections_not_sessions(self):
+        transport = RequestsTransport()
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport)
+        sessions = []
+
+        def request(session, method, url, **kwargs):
+            sessions.append(session)
+            return mock.Mock(status_code=200)
+
+        with mock.patch('requests.Session.request', autospec=True, side_effect=request):
+            vault.warmup(connections=3)
+        self.assertEqual(len(set(map(id, sessions))), 3)
+        self.assertEqual({id(session.get_adapter('http://localhost:8123')) for session in sessions},
+                         {id(transport._get_session().get_adapter('http://localhost:8123'))})
+
+    def test_warmup_unhealthy(self):
+        transport = mock.Mock(spec=Transport)
+        transport.request.return_value = mock.Mock(status_code=503)
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport)
+        with self.assertRaises(VaultException) as cm:
+            vault.warmup()
+        self.assertEqual(cm.exception.status_code, 503)
+
+    def test_warmup_vaults(self):
+        eu_vault = mock.Mock(spec=Vault)
+        with self.settings(VAULTS={'eu': {'ADDRESS': 'http://eu', 'API_KEY': 'key'}}), \
+                mock.patch.object(fields._VAULT, 'warmup') as default_warmup, \
+                mock.patch.dict(fields._VAULT_CLIENTS, {'eu': eu_vault}):
+            fields.warmup_vaults(connections=2)
+        default_warmup.assert_called_once_with(2)
+        eu_vault.warmup.assert_called_once_with(2)
+
+    def test_copied_context_gets_a_session_per_thread(self):
+        transport = RequestsTransport()
+        session = transport._get_session()
+        context = contextvars.copy_context()
+        self.assertIs(context.run(transport._get_session), session)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            worker_session = executor.submit(context.run, transport._get_session).result()
+        self.assertIsNot(worker_session, session)
+        self.assertIs(worker_session.get_adapter('http://localhost'), session.get_adapter('http://localhost'))
+        self.assertIs(transport._get_session(), session)
+
+    def test_session_is_replaced_after_fork(self):
+        transport = RequestsTransport()
+        session = transport._get_session()
+        self.assertIs(transport._get_session(), session)
+        with mock.patch.object(transports.os, 'getpid', return_value=os.getpid() + 1), \
+                mock.patch.object(session, 'close') as close:
+            forked_session = transport._get_session()
+            transport.close()
+        self.assertIsNot(forked_session, session)
+        # the parent's session is left to the parent
+        close.assert_not_called()
+
+
+class TestAdaptiveController(TestCase):
+
+    def test_additive_increase_multiplicative_decrease(self):
+        controller = AdaptiveController(initial_concurrency=4, initial_batch_items=100, target_latency=1)
+        for _ in range(4):
+            controller.acquire()
+            controller.release(0.1, 200)
+        self.assertEqual(controller.get_state()['concurrency_limit'], 4)
+        self.assertGreater(controller.concurrency_limit, 4.9)
+        self.assertGreater(controller.batch_items, 140)
+        controller.acquire()
+        controller.acquire()
+        controller.release(0.1, 429)
+        # the second failure of the same round trip does not decrease the limits again
+        controller.release(0.1, 429)
+        self.assertEqual(controller.get_state()['concurrency_limit'], 2)
+        self.assertEqual(controller.get_state()['in_flight'], 0)
+
+    def test_split(self):
+        controller = AdaptiveController(initial_batch_items=3, max_batch_bytes=10)
+        self.assertEqual(list(controller.split(['a', 'b', 'c', 'd'], len)), [['a', 'b', 'c'], ['d']])
+        self.assertEqual(list(controller.split(['aaaaaa', 'bbbbbb', 'c'], len)), [['aaaaaa'], ['bbbbbb', 'c']])
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('2'), 2.0)
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+
+    def test_bulk_requests_are_split_and_retried(self):
+        def request(method, url, *, headers, data, **kwargs):
+            if not responses:
+                items = json.loads(data)
+                return mock.Mock(status_code=200, json=lambda: [
+                    {'fields': {'name': item['encrypted_object']['ciphertext']}} for item in items])
+            return responses.pop()
+        responses = [mock.Mock(status_code=429, headers={'Retry-After': '0'})]
+        transport = mock.Mock(spec=Transport)
+        transport.request.side_effect = request
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport,
+                      adaptive=AdaptiveController(initial_batch_items=2, min_batch_items=2))
+        self.assertEqual(vault.bulk_decrypt(['a', 'b', 'c', 'd', 'e'], 'name', reason=None, collection='test'),
+                         ['a', 'b', 'c', 'd', 'e'])
+        # three batches, the first one sent twice
+        self.assertEqual(transport.request.call_count, 4)
+        self.assertEqual(vault.get_stats()['retries'], 1)
+        self.assertEqual(vault.get_limits()['in_flight'], 0)
+
+    def test_adaptive_setting(self):
+        with self.settings(VAULT_ADAPTIVE={'MAX_CONCURRENCY': 8, 'TARGET_LATENCY': 0.2}):
+            vault = get_vault()
+        self.assertEqual(vault.adaptive.max_concurrency, 8)
+        self.assertEqual(vault.adaptive.target_latency, 0.2)
+        self.assertEqual(fields._VAULT.get_limits(), {})
+
+
+class TestLoadBalancing(TestCase):
+
+    def test_least_outstanding(self):
+        pool = EndpointPool(['http://a', 'http://b'])
+        first = pool.choose()
+        second = pool.choose()
+        self.assertNotEqual(first, second)
+        pool.finish(first, 0.01, ok=True)
+        self.assertIs(pool.choose(), first)
+
+    def test_ejection(self):
+        pool = EndpointPool(['http://a', 'http://b'], eject_after_failures=2)
+        a, b = pool.endpoints
+        for _ in range(2):
+            a.outstanding = 1
+            pool.finish(a, 0.01, ok=False)
+        self.assertEqual([state['ejected'] for state in pool.get_state()], [True, False])
+        self.assertEqual({pool.choose().url for _ in range(4)}, {'http://b'})
+        # with every node ejected, requests are still sent
+        for _ in range(2):
+            b.outstanding = 1
+            pool.finish(b, 0.01, ok=False)
+        self.assertIsNotNone(pool.choose())
+
+    def test_requests_are_balanced(self):
+        transport = mock.Mock(spec=Transport)
+        transport.request.return_value = mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'x'}}])
+        vault = Vault(['http://a:8123/', 'http://b:8123'], 'key', 'test', transport=transport)
+        for _ in range(4):
+            vault.decrypt('ct', 'name', reason=None, collection='test')
+        hosts = [call.args[1].split('/api/')[0] for call in transport.request.call_args_list]
+        self.assertEqual(sorted(hosts), ['http://a:8123'] * 2 + ['http://b:8123'] * 2)
+        self.assertEqual([state['outstanding'] for state in vault.get_endpoints()], [0, 0])
+
+    def hedging_vault(self, request, **kwargs):
+        transport = mock.Mock(spec=Transport)
+        transport.request.side_effect = request
+        vault = Vault(['http://slow:8123', 'http://fast:8123'], 'key', 'test', transport=transport,
+                      hedge_percentile=50, **kwargs)
+        # single reads are hedged after 50ms
+        for _ in range(20):
+            vault.endpoints.finish(vault.endpoints.choose(), 0.05, ok=True, kind='single')
+        return vault
+
+    def first_to_slow(self, vault):
+        slow, fast = vault.endpoints.endpoints
+
+        def choose(exclude=None):
+            endpoint = slow if exclude is None else fast
+            endpoint.outstanding += 1
+            return endpoint
+        return mock.patch.object(vault.endpoints, 'choose', side_effect=choose)
+
+    def test_failed_slow_read_is_hedged(self):
+        hedged = threading.Event()
+        threads = []
+
+        def request(method, url, *, headers, **kwargs):
+            if url.startswith('http://slow'):
+                threads.append(threading.get_ident())
+                # fails once the hedge was sent
+                hedged.wait(5)
+                return mock.Mock(status_code=503, text='')
+            hedged.set()
+            return mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'fast'}}])
+        vault = self.hedging_vault(request)
+        with self.first_to_slow(vault):
+            self.assertEqual(vault.decrypt('ct', 'name', reason=None, collection='test'), 'fast')
+        self.assertEqual(vault.get_stats()['hedged_requests'], 1)
+        # the first attempt is sent from the calling thread
+        self.assertEqual(threads, [threading.get_ident()])
+
+    def test_latency_windows(self):
+        pool = EndpointPool(['http://a', 'http://b'], hedge_percentile=50, hedge_min_samples=2)
+        for latency in [0.01, 0.01, 1.0, 1.0]:
+            pool.finish(pool.choose(), latency, ok=True, kind='single' if latency < 0.1 else 'bulk')
+        pool.finish(pool.choose(), 5.0, ok=True)
+        self.assertEqual(pool.hedge_delay('single'), 0.01)
+        self.assertEqual(pool.hedge_delay('bulk'), 1.0)
+
+    def test_hedges_are_bounded(self):
+        release = threading.Event()
+
+        def request(method, url, *, headers, **kwargs):
+            if url.startswith('http://slow'):
+                release.wait(5)
+            return mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'x'}}])
+        vault = self.hedging_vault(request, max_hedges=1)
+        with self.first_to_slow(vault), ThreadPoolExecutor(max_workers=2) as executor:
+            reads = [executor.submit(vault.decrypt, 'ct', 'name', reason=None, collection='test') for _ in range(2)]
+            time.sleep(0.2)
+            release.set()
+            for read in reads:
+                read.result()
+        self.assertEqual(vault.get_stats()['hedged_requests'], 1)
+
+    def test_hedges_are_admitted_by_the_adaptive_controller(self):
+        in_flight = []
+
+        def request(method, url, *, headers, **kwargs):
+            if url.startswith('http://slow'):
+                time.sleep(0.3)
+            else:
+                in_flight.append(vault.adaptive.in_flight)
+            return mock.Mock(status_code=200, json=lambda: [{'fields': {'name': 'x'}}])
+        for concurrency, hedges in [(1, 0), (2, 1)]:
+            vault = self.hedging_vault(request, adaptive=AdaptiveController(initial_concurrency=concurrency))
+            with self.first_to_slow(vault):
+                vault.decrypt('ct', 'name', reason=None, collection='test')
+            self.assertEqual(vault.get_stats().get('hedged_requests', 0), hedges)
+            self.assertEqual(vault.adaptive.in_flight, 0)
+        # the hedge was counted as in flight along with the first attempt
+        self.assertEqual(in_flight, [2])
+
+    def test_hedge_executor_is_replaced_after_fork(self):
+        vault = self.hedging_vault(lambda *args, **kwargs: None)
+        executor, _ = vault._get_hedging()
+        self.assertIs(vault._get_hedging()[0], executor)
+        with mock.patch.object(vault_wrapper.os, 'getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(vault._get_hedging()[0], executor)
+
+    def test_warmup_checks_every_node(self):
+        transport = mock.Mock(spec=Transport)
+        transport.request.return_value = mock.Mock(status_code=200)
+        vault = Vault(['http://a:8123', 'http://b:8123'], 'key', 'test', transport=transport)
+        vault.warmup()
+        self.assertEqual([call.args[1] for call in transport.request.call_args_list],
+                         ['http://a:8123/api/pvlt/1.0/data/info/health', 'http://b:8123/api/pvlt/1.0/data/info/health'])
+
+    def test_address_list_setting(self):
+        with self.settings(VAULT_ADDRESS=['http://a:8123', 'http://b:8123'], VAULT_HEDGE_PERCENTILE=95):
+            vault = get_vault()
+        self.assertEqual(vault.vault_url, 'http://a:8123')
+        self.assertEqual(vault.endpoints.hedge_percentile, 95)
+        self.assertIsNone(fields._VAULT.endpoints)
+
+
+class TestTrafficRecording(TestCase):
+
+    def record(self, recorder):
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=StandInTransport(), recorder=recorder)
+        ciphertexts = vault.bulk_encrypt(['123-45-6789', '987-65-4321'], 'ssn', reason=None, collection='persons')
+        self.assertEqual(vault.decrypt(ciphertexts[0], 'ssn', reason=None, collection='persons'), '123-45-6789')
+        return vault
+
+    def test_shape_is_recorded(self):
+        recorder = TrafficRecorder()
+        self.record(recorder)
+        self.assertEqual([(entry['op'], entry['collection'], entry['props'], entry['items'], entry['status'])
+                          for entry in recorder.entries],
+                         [('encrypt', 'persons', ['ssn'], 2, 200), ('decrypt', 'persons', ['ssn'], 1, 200)])
+        self.assertEqual(recorder.entries[0]['in_flight'], 1)
+        self.assertGreater(recorder.entries[0]['request_bytes'], 0)
+        recorded = json.dumps(list(recorder.entries))
+        self.assertNotIn('6789', recorded)
+        self.assertNotIn('4321', recorded)
+
+    def test_replay(self):
+        recorder = TrafficRecorder()
+        self.record(recorder)
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=StandInTransport())
+        summary = replay(vault, recorder.entries, threads=2, speed=0, copies=3).summary()
+        self.assertEqual(summary['requests'], 6)
+        self.assertEqual(summary['items'], 9)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(set(summary['latency']), {'encrypt', 'decrypt'})
+
+    def test_replayed_values_are_valid_for_their_data_types(self):
+        recorder = TrafficRecorder()
+        self.record(recorder)
+        transport = StandInTransport()
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport)
+        schema = [{'name': 'Persons', 'properties': [{'name': 'SSN', 'data_type_name': 'SSN'}]}]
+        with mock.patch.object(vault, 'list_collections', return_value=schema), \
+                mock.patch.object(transport, 'request', wraps=transport.request) as request:
+            self.assertEqual(replay(vault, recorder.entries, speed=0).summary()['errors'], 0)
+        values = [item['object']['fields']['ssn'] for call in request.call_args_list if '/encrypt/' in call.args[1]
+                  for item in json.loads(call.kwargs['data'])]
+        self.assertEqual(len(values), 3)
+        for value in values:
+            self.assertRegex(value, r'^(?!000|666|9)\d{3}-(?!00)\d{2}-(?!0000)\d{4}$')
+
+    def test_request_bytes_are_the_sent_bytes(self):
+        recorder = TrafficRecorder()
+        transport = mock.Mock(spec=Transport)
+        transport.request.return_value = mock.Mock(status_code=200, content=b'',
+                                                   json=lambda: [{'ciphertext': 'a'}, {'ciphertext': 'b'}])
+        vault = Vault('http://localhost:8123', 'key', 'test', transport=transport, recorder=recorder)
+        with mock.patch.object(traffic, 'json', wraps=json) as traffic_json:
+            vault.bulk_encrypt(['a', 'b'], 'name', reason=None, collection='persons')
+        self.assertEqual(recorder.entries[0]['request_bytes'], len(transport.request.call_args.kwargs['data']))
+        # the body is serialized once, by the client
+        traffic_json.dumps.assert_not_called()
+
+    def test_replay_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = TrafficRecorder(os.path.join(directory, 'traffic-{pid}.jsonl'))
+            self.record(recorder)
+            recorder.close()
+            path = os.path.join(directory, f'traffic-{os.getpid()}.jsonl')
+            self.assertEqual(len(load_traffic([path])), 2)
+            out = io.StringIO()
+            call_command('replay_vault_traffic', path, '--stand-in', '--speed', '0', stdout=out)
+        self.assertIn('Replayed 2 requests (3 items)', out.getvalue())
+        self.assertIn('decrypt: p50', out.getvalue())
+
+    def test_recording_setting(self):
+        with self.settings(VAULT_TRAFFIC_RECORDING='/tmp/vault-traffic-{pid}.jsonl'):
+            vault = get_vault()
+        self.assertEqual(vault.recorder.path, '/tmp/vault-traffic-{pid}.jsonl')
+        self.assertIsNone(get_vault().recorder)
+        with self.settings(VAULT_TRAFFIC_RECORDING=True):
+            self.assertRaises(ImproperlyConfigured, get_vault)
+
+    def test_in_memory_recording_is_bounded(self):
+        recorder = TrafficRecorder(max_entries=1)
+        self.record(recorder)
+        self.assertEqual([entry['op'] for entry in recorder.entries], ['decrypt'])
+
+
+class TestVaultTestFixtures(TestCase):
+
+    def setUp(self):
+        provisioned = mock.patch.object(testing, '_provisioned', set())
+        provisioned.start()
+        self.addCleanup(provisioned.stop)
+        # these tests assert concrete collection names, also when run by VaultTestRunner
+        prefix = mock.patch.object(fields, '_collection_prefix', '')
+        prefix.start()
+        self.addCleanup(prefix.stop)
+
+    def mock_vault(self):
+        self.vault = mock.MagicMock(default_collection=TEST_COLLECTION_NAME)
+        patcher = mock.patch('django_encryption.testing.get_vault_client', return_value=self.vault)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_missing_collection_is_created_with_its_properties(self):
+        self.mock_vault()
+        self.vault.list_collections.return_value = [{'name': 'test', 'properties': []}]
+        testing.set_collection_prefix('test_run_')
         try:
-            for field in models.TestModel._meta.get_fields():
-                if not isinstance(field, EncryptedMixin):
-                    continue
-                vault.add_property(
-                    property_name=field.vault_property,
-                    collection=TEST_COLLECTION_NAME,
-                    description='',
-                    is_encrypted=True,
-                    is_index=False,
-                    is_nullable=True,
-                    is_unique=False,
-                    data_type_name=field.data_type_name,
-                )
-        except VaultException:
-            vault.remove_collection(TEST_COLLECTION_NAME)
-            raise
-
-    def tearDown(self) -> None:
-        vault = get_vault()
-        collection_names = {c["name"] for c in vault.list_collections()}
-        if TEST_COLLECTION_NAME in collection_names:
-            vault.remove_collection(TEST_COLLECTION_NAME)
-        else:
-            print("tearDown: collection already removed")
+            self.assertEqual(models.TestModel.enc_char_field.field.vault_collection, 'test_run_test')
+            self.assertEqual(testing.provision_collections([models.TestModel]), [('default', 'test_run_test')])
+        finally:
+            testing.set_collection_prefix('')
+        self.assertEqual(models.TestModel.enc_char_field.field.vault_collection, 'test')
+        self.vault.add_collection.assert_called_once()
+        name, collection_type, properties = self.vault.add_collection.call_args[0]
+        self.assertEqual((name, collection_type), ('test_run_test', 'PERSONS'))
+        self.assertIn({'name': 'enc_ssn_field', 'description': '', 'is_encrypted': True, 'is_index': False,
+                       'is_nullable': True, 'is_unique': False, 'data_type_name': 'SSN'}, properties)
+        self.assertEqual(len(properties), 13)
+        self.vault.add_property.assert_not_called()
+
+    def test_only_missing_properties_are_added_once(self):
+        self.mock_vault()
+        self.vault.list_collections.return_value = [
+            {'name': 'TEST', 'properties': [{'name': 'id'}, {'name': 'name'}, {'name': 'email'}]}]
+        self.assertEqual(testing.provision_collections([models.TestContactModel]), [])
+        self.vault.add_collection.assert_not_called()
+        self.vault.add_property.assert_called_once()
+        self.assertEqual(self.vault.add_property.call_args[1]['property_name'], 'phone')
+
+        # provisioned collections are not looked up again
+        testing.provision_collections([models.TestContactModel])
+        self.vault.list_collections.assert_called_once()
+
+    def test_remove_collections(self):
+        self.mock_vault()
+        self.vault.list_collections.return_value = [{'name': 'test'}, {'name': 'test_run_test'}]
+        with self.assertRaises(ValueError):
+            testing.remove_collections('')
+        self.assertEqual(testing.remove_collections('test_run_'), [('default', 'test_run_test')])
+        self.vault.remove_collection.assert_called_once_with('test_run_test')
+
+    def test_mixin_removes_the_collections_it_created(self):
+        self.mock_vault()
+        self.vault.list_collections.return_value = []
+
+        class Case(VaultTestMixin, unittest.TestCase):
+            vault_models = [models.TestModel]
+
+        Case.setUpClass()
+        self.vault.add_collection.assert_called_once()
+        Case.tearDownClass()
+        self.vault.remove_collection.assert_called_once_with('test')
+        # provisioned again by the next test case
+        self.assertEqual(testing.provision_collections([models.TestModel]), [('default', 'test')])
+
+    def test_runner_provisions_each_worker(self):
+        runner = testing.VaultTestRunner(parallel=2)
+        prefix = runner.collection_prefix
+        self.assertRegex(prefix, r'^test_[0-9a-f]{8}_$')
+        self.assertEqual(runner.get_collection_prefixes(), [f'{prefix}1_', f'{prefix}2_'])
+        self.assertEqual(testing.VaultTestRunner(keepdb=True).collection_prefix, 'test_')
+
+        collections = []
+        with mock.patch('django.test.runner.DiscoverRunner.setup_databases'), \
+                mock.patch('django.test.runner.DiscoverRunner.teardown_databases'), \
+                mock.patch('django_encryption.testing.provision_collections',
+                           side_effect=lambda: collections.append(models.TestModel.enc_char_field.field.vault_collection)), \
+                mock.patch('django_encryption.testing.remove_collections') as remove_collections:
+            runner.setup_databases()
+            runner.teardown_databases(None)
+        testing.set_collection_prefix('')
+        self.assertEqual(collections, [f'{prefix}1_test', f'{prefix}2_test'])
+        remove_collections.assert_called_once_with(prefix, {'default'})
+
+    def test_parallel_runs_require_django_4_1(self):
+        with mock.patch.object(django, 'VERSION', (4, 0, 10, 'final', 0)):
+            self.assertRaises(ImproperlyConfigured, testing.VaultTestRunner, parallel=2)
+            self.assertEqual(testing.VaultTestRunner(parallel=1).parallel, 1)
+
+    def test_in_memory_vaults(self):
+        transport = RequestsTransport()
+        # the runner may already answer the default vault in memory
+        with mock.patch.object(fields._VAULT, 'transport', transport), \
+                mock.patch.object(fields._VAULT, 'recorder', None):
+            with testing.InMemoryVaults() as in_memory:
+                self.assertIsInstance(fields._VAULT.transport, StandInTransport)
+                models.TestContactModel.objects.create(state='NY', contact={'name': 'John', 'email': 'j@example.com'})
+                self.assertEqual(models.TestContactModel.objects.get().name, 'John')
+                self.assertEqual([(entry['op'], entry['collection']) for entry in in_memory.get_traffic()],
+                                 [('encrypt', 'test'), ('decrypt', 'test')])
+            self.assertIs(fields._VAULT.transport, transport)
+            self.assertIsNone(fields._VAULT.recorder)
+
+
+class TestModelTestCase(VaultTestMixin, TestCase):
+    vault_models = [models.TestModel]
+
+    def require_vault(self):
+        if isinstance(fields._VAULT.transport, StandInTransport):
+            self.skipTest('requires a vault, vault requests are answered in memory')
 
     def test_value(self):
         test_date_today = datetime.date.today()
@@ -222,6 +1618,7 @@ class TestModelTestCase(TestCase):
             ).validators
 
     def test_mask_value(self):
+        self.require_vault()
         inst = models.TestModel()
 
         inst.enc_ssn_field = SSN_VALUE2
@@ -249,9 +1646,12 @@ class TestModelTestCase(TestCase):
         self.assertEqual(enc_ssn_field.data_type_name, 'SSN')
 
     def test_vault_migration(self):
+        self.require_vault()
+        # the collection of the test run, see VaultTestRunner
+        collection_name = models.TestModel.enc_char_field.field.vault_collection
         vault = get_vault()
         coll_num = len(vault.list_collections())
-        vault.remove_collection(TEST_COLLECTION_NAME)
+        vault.remove_collection(collection_name)
         assert len(vault.list_collections()) == coll_num - 1
         orig_collection_names = {c["name"] for c in vault.list_collections()}
 
@@ -269,7 +1669,8 @@ class TestModelTestCase(TestCase):
                            not in orig_collection_names]
         assert len(new_collections) == 1
         collection = new_collections[0]
-        self.assertEqual(collection["name"], TEST_COLLECTION_NAME)
+        self.assertEqual(collection["name"], collection_name)
         self.assertEqual(collection["type"], "PERSONS")
         self.assertEqual(
-            len(collection["properties"]) + 1, len(models.TestModel._meta.get_fields()))
+            len(collection["properties"]),
+            len([field for field in models.TestModel._meta.get_fields() if isinstance(field, fields.EncryptedMixin)]))